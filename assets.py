@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+
+import table_cache
+import instrumentation
+
+# Bump when the preprocessing of the images changes, so that the cached images are made again
+ASSET_VERSION = 1
+
+# Print resolution of the signature : a larger image is downsampled, a smaller one is kept as it is
+SIGNATURE_DPI = 200
+
+# A gray image is stored with this number of gray levels (4 bits per pixel in the pdf renderer), and its pixels
+# lighter than PAPER_WHITE are made white : the scanned paper grain only costs bytes
+GRAY_LEVELS = 16
+PAPER_WHITE = 240
+
+
+def get_default_asset_dir():
+    """
+    :return:    folder of the preprocessed images, in the cache folder (see 'table_cache.get_default_cache_dir')
+    """
+
+    return os.path.join(table_cache.get_default_cache_dir(), "assets")
+
+
+def prepare_image(image_path, output_path, width, dpi=SIGNATURE_DPI):
+    """
+    Converts an image to the most compact form printed identically : resampled to 'dpi' at its printed width,
+    grayscale if it has no colors, without alpha if it is opaque, with few gray levels
+
+    :param image_path:  path of the source image
+    :param output_path: path of the PNG written
+    :param width:       printed width of the image in points
+    :param dpi:         print resolution, in pixels per inch
+    :return:            None
+    """
+
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(image_path) as source:
+        image = source.convert("RGBA")
+
+    target_width = round(width / 72 * dpi)
+    if image.width > target_width:
+        target_height = max(1, round(image.height * target_width / image.width))
+        image = image.resize((target_width, target_height), Image.LANCZOS)
+
+    pixels = np.asarray(image)
+    rgb = pixels[..., :3].astype(np.int16)
+    alpha = pixels[..., 3]
+
+    if np.abs(rgb - rgb[..., :1]).max() <= 2:
+        step = 255 // (GRAY_LEVELS - 1)
+        gray = rgb.mean(axis=-1)
+        gray[gray >= PAPER_WHITE] = 255
+        gray = (np.round(gray / step) * step).astype(np.uint8)
+        if alpha.min() == 255:
+            image = Image.fromarray(gray, mode="L")
+        else:
+            image = Image.fromarray(np.dstack([gray, alpha]), mode="LA")
+    elif alpha.min() == 255:
+        image = image.convert("RGB")
+
+    image.save(output_path, format="PNG", optimize=True)
+
+
+def get_signature_image(image_path, width, dpi=SIGNATURE_DPI, asset_dir=None, metrics=None):
+    """
+    Returns the preprocessed signature (see 'prepare_image'), made once and cached by content hash and settings. The
+    source image is returned unchanged if the cache cannot be written
+
+    :param image_path:  path of the source image
+    :param width:       printed width of the image in points
+    :param dpi:         print resolution, in pixels per inch
+    :param asset_dir:   folder of the preprocessed images, None for 'get_default_asset_dir'
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :return:            path of the image to embed in the invoices
+    """
+
+    if asset_dir is None:
+        asset_dir = get_default_asset_dir()
+
+    with open(image_path, "rb") as file:
+        digest = hashlib.sha256(file.read())
+    digest.update(f"{ASSET_VERSION} {width} {dpi} {GRAY_LEVELS} {PAPER_WHITE}".encode("utf-8"))
+
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    output_path = os.path.join(asset_dir, f"{name}_{digest.hexdigest()[:16]}.png")
+    if os.path.exists(output_path):
+        return output_path
+
+    try:
+        os.makedirs(asset_dir, exist_ok=True)
+        prepare_image(image_path, output_path + f".{os.getpid()}.tmp", width=width, dpi=dpi)
+        os.replace(output_path + f".{os.getpid()}.tmp", output_path)
+    except (OSError, ValueError) as e:
+        if metrics is None:
+            metrics = instrumentation.RunMetrics()
+        metrics.log("image_unprocessed", f"Image '{image_path}' used as it is: {e}", path=image_path, error=str(e))
+        return image_path
+
+    return output_path
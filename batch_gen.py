@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import argparse
+from itertools import groupby
+
+import invoice_gen
+import instrumentation
+import table_cache
+import table_schema
+
+
+def read_batch_file(path):
+    """
+    Reads a batch job file : a json list of runs (or an object whose 'jobs' key holds that list), each run being an
+    entries dictionary as built by 'widget_gen.get_widget_entries', e.g. :
+
+        [{"property": "COLQUEPATA", "year": "2026", "month": "Octubre",
+          "water": {"initial": "01/09/26", "final": "30/09/26"},
+          "energy": {"initial": "01/09/26", "final": "30/09/26"},
+          "excel": "recibos_octubre.xlsx", "sheet": "CSV", "output": "recibos/2026_octubre_colquepata"}]
+
+    'sheet' (default 'CSV') and 'renderer' (default 'matplotlib') are optional. Relative paths are resolved from the
+    folder of the job file
+
+    :param path:    path of the json job file
+    :return:        list of entries dictionaries
+    """
+
+    with open(path, encoding="utf-8") as file:
+        batch = json.load(file)
+
+    if isinstance(batch, dict):
+        batch = batch.get('jobs')
+    if not isinstance(batch, list):
+        raise ValueError(f"'{path}' must hold a list of jobs")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    runs = []
+    for i, entries in enumerate(batch):
+        missing = {"property", "year", "month", "excel", "output"} - set(entries)
+        if missing:
+            raise ValueError(f"Job {i} of '{path}' misses {sorted(missing)}")
+
+        invoice_gen.get_building_address(entries['property'])
+        if entries['month'] not in invoice_gen.MONTHS:
+            raise ValueError(f"Job {i} of '{path}': unknown month '{entries['month']}'")
+        runs.append({"property": entries['property'],
+                     "year": str(entries['year']),
+                     "month": entries['month'],
+                     "water": dict(entries.get('water', {"initial": "", "final": ""})),
+                     "energy": dict(entries.get('energy', {"initial": "", "final": ""})),
+                     "excel": os.path.join(base_dir, entries['excel']),
+                     "sheet": entries.get('sheet', "CSV"),
+                     "output": os.path.join(base_dir, entries['output']),
+                     "renderer": entries.get('renderer', "matplotlib")
+                     })
+
+    return runs
+
+
+def make_batch_invoices(runs, workers=1, force=False, metrics=None, cache=None, ledger=None):
+    """
+    Generates the invoices of several runs (properties and months) through a single pool of rendering processes. Each
+    Excel file is opened and parsed once, whatever the number of runs reading its sheets
+
+    :param runs:    list of entries dictionaries (see 'read_batch_file')
+    :param workers: number of rendering processes (see 'invoice_gen.get_worker_count')
+    :param force:   if True, every invoice is rendered again (see 'invoice_gen.make_invoice')
+    :param metrics: 'instrumentation.RunMetrics' of the batch (see 'invoice_gen.make_invoice')
+    :param cache:   'table_cache.TableCache' of the normalized sheets (see 'invoice_gen.make_invoice')
+    :param ledger:  'invoice_ledger.InvoiceLedger' of the invoices generated (see 'invoice_gen.make_invoice')
+    :return:        list of tuples (output_filename, error message) of the failed invoices
+    :raise invoice_gen.InputFileError:  if one of the Excel files cannot be read
+    """
+
+    import invoice_manifest
+
+    summarize = metrics is None
+    if summarize:
+        metrics = instrumentation.RunMetrics()
+
+    # Fail fast on the missing files and invalid headers, before any invoice is generated. The schemas are kept for
+    # the loading of the sheets, which does not read the headers again
+    schemas = {}
+    for excel_file in sorted({entries['excel'] for entries in runs}):
+        if not os.path.isfile(excel_file):
+            raise invoice_gen.InputFileError(f"File '{excel_file}' not found.")
+        try:
+            schemas[excel_file] = table_schema.read_sheet_schemas(
+                excel_file=excel_file, sheet_names=sorted({entries['sheet'] for entries in runs
+                                                           if entries['excel'] == excel_file}))
+        except Exception as e:
+            raise invoice_gen.get_input_error(excel_file, e) from e
+
+    def get_excel(entries):
+        return entries['excel']
+
+    def iter_jobs():
+        # Runs reading the same file are consecutive : the records of a file are only kept while its runs are rendered
+        for excel_file, file_runs in groupby(sorted(runs, key=get_excel), key=get_excel):
+            file_runs = list(file_runs)
+            sheet_names = sorted({entries['sheet'] for entries in file_runs})
+            records = invoice_gen.load_workbook_records(excel_file=excel_file, sheet_names=sheet_names,
+                                                        metrics=metrics, cache=cache, schemas=schemas[excel_file])
+            for entries in file_runs:
+                sheet_records = records[entries['sheet']]
+                metrics.log("batch_run", f"{entries['property']} {entries['month']} {entries['year']} "
+                                         f"({len(sheet_records)} tenants) -> '{entries['output']}'",
+                            property=entries['property'], year=entries['year'], month=entries['month'],
+                            excel=excel_file, sheet=entries['sheet'], output_dir=entries['output'],
+                            tenants=len(sheet_records))
+                totals = invoice_gen.write_run_summary(entries, records=sheet_records, metrics=metrics)
+                header = invoice_gen.build_invoice_header(entries, metrics=metrics)
+                yield from invoice_gen.iter_invoice_jobs(entries=entries, records=sheet_records, header=header,
+                                                         totals=totals)
+
+    manifest = invoice_manifest.InvoiceManifest(force=force, metrics=metrics)
+    for entries in runs:
+        invoice_gen.create_folder(entries['output'], metrics=metrics)
+        manifest.add_directory(os.path.dirname(os.path.join(entries['output'], '')),
+                               period=invoice_gen.get_period(entries))
+
+    output_dirs = ", ".join(sorted({entries['output'] for entries in runs}))
+
+    return invoice_gen.run_invoice_jobs(iter_jobs(), output_dir=output_dirs, metrics=metrics, workers=workers,
+                                        manifest=manifest, ledger=ledger, summarize=summarize)
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the arguments of the batch invoice generation
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m batch_gen",
+                                     description="Generación de los recibos de varios inmuebles y meses en una sola "
+                                                 "ejecución")
+    parser.add_argument("jobs", help="archivo json con la lista de ejecuciones (inmueble, año, mes, periodos, "
+                                     "Excel, carpeta)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="número de procesos de generación (0 : todos los núcleos)")
+    parser.add_argument("--force", action="store_true",
+                        help="genera de nuevo todos los recibos, aunque sus datos no hayan cambiado")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="formato de los mensajes : texto o un objeto json por línea")
+    parser.add_argument("--report", default=None,
+                        help="archivo json donde se guarda el resumen (tiempos por etapa, memoria, contadores)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="lee siempre el Excel, sin usar la caché de las hojas ya leídas")
+    parser.add_argument("--ledger", default=None,
+                        help="archivo sqlite del registro de recibos emitidos (por defecto en ~/.local/share)")
+    parser.add_argument("--no-ledger", action="store_true",
+                        help="no registra los recibos generados")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the batch invoice generation, e.g. :
+
+        python -m batch_gen trimestre.json --workers 4
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        exit code : 0 if every invoice was generated, 1 if some failed, 2 if an input file is unreadable
+    """
+
+    args = parse_arguments(argv)
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    metrics = instrumentation.RunMetrics(log_format=args.log_format)
+
+    try:
+        runs = read_batch_file(args.jobs)
+        cache = None if args.no_cache else table_cache.TableCache()
+        ledger = None if args.no_ledger else invoice_gen.get_ledger(args.ledger)
+        failures = make_batch_invoices(runs, workers=args.workers, force=args.force, metrics=metrics, cache=cache,
+                                       ledger=ledger)
+    except (OSError, ValueError, invoice_gen.InputFileError) as e:
+        metrics.log("error", str(e), error=str(e))
+        return 2
+    finally:
+        metrics.report(path=args.report)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import invoice_gen
+import invoice_layout
+
+FIRST_NAMES = ["Juan", "María", "José", "Rosa", "Luis", "Carmen", "Jorge", "Ana", "Pedro", "Lucía"]
+LAST_NAMES = ["Quispe", "Mamani", "Huamán", "Flores", "Rojas", "Sánchez", "García", "Pérez Soto", "Condori Apaza"]
+EXTRA_LABELS = ["Mantenimiento de áreas comunes del edificio", "Multa", "Cable", "Gas",
+                "Reparación de la puerta de ingreso principal", "Limpieza"]
+
+# Column letters of the sheet, as used by the 'usecols' range of 'pd.read_excel'
+COLUMN_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def make_workbook(path, n_tenants, n_pairs, seed=0):
+    """
+    Writes a synthetic Excel file with the 'CSV' sheet expected by 'read_table.get_table_dictionary' : apartment,
+    first and last names, rent, water and energy, followed by 'n_pairs' extra charge label/amount columns, about half
+    of them empty or zero as in real sheets
+
+    :param path:        path of the Excel file
+    :param n_tenants:   number of tenants (rows)
+    :param n_pairs:     number of extra charge label/amount column pairs
+    :param seed:        seed of the random generator, for reproducible files
+    :return:            None
+    """
+
+    import openpyxl
+
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("CSV")
+
+    header = ["DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "AGUA", "LUZ"]
+    for k in range(n_pairs):
+        header += [f"CONCEPTO {k + 1}", f"MONTO {k + 1}"]
+    sheet.append(header)
+
+    for i in range(n_tenants):
+        row = [100 + i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+               rng.choice([650, 700, 800, 950]), round(rng.uniform(15, 60), 3), round(rng.uniform(30, 150), 3)]
+        for k in range(n_pairs):
+            if rng.random() < 0.5:
+                row += [rng.choice(EXTRA_LABELS), rng.choice([0, 10, 15.5, 20, 35.75])]
+            else:
+                row += [None, None]
+        sheet.append(row)
+
+    workbook.save(path)
+
+
+def get_entries(excel_file, output_dir, renderer="matplotlib"):
+    """
+    Builds the entries dictionary of a benchmark run (see 'widget_gen.get_widget_entries')
+
+    :param excel_file:  path of the Excel file
+    :param output_dir:  output directory of the invoices
+    :param renderer:    name of the renderer (see 'invoice_gen.RENDERERS')
+    :return:            dict
+    """
+
+    return {"property": "COLQUEPATA",
+            "year": "2026",
+            "month": "Octubre",
+            "water": {"initial": "01/09/26", "final": "30/09/26"},
+            "energy": {"initial": "01/09/26", "final": "30/09/26"},
+            "excel": excel_file,
+            "output": output_dir,
+            "renderer": renderer}
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls a function and measures its wall-clock time
+
+    :return:    tuple (result of the function, elapsed seconds)
+    """
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def bench_workbook(excel_file, n_tenants, n_pairs, render_sample):
+    """
+    Times separately the stages of the invoice generation on a workbook
+
+    :param excel_file:      path of the synthetic Excel file
+    :param n_tenants:       number of tenants of the file
+    :param n_pairs:         number of extra charge pairs of the file
+    :param render_sample:   number of tenants rendered (rendering is timed per invoice on this sample)
+    :return:                list of result dictionaries (stage, seconds, items)
+    """
+
+    import pandas as pd
+    import read_table
+    import table_schema
+    import invoice_template
+    import pdf_renderer
+
+    results = []
+
+    def add(stage, seconds, items):
+        results.append({"n_tenants": n_tenants, "n_pairs": n_pairs, "stage": stage, "seconds": seconds,
+                        "items": items, "seconds_per_item": seconds / items if items else None})
+
+    usecols = f"A:{COLUMN_LETTERS[6 + 2 * n_pairs - 1]}"
+    df, seconds = timed(pd.read_excel, io=excel_file, usecols=usecols, sheet_name="CSV", engine='openpyxl')
+    add("read_excel", seconds, n_tenants)
+
+    schemas, seconds = timed(table_schema.read_sheet_schemas, excel_file=excel_file, sheet_names=["CSV"])
+    add("read_sheet_schemas", seconds, n_tenants)
+
+    _, seconds = timed(read_table.read_sheets, excel_file=excel_file, schemas=schemas)
+    add("read_sheets", seconds, n_tenants)
+
+    records, seconds = timed(read_table.get_table_dictionary, dataframe=df)
+    add("get_table_dictionary", seconds, n_tenants)
+
+    labels = [label for record in records for label in record.extra_labels]
+    _, seconds = timed(lambda: [invoice_layout.break_string_at_word(text=label, max_length=40) for label in labels])
+    add("break_string_at_word", seconds, len(labels))
+
+    sample = records[:render_sample]
+    header = invoice_gen.build_invoice_header(get_entries(excel_file, output_dir=""))
+    page_layout = invoice_layout.get_page_layout(header)
+
+    tenant_layouts, seconds = timed(lambda: [invoice_layout.get_tenant_layout(header=header, record=record)
+                                             for record in sample])
+    add("tenant_layout", seconds, len(sample))
+
+    template, seconds = timed(invoice_template.InvoiceTemplate, page_layout=page_layout)
+    add("figure_template", seconds, 1)
+
+    construction = 0.0
+    saving = 0.0
+    for tenant_layout in tenant_layouts:
+        tenant = tenant_layout['tenant']
+        start = time.perf_counter()
+        template.first_name.set_text(tenant['first_name'])
+        template.last_name.set_text(tenant['last_name'])
+        template.apartment.set_text(tenant['apartment'])
+        template.set_table(data=tenant_layout['charges']['rows'] + [tenant_layout['total']],
+                           columns=tenant_layout['charges']['columns'])
+        middle = time.perf_counter()
+        template.fig.savefig(io.BytesIO(), format="pdf")
+        construction += middle - start
+        saving += time.perf_counter() - middle
+    template.close()
+    add("figure_construction", construction, len(sample))
+    add("savefig", saving, len(sample))
+
+    pdf_template, seconds = timed(pdf_renderer.InvoiceTemplate, page_layout=page_layout)
+    add("pdf_template", seconds, 1)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        for i, tenant_layout in enumerate(tenant_layouts):
+            pdf_template.render(tenant_layout=tenant_layout, output=os.path.join(output_dir, f"{i}.pdf"))
+        add("pdf_render", time.perf_counter() - start, len(sample))
+
+    return results
+
+
+def bench_memory(excel_file, counts, renderer="matplotlib"):
+    """
+    Measures the memory of long rendering runs : the tenants of the workbook are rendered in a loop (to memory, not
+    to disk) with one page template, up to each count of invoices. Python allocations are traced with 'tracemalloc'
+
+    :param excel_file:  path of the synthetic Excel file
+    :param counts:      numbers of invoices rendered, in increasing order
+    :param renderer:    name of the renderer (see 'invoice_gen.RENDERERS')
+    :return:            list of result dictionaries (invoices, traced peak and retained memory, peak RSS in MB)
+    """
+
+    import gc
+    import importlib
+    import tracemalloc
+    import pandas as pd
+    import read_table
+    import instrumentation
+
+    records = read_table.get_table_dictionary(pd.read_excel(io=excel_file, sheet_name="CSV", engine='openpyxl'))
+    header = invoice_gen.build_invoice_header(get_entries(excel_file, output_dir="", renderer=renderer))
+    tenant_layouts = [invoice_layout.get_tenant_layout(header=header, record=record) for record in records]
+    module = importlib.import_module(invoice_gen.RENDERERS[renderer])
+
+    results = []
+    for count in counts:
+        template = module.InvoiceTemplate(page_layout=invoice_layout.get_page_layout(header))
+        # Warm-up : fonts and first-use caches are not part of the growth
+        template.render(tenant_layout=tenant_layouts[0], output=io.BytesIO())
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(count):
+            template.render(tenant_layout=tenant_layouts[i % len(tenant_layouts)], output=io.BytesIO())
+        # Only the memory still reachable counts as retained, not the garbage waiting for a collection
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        template.close()
+
+        results.append({"renderer": renderer, "invoices": count, "seconds": time.perf_counter() - start,
+                        "traced_peak_mb": peak / 1024 ** 2, "traced_retained_mb": retained / 1024 ** 2,
+                        "peak_rss_mb": instrumentation.get_peak_rss()})
+
+    return results
+
+
+def is_memory_flat(results, tolerance=0.25, slack_mb=1.0):
+    """
+    Checks that the memory of the longest run stays within a tolerance of the memory of the shortest one : both the
+    traced peak and the memory retained once the invoices are rendered (a leak grows with the number of invoices)
+
+    :param results:     results of 'bench_memory'
+    :param tolerance:   allowed relative growth
+    :param slack_mb:    allowed absolute growth in MB
+    :return:            bool
+    """
+
+    first, last = results[0], results[-1]
+
+    return all(last[key] <= first[key] * (1 + tolerance) + slack_mb
+               for key in ("traced_peak_mb", "traced_retained_mb"))
+
+
+def get_git_commit():
+    """
+    :return:    commit hash of the working tree, None outside of a git repository
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, reference):
+    """
+    Prints the time ratio of every stage against a previous benchmark file
+
+    :param results:     benchmark dictionary of this run
+    :param reference:   benchmark dictionary of the reference run
+    :return:            None
+    """
+
+    def key(result):
+        return result["n_tenants"], result["n_pairs"], result["stage"]
+
+    reference_seconds = {key(result): result["seconds"] for result in reference["results"]}
+    print(f"Comparison with commit {reference.get('commit')} :")
+    for result in results["results"]:
+        previous = reference_seconds.get(key(result))
+        if previous:
+            print(f"  {result['stage']:<22} tenants={result['n_tenants']:<6} pairs={result['n_pairs']} "
+                  f"{result['seconds'] / previous:6.2f}x")
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the arguments of the benchmark
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(prog="python benchmark.py",
+                                     description="Benchmark of the reading, normalization and rendering stages")
+    parser.add_argument("--tenants", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="numbers of tenants of the synthetic workbooks")
+    parser.add_argument("--pairs", type=int, nargs="+", default=[0, 1, 2, 3, 4, 5],
+                        help="numbers of extra charge label/amount pairs of the synthetic workbooks")
+    parser.add_argument("--render-sample", type=int, default=20,
+                        help="number of tenants rendered per workbook")
+    parser.add_argument("--workdir", default=None,
+                        help="folder where the synthetic workbooks are kept (temporary folder by default)")
+    parser.add_argument("--output", default="bench_results.json", help="json file of the results")
+    parser.add_argument("--compare", default=None, help="json file of a previous run to compare with")
+    parser.add_argument("--memory", type=int, nargs="+", default=None, metavar="INVOICES",
+                        help="instead of the timings, checks that the memory stays flat when rendering these numbers "
+                             "of invoices (e.g. 100 1000 10000)")
+    parser.add_argument("--renderer", choices=sorted(invoice_gen.RENDERERS), default="matplotlib",
+                        help="renderer of the memory check")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Generates the synthetic workbooks, times every stage and writes the results as json
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        exit code
+    """
+
+    args = parse_arguments(argv)
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="invoice_bench_")
+    os.makedirs(workdir, exist_ok=True)
+
+    if args.memory:
+        excel_file = os.path.join(workdir, "bench_memory.xlsx")
+        if not os.path.exists(excel_file):
+            make_workbook(excel_file, n_tenants=100, n_pairs=3)
+        results = bench_memory(excel_file, counts=sorted(args.memory), renderer=args.renderer)
+        for result in results:
+            print(f"{result['invoices']:>6} invoices  {result['seconds']:8.1f} s  "
+                  f"traced peak {result['traced_peak_mb']:7.2f} MB  retained {result['traced_retained_mb']:7.2f} MB  "
+                  f"peak RSS {result['peak_rss_mb']:7.1f} MB")
+        flat = is_memory_flat(results)
+        print("Memory is flat." if flat else "Memory grows with the number of invoices.")
+        return 0 if flat else 1
+
+    results = {"commit": get_git_commit(),
+               "date": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "render_sample": args.render_sample,
+               "results": []}
+
+    for n_tenants in args.tenants:
+        for n_pairs in args.pairs:
+            excel_file = os.path.join(workdir, f"bench_{n_tenants}_{n_pairs}.xlsx")
+            if not os.path.exists(excel_file):
+                make_workbook(excel_file, n_tenants=n_tenants, n_pairs=n_pairs)
+            for result in bench_workbook(excel_file, n_tenants=n_tenants, n_pairs=n_pairs,
+                                         render_sample=args.render_sample):
+                results["results"].append(result)
+                print(f"{result['stage']:<22} tenants={n_tenants:<6} pairs={n_pairs} {result['seconds']:9.4f} s")
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=1)
+    print(f"Results written to '{args.output}'.")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            compare_results(results, json.load(file))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
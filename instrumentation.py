@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import time
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def get_peak_rss():
+    """
+    :return:    peak resident memory of the current process in MB, None where it is not available
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class RunMetrics:
+    """
+    Instrumentation of an invoice run : wall-clock time per stage (load, normalize, layout, save, ...), peak memory,
+    counters (rendered, skipped, failed) and events logged as text or as one json object per line
+    """
+
+    def __init__(self, log_format="text", stream=None):
+        """
+        :param log_format:  'text' for human readable lines, 'json' for one json object per line
+        :param stream:      where events are written, defaults to the standard output
+        """
+
+        self.log_format = log_format
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {"rendered": 0, "skipped": 0, "failed": 0}
+
+    def log(self, event, message="", **fields):
+        """
+        Writes an event
+
+        :param event:       name of the event
+        :param message:     human readable message (text format)
+        :param fields:      values of the event (json format)
+        :return:            None
+        """
+
+        stream = self.stream or sys.stdout
+        if self.log_format == "json":
+            record = {"time": datetime.now().isoformat(timespec="milliseconds"), "event": event}
+            record.update(fields)
+            print(json.dumps(record, ensure_ascii=False, default=str), file=stream, flush=True)
+        elif message:
+            print(message, file=stream)
+
+    def add_time(self, stage, seconds, calls=1):
+        """
+        Adds wall-clock time to a stage
+
+        :param stage:       name of the stage
+        :param seconds:     elapsed time
+        :param calls:       number of calls measured
+        :return:            None
+        """
+
+        entry = self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+        entry["seconds"] += seconds
+        entry["calls"] += calls
+
+    def add_timings(self, timings):
+        """
+        Adds the stage timings measured while rendering an invoice (possibly in another process)
+
+        :param timings:     dictionary stage -> seconds
+        :return:            None
+        """
+
+        for stage, seconds in timings.items():
+            self.add_time(stage, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the wall-clock time and the peak memory of a block
+
+        :param name:    name of the stage
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time(name, seconds)
+            self.stages[name]["peak_rss_mb"] = get_peak_rss()
+            self.log("stage", f"Stage '{name}' done in {seconds:.3f} s.", stage=name, seconds=seconds,
+                     peak_rss_mb=self.stages[name]["peak_rss_mb"])
+
+    def timed_iter(self, name, iterable):
+        """
+        Measures the time spent producing the items of a lazy iterable (e.g. a streaming reader)
+
+        :param name:        name of the stage
+        :param iterable:    iterable to measure
+        :return:            generator of the same items
+        """
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start, calls=0)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, counter, n=1):
+        """
+        Increments a counter
+
+        :param counter:     name of the counter ('rendered', 'skipped', 'failed', ...)
+        :param n:           increment
+        :return:            None
+        """
+
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def summary(self):
+        """
+        :return:    dictionary with the total time, the peak memory, the stages and the counters of the run
+        """
+
+        return {"seconds": time.perf_counter() - self.start,
+                "peak_rss_mb": get_peak_rss(),
+                "stages": self.stages,
+                "counters": self.counters}
+
+    def report(self, path=None):
+        """
+        Logs the summary of the run, and writes it as json if a path is given
+
+        :param path:    path of the json report, None for no file
+        :return:        summary dictionary (see 'summary')
+        """
+
+        summary = self.summary()
+        lines = [f"Run done in {summary['seconds']:.3f} s : {self.counters['rendered']} rendered, "
+                 f"{self.counters['skipped']} skipped, {self.counters['failed']} failed."]
+        for stage, entry in self.stages.items():
+            lines.append(f"  {stage:<12} {entry['seconds']:9.3f} s  ({entry['calls']} calls)")
+        self.log("summary", "\n".join(lines), **summary)
+
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(summary, file, indent=1)
+
+        return summary
+
+
+@contextmanager
+def profile(path=None):
+    """
+    Captures a cProfile profile of a block (the current process only, not the rendering workers)
+
+    :param path:    path of the profile statistics file (readable with 'pstats'), None to disable profiling
+    """
+
+    if path is None:
+        yield
+        return
+
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(20)
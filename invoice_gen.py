@@ -1,201 +1,1109 @@
 #!/usr/bin/env python
 
 import os
-
-import read_table
-import numpy as np
-import pandas as pd
+import sys
+import json
+import time
+import argparse
+import importlib
+import io
+import itertools
 from datetime import datetime
-import matplotlib.pyplot as plt
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+from contextlib import contextmanager
+
+import assets
+import invoice_layout
+import instrumentation
+import table_cache
+import table_schema
+
+# pandas, numpy and matplotlib (through 'read_table' and 'invoice_template') are imported inside the functions that
+# need them, so that the command line starts fast and the widget only pays for them when invoices are generated
+
+
+def load_property_registry(path=None):
+    """
+    Reads the registry of the properties : name -> dictionary with the street 'address' printed on the invoices
+
+    :param path:    path of the json registry, defaults to 'properties.json' next to this script
+    :return:        dict
+    """
+
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'properties.json')
+
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+PROPERTY_REGISTRY = load_property_registry()
+PROPERTIES = list(PROPERTY_REGISTRY)
+MONTHS = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+          "Julio", "Agosto", "Setiembre", "Octubre", "Noviembre", "Diciembre"]
+
+# Renderer name -> module providing the page template class 'InvoiceTemplate' and 'open_document'
+RENDERERS = {"matplotlib": "invoice_template",
+             "pdf": "pdf_renderer"}
+
+# Range of the columns read from the sheets (see 'table_schema.MAX_COLUMNS'). No sheet is read with it : it is only
+# an input of the key of the cached tables (see 'table_cache.TableCache.get_entry_path'), so that the tables cached
+# from a narrower range are not reused
+CACHE_KEY_COLUMNS = f"A:{table_schema.get_column_letter(table_schema.MAX_COLUMNS - 1)}"
+
+
+class InputFileError(Exception):
+    """
+    The Excel file of a run cannot be read : the run stops before any invoice is generated
+    """
+
+
+def get_input_error(excel_file, error):
+    """
+    :param excel_file:  path to the Excel file
+    :param error:       exception raised while reading it
+    :return:            'InputFileError' to raise, with the precise message of a 'table_schema.SchemaError'
+    """
+
+    if isinstance(error, table_schema.SchemaError):
+        return InputFileError(f"File '{excel_file}': {error}")
+
+    return InputFileError(f"File '{excel_file}' could not be read: {type(error).__name__}: {error}")
 
 
-def create_folder(path):
+def create_folder(path, metrics=None):
     """
     Create a directory is path does not exist
 
     :param path:    path to the directory set for creation
+    :param metrics: 'instrumentation.RunMetrics' of the run, a new one if None
     :return:        None
     """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
     try:
         os.makedirs(path)
-        print(f"Folder '{path}' created successfully.")
+        metrics.log("folder_created", f"Folder '{path}' created successfully.", path=path)
     except FileExistsError:
-        print(f"Folder '{path}' already exists.")
+        metrics.log("folder_exists", f"Folder '{path}' already exists.", path=path)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        metrics.log("folder_error", f"An error occurred: {e}", path=path, error=str(e))
 
 
-def break_string_at_word(text, max_length):
-    lines = []
-    current_line = ""
+def get_building_address(building):
+    """
+    Returns the street address printed in the 'Lugar de arrendamiento' block for a given property
 
-    words = text.split()
+    :param building:    property name as selected in the widget (e.g. 'COLQUEPATA'), see 'PROPERTY_REGISTRY'
+    :return:            street address of the property
+    """
+
+    try:
+        return PROPERTY_REGISTRY[building]['address']
+    except KeyError:
+        raise ValueError(f"Unknown property '{building}', expected one of {PROPERTIES}") from None
 
-    for word in words:
-        if len(current_line) + len(word) + 1 <= max_length:
-            current_line += word + " "
-        else:
-            lines.append(current_line.strip())
-            current_line = word + " "
 
-    # Add the last line
-    lines.append(current_line.strip())
+def get_output_filename(invoice_year, invoice_month, record):
+    """
+    Builds the deterministic pdf file name of a tenant invoice
+
+    :param invoice_year:    invoice year
+    :param invoice_month:   invoice month (in Spanish)
+    :param record:          'read_table.TenantRecord' of the tenant
+    :return:                pdf file name
+    """
 
-    return "\n".join(lines)
+    last_name = record.last_name.replace(' ', '_').lower()
 
+    return f"{invoice_year}_{invoice_month.lower()}_depa_{record.apartment}_{last_name}.pdf"
 
-def make_invoice(entries):
+
+def build_invoice_header(entries, metrics=None):
     """
+    Builds the part of the invoice jobs shared by every tenant of a run
 
-    :param entries: 
-    :return: 
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :return:            header dictionary
     """
 
     # Get the absolute path to the script's directory
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    # Specify the absolute path to the image file
-    image_path = os.path.join(script_dir, 'figures', 'firma.png')
-    print("Current Working Directory:", os.getcwd())
 
-    building = entries['property']
+    # The signature is resampled and compacted once, then cached (see 'assets.get_signature_image')
+    signature_dpi = entries.get('signature_dpi', assets.SIGNATURE_DPI)
+    image_path = assets.get_signature_image(os.path.join(script_dir, 'figures', 'firma.png'),
+                                            width=invoice_layout.SIGNATURE_WIDTH, dpi=signature_dpi, metrics=metrics)
+
+    header = {'image_path': image_path,
+              'signature_dpi': signature_dpi,
+              'property': entries['property'],
+              'building_address': get_building_address(entries['property']),
+              'year': entries['year'],
+              'month': entries['month'],
+              'water': dict(entries['water']),
+              'energy': dict(entries['energy']),
+              'issue_date': datetime.today().date().strftime("%d/%m/%Y"),
+              'renderer': entries.get('renderer', 'matplotlib')
+              }
+
+    return header
+
+
+def iter_invoice_jobs(entries, records, header=None, totals=None, in_memory=False):
+    """
+    Builds lazily one self-contained, picklable job per tenant so invoices can be rendered in any process
+
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param records:     iterable of 'read_table.TenantRecord'
+    :param header:      job header shared by the tenants, built from 'entries' if not given
+    :param totals:      totals of the tenants in the order of 'records' (see 'write_run_summary'), None to compute
+                        them at rendering time
+    :param in_memory:   if True, the invoices are rendered in memory (see 'render_invoice') instead of being saved to
+                        their 'output_path'
+    :return:            generator of job dictionaries, in the same order as 'records'
+    """
+
+    if header is None:
+        header = build_invoice_header(entries)
+
+    for i, record in enumerate(records):
+        output_filename = get_output_filename(entries['year'], entries['month'], record)
+        yield {'header': header,
+               'client': record,
+               'output_filename': output_filename,
+               'output_path': os.path.join(entries['output'], output_filename),
+               'total': None if totals is None else totals[i],
+               'in_memory': in_memory
+               }
+
+
+# Page template of the current process, rebuilt only when the job header changes
+_template = None
+_template_key = None
+
+# Number of open 'keep_template' sessions : while there is one, the template outlives the runs
+_template_sessions = 0
+
+
+def get_template(header):
+    """
+    Returns the invoice page template of the current process for a job header, building it on first use
+
+    :param header:  job header as built by 'build_invoice_header'
+    :return:        'InvoiceTemplate' instance of the renderer of the header (see 'RENDERERS')
+    """
+
+    global _template, _template_key
+
+    key = json.dumps(header, sort_keys=True)
+    if _template is None or key != _template_key:
+        renderer = importlib.import_module(RENDERERS[header['renderer']])
+
+        close_template()
+        _template = renderer.InvoiceTemplate(page_layout=invoice_layout.get_page_layout(header))
+        _template_key = key
+
+    return _template
+
+
+def close_template():
+    """
+    Releases the invoice page template of the current process, if any
+
+    :return:    None
+    """
+
+    global _template, _template_key
+
+    if _template is not None:
+        _template.close()
+    _template = None
+    _template_key = None
+
+
+def release_template():
+    """
+    Releases the page template of the current process at the end of a run, unless a 'keep_template' session keeps
+    it for the next runs
+
+    :return:    None
+    """
+
+    if not _template_sessions:
+        close_template()
+
+
+@contextmanager
+def keep_template():
+    """
+    Keeps the page template of the current process alive across runs (e.g. the updates of
+    'invoice_watch.watch_invoices'), it is released when the session ends
+
+    :return:    context manager
+    """
+
+    global _template_sessions
+
+    _template_sessions += 1
+    try:
+        yield
+    finally:
+        _template_sessions -= 1
+        release_template()
+
+
+def init_worker():
+    """
+    Initializes a rendering process : invoices are only saved to pdf, so no interactive backend is needed. matplotlib
+    is not imported yet and only will be if the matplotlib renderer is used
+
+    :return:    None
+    """
+
+    os.environ['MPLBACKEND'] = 'Agg'
+
+
+def render_invoice(job, output=None):
+    """
+    Renders a single tenant invoice and saves it as pdf. Errors are returned instead of raised, so that a failing
+    tenant does not stop the rest of the batch
+
+    :param job:     job dictionary as built by 'iter_invoice_jobs'
+    :param output:  where the page is saved : defaults to the pdf file of the job (or to memory if the job is
+                    'in_memory'), a document opened with the 'open_document' function of the renderer appends it as
+                    a new page of a multi-page pdf
+    :return:        tuple (output_filename, error message or None, dictionary stage -> seconds of the 'layout' and
+                    'save' stages, content of the pdf if rendered in memory else None)
+    """
+
+    header = job['header']
+    timings = {}
+
+    buffer = None
+    if output is None:
+        buffer = io.BytesIO() if job.get('in_memory') else None
+        output = job['output_path'] if buffer is None else buffer
+
+    try:
+        start = time.perf_counter()
+        tenant_layout = invoice_layout.get_tenant_layout(header=header, record=job['client'], total=job.get('total'))
+        timings['layout'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        get_template(header).render(tenant_layout=tenant_layout, output=output)
+        timings['save'] = time.perf_counter() - start
+
+    except Exception as e:
+        return job['output_filename'], f"{type(e).__name__}: {e}", timings, None
+
+    return job['output_filename'], None, timings, None if buffer is None else buffer.getvalue()
+
+
+def get_single_pdf_filename(entries):
+    """
+    Builds the file name of the multi-page pdf holding the invoices of a whole run
+
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :return:            pdf file name
+    """
+
+    return f"{entries['year']}_{entries['month'].lower()}_{entries['property'].lower()}.pdf"
+
+
+def iter_single_pdf_invoices(jobs, pdf_path, index_path=None, renderer='matplotlib', metrics=None):
+    """
+    Renders every invoice job as a page of a single pdf file, optionally writing a csv page index next to it
+
+    :param jobs:        iterable of job dictionaries (see 'iter_invoice_jobs')
+    :param pdf_path:    path of the multi-page pdf
+    :param index_path:  path of the csv index (page, apartment, first name, last name), None for no index
+    :param renderer:    name of the renderer of the jobs (see 'RENDERERS')
+    :param metrics:     'instrumentation.RunMetrics' receiving the layout and save timings, None for no timings
+    :return:            generator of tuples (output_filename, error message or None)
+    """
+
+    import csv
+
+    index = []
+    try:
+        with importlib.import_module(RENDERERS[renderer]).open_document(pdf_path) as pdf_pages:
+            for job in jobs:
+                output_filename, error, timings, data = render_invoice(job, output=pdf_pages)
+                if metrics is not None:
+                    metrics.add_timings(timings)
+                if error is None:
+                    record = job['client']
+                    index.append((pdf_pages.get_pagecount(), record.apartment, record.first_name, record.last_name))
+                yield output_filename, error
+    finally:
+        release_template()
+
+    if index_path is not None:
+        with open(index_path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["pagina", "departamento", "nombre", "apellido"])
+            writer.writerows(index)
+
+
+def get_worker_count(workers):
+    """
+    Resolves the number of rendering processes
+
+    :param workers: requested number of processes, 0 or None for all the CPU cores
+    :return:        number of processes, at least 1
+    """
+
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    return max(1, workers)
+
+
+def iter_rendered_invoices(jobs, workers=1, metrics=None, sink=None, checks=None, size_budget=None):
+    """
+    Renders invoice jobs as they come and yields their results in the same order. With a process pool, at most a few
+    jobs per worker are in flight, so a lazy 'jobs' iterable is never materialized
+
+    :param jobs:        iterable of job dictionaries (see 'iter_invoice_jobs')
+    :param workers:     number of rendering processes (see 'get_worker_count')
+    :param metrics:     'instrumentation.RunMetrics' receiving the layout and save timings, measured in the process
+                        that rendered the invoice. None for no timings
+    :param sink:        sink receiving the invoices rendered in memory (see 'invoice_sink'), in the order of the jobs
+    :param checks:      list to which the size checks of the invoices rendered in memory are appended (see
+                        'get_size_checks'), None for no checks
+    :param size_budget: maximum size of an invoice in bytes for the 'checks' (see 'report_sizes')
+    :return:            generator of tuples (output_filename, error message or None)
+    """
+
+    import pdf_check
+
+    for output_filename, error, timings, data in iter_rendered_results(jobs=jobs, workers=get_worker_count(workers)):
+        if metrics is not None:
+            metrics.add_timings(timings)
+        if data is not None:
+            start = time.perf_counter()
+            sink.add(output_filename, data)
+            if metrics is not None:
+                metrics.add_time("write", time.perf_counter() - start)
+            if checks is not None:
+                checks.append((output_filename, pdf_check.check_pdf(output_filename, budget=size_budget, data=data)))
+        yield output_filename, error
+
+
+def iter_rendered_results(jobs, workers):
+    """
+    Renders invoice jobs in the current process or in a process pool (see 'iter_rendered_invoices'). If a worker
+    dies, the jobs in flight are reported as failed and the rest of the batch is rendered by a new pool
+
+    :param jobs:    iterable of job dictionaries (see 'iter_invoice_jobs')
+    :param workers: number of rendering processes
+    :return:        generator of the 'render_invoice' results, in the same order as the jobs
+    """
+
+    if workers == 1:
+        try:
+            for job in jobs:
+                yield render_invoice(job)
+        finally:
+            release_template()
+        return
+
+    import multiprocessing
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    def get_result(output_filename, future):
+        # A worker that died (e.g. killed for lack of memory) breaks the pool : every job in flight fails with it
+        try:
+            return future.result(), False
+        except BrokenProcessPool as e:
+            return (output_filename, f"{type(e).__name__}: {e}", {}, None), True
+
+    # The jobs in flight when a worker dies are reported as failed, the next ones go to a new pool
+    jobs = iter(jobs)
+    broken = True
+    while broken:
+        broken = False
+        # 'spawn' gives fresh interpreters : the workers do not inherit the Tk state of the widget
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker) as executor:
+            in_flight = deque()
+            for job in jobs:
+                try:
+                    in_flight.append((job['output_filename'], executor.submit(render_invoice, job)))
+                except BrokenProcessPool:
+                    jobs = itertools.chain([job], jobs)
+                    broken = True
+                    break
+                if len(in_flight) >= 4 * workers:
+                    result, broken = get_result(*in_flight.popleft())
+                    yield result
+                    if broken:
+                        break
+            while in_flight:
+                result, failed = get_result(*in_flight.popleft())
+                broken = broken or failed
+                yield result
+
+
+def report_results(results, output_dir, metrics=None):
+    """
+    Logs the invoices that could not be generated and a summary of the run
+
+    :param results:     iterable of tuples (output_filename, error message or None)
+    :param output_dir:  output directory of the run
+    :param metrics:     'instrumentation.RunMetrics' counting the rendered and failed invoices, a new one if None
+    :return:            list of tuples (output_filename, error message) of the failed invoices
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    n_results = 0
+    failures = []
+    for output_filename, error in results:
+        n_results += 1
+        if error is not None:
+            metrics.count("failed")
+            metrics.log("invoice_failed", f"Invoice '{output_filename}' could not be generated: {error}",
+                        output_filename=output_filename, error=error)
+            failures.append((output_filename, error))
+        else:
+            metrics.count("rendered")
+            metrics.log("invoice_rendered", output_filename=output_filename)
+
+    metrics.log("results", f"{n_results - len(failures)} of {n_results} invoices generated in '{output_dir}'.",
+                output_dir=output_dir, generated=n_results - len(failures), total=n_results)
+
+    return failures
+
+
+def load_records(excel_file, stream=False, metrics=None, cache=None):
+    """
+    Reads and normalizes the tenants of the 'CSV' sheet of the Excel file, timing the 'load' and 'normalize' stages
+
+    :param excel_file:  path to the Excel file
+    :param stream:      if True, the sheet is read lazily row by row (see 'read_table.iter_workbook_records') : the
+                        'load' stage then covers both reading and normalizing, and is measured as the records come
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :param cache:       'table_cache.TableCache' of the normalized sheets, None to always parse the Excel file. Not
+                        used in 'stream' mode
+    :return:            list (or generator if 'stream') of 'read_table.TenantRecord'
+    :raise InputFileError:  if the file cannot be read
+    """
+
+    import read_table
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    if not stream:
+        return load_workbook_records(excel_file=excel_file, sheet_names=["CSV"], metrics=metrics, cache=cache)["CSV"]
+
+    # Fail fast : a missing file stops the run before anything is written
+    if not os.path.isfile(excel_file):
+        raise InputFileError(f"File '{excel_file}' not found.")
+
+    def iter_records():
+        try:
+            for sheet_name, record in read_table.iter_workbook_records(excel_file=excel_file):
+                yield record
+        except Exception as e:
+            raise get_input_error(excel_file, e) from e
+
+    # The first record is read right away, so that an unreadable file stops the run before anything is written
+    records = metrics.timed_iter("load", iter_records())
+    first = next(records, None)
+
+    return iter(()) if first is None else itertools.chain([first], records)
+
+
+def load_workbook_records(excel_file, sheet_names, metrics=None, cache=None, schemas=None):
+    """
+    Reads and normalizes the tenants of several sheets of an Excel file, opening it once, and times the 'load' and
+    'normalize' stages
+
+    :param excel_file:  path to the Excel file
+    :param sheet_names: names of the sheets to read
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :param cache:       'table_cache.TableCache' holding the normalized sheets of the files already read, None to
+                        always parse the Excel file
+    :param schemas:     dictionary sheet name -> 'table_schema.SheetSchema' of the sheets, if the caller already read
+                        them (see 'table_schema.read_sheet_schemas'). None to read the headers here
+    :return:            dictionary sheet name -> list of 'read_table.TenantRecord'
+    :raise InputFileError:  if the file or one of the sheets cannot be read
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    # Fail fast : a missing file stops the run before anything is written
+    if not os.path.isfile(excel_file):
+        raise InputFileError(f"File '{excel_file}' not found.")
+
+    sheet_names = list(sheet_names)
+    if cache is not None:
+        with metrics.stage("cache"):
+            records = cache.load(excel_file=excel_file, sheet_names=sheet_names, usecols=CACHE_KEY_COLUMNS,
+                                 metrics=metrics)
+        if records is not None:
+            metrics.log("cache_hit", f"Tenants of '{excel_file}' read from the cache.", excel=excel_file)
+            return records
+
+    # Only the header rows are read first : a file with missing or unpaired columns is rejected before its data is
+    # parsed (and before pandas is even imported)
+    if schemas is None:
+        with metrics.stage("schema"):
+            try:
+                schemas = table_schema.read_sheet_schemas(excel_file=excel_file, sheet_names=sheet_names)
+            except Exception as e:
+                raise get_input_error(excel_file, e) from e
+
+    import read_table
+
+    with metrics.stage("load"):
+        try:
+            dataframes = read_table.read_sheets(excel_file=excel_file, schemas=schemas)
+        except Exception as e:
+            raise get_input_error(excel_file, e) from e
+
+    with metrics.stage("normalize"):
+        records = {sheet_name: read_table.get_table_dictionary(dataframe=df, schema=schemas[sheet_name])
+                   for sheet_name, df in dataframes.items()}
+
+    if cache is not None:
+        with metrics.stage("cache"):
+            cache.store(excel_file=excel_file, sheet_names=sheet_names, usecols=CACHE_KEY_COLUMNS, records=records,
+                        metrics=metrics)
+
+    return records
+
+
+def get_size_checks(paths, size_budget=None):
+    """
+    :param paths:       paths of the generated pdf files
+    :param size_budget: maximum size of an invoice (a page) in bytes, None for no budget
+    :return:            generator of tuples (file name, 'pdf_check.check_pdf' result)
+    """
+
+    import pdf_check
+
+    for path in paths:
+        yield os.path.basename(path), pdf_check.check_pdf(path, budget=size_budget)
+
+
+def report_sizes(checks, metrics=None):
+    """
+    Logs the average size of the generated pdf files, and the files over the size budget or with fonts not subset
+
+    :param checks:      iterable of tuples (file name, 'pdf_check.check_pdf' result), see 'get_size_checks'
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :return:            number of files with a problem
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    n_bytes = 0
+    n_pages = 0
+    n_problems = 0
+    for filename, check in checks:
+        n_bytes += check['size']
+        n_pages += check['pages']
+        for problem in check['problems']:
+            metrics.log("size_warning", f"Invoice '{filename}': {problem}.", output_filename=filename, problem=problem)
+        n_problems += bool(check['problems'])
+
+    if n_pages:
+        metrics.count("bytes", n_bytes)
+        metrics.count("size_warnings", n_problems)
+        metrics.log("sizes", f"Average invoice size: {n_bytes / n_pages / 1024:.1f} KB.",
+                    average_bytes=n_bytes / n_pages, pages=n_pages, files_with_problems=n_problems)
+
+    return n_problems
+
+
+def iter_until_cancelled(jobs, cancel=None):
+    """
+    Stops a job stream as soon as a cancellation is requested : the jobs already started are not interrupted
+
+    :param jobs:    iterable of job dictionaries (see 'iter_invoice_jobs')
+    :param cancel:  'threading.Event' set to cancel the run, None if the run cannot be cancelled
+    :return:        generator of the jobs given before the cancellation
+    """
+
+    for job in jobs:
+        if cancel is not None and cancel.is_set():
+            return
+        yield job
+
+
+def get_period(entries):
+    """
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :return:            tuple (property, year, month) of the run (see 'invoice_manifest.get_job_period')
+    """
+
+    return entries['property'], entries['year'], entries['month']
+
+
+def get_summary_filename(entries):
+    """
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :return:            file name of the csv summary of the building
+    """
+
+    return f"{entries['year']}_{entries['month'].lower()}_{entries['property'].lower()}_resumen.csv"
+
+
+def write_run_summary(entries, records, metrics, sink=None):
+    """
+    Computes the totals of the tenants and of the building, timed as the 'summary' stage, and writes the summary of
+    the building next to the invoices (see 'invoice_summary.write_summary')
+
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param records:     list of 'read_table.TenantRecord'
+    :param metrics:     'instrumentation.RunMetrics' of the run
+    :param sink:        sink of the invoices (see 'invoice_sink') the summary is added to, None to write it in the
+                        output folder
+    :return:            list of the totals of the tenants, in the order of 'records'
+    """
+
+    import invoice_summary
+
+    with metrics.stage("summary"):
+        summary = invoice_summary.get_summary(records)
+        if sink is None:
+            path = os.path.join(entries['output'], get_summary_filename(entries))
+            invoice_summary.write_summary(path, records=records, summary=summary)
+        else:
+            path = f"{sink.name}:{get_summary_filename(entries)}"
+            with io.StringIO(newline="") as file:
+                invoice_summary.write_summary(file, records=records, summary=summary)
+                sink.add(get_summary_filename(entries), file.getvalue().encode("utf-8"))
+
+    building = {column: cents / invoice_summary.CENTS for column, cents in summary['building'].items()}
+    metrics.log("building_summary", f"{entries['property']} {entries['month']} {entries['year']} : "
+                           f"S/. {invoice_summary.format_cents(summary['building']['total'])} billed to "
+                           f"{summary['n_tenants']} tenants, summary in '{path}'.",
+                property=entries['property'], path=path, tenants=summary['n_tenants'],
+                extra_charges=summary['n_extra_charges'], empty_amounts=summary['n_empty_amounts'], **building)
+
+    return (summary['tenants']['total'] / invoice_summary.CENTS).tolist()
+
+
+def save_ledger(ledger, complete, metrics):
+    """
+    Writes the last invoices of a run to the ledger and removes the tenants gone, timed as the 'ledger' stage
+
+    :param ledger:      'invoice_ledger.InvoiceLedger' that recorded the results of the run
+    :param complete:    False if the run was cancelled (see 'invoice_ledger.InvoiceLedger.save')
+    :param metrics:     'instrumentation.RunMetrics' of the run
+    :return:            None
+    """
+
+    with metrics.stage("ledger"):
+        n_invoices = ledger.save(complete=complete)
+    metrics.log("ledger", f"{n_invoices} invoices recorded in '{ledger.path}'.", invoices=n_invoices,
+                ledger=ledger.path)
+
+
+def run_invoice_jobs(jobs, output_dir, metrics, workers=1, manifest=None, sink=None, pdf_path=None, index_path=None,
+                     renderer='matplotlib', ledger=None, cancel=None, size_budget=None, summarize=False):
+    """
+    Renders the invoice jobs of a run and finishes it, whatever its output : the invoices are rendered (the 'render'
+    stage) and their sizes reported, then the manifest is saved, the invoices are recorded in the ledger and the sink
+    is closed. The caller aborts the sink if anything raises before. Only the invoices actually rendered are recorded
+    in the ledger : the rows of the unchanged (skipped) and failed invoices are kept as they were
+
+    :param jobs:        iterable of job dictionaries (see 'iter_invoice_jobs')
+    :param output_dir:  output directory of the invoices. The invoices of a run with a manifest may go to several
+                        directories (e.g. 'batch_gen'), which are then joined by ', ' for the messages
+    :param metrics:     'instrumentation.RunMetrics' of the run
+    :param workers:     number of rendering processes (see 'get_worker_count')
+    :param manifest:    'invoice_manifest.InvoiceManifest' skipping the unchanged invoices, None to render them all
+    :param sink:        sink of the invoices rendered in memory (see 'invoice_sink'), None to save them to files
+    :param pdf_path:    path of the multi-page pdf of a single pdf run (see 'iter_single_pdf_invoices'), else None
+    :param index_path:  path of the page index of a single pdf run, None for no index
+    :param renderer:    name of the renderer of a single pdf run (see 'RENDERERS')
+    :param ledger:      'invoice_ledger.InvoiceLedger' recording the invoices rendered, None for no record
+    :param cancel:      'threading.Event' of the run (see 'make_invoice'), None if the run cannot be cancelled
+    :param size_budget: maximum size of an invoice in bytes (see 'report_sizes')
+    :param summarize:   if True, the summary of the metrics is logged at the end
+    :return:            list of tuples (output_filename, error message) for the invoices that could not be generated
+    """
+
+    checks = []
+    if ledger is not None:
+        jobs = ledger.list_jobs(jobs)
+    if pdf_path is not None:
+        if ledger is not None:
+            jobs = ledger.record_jobs(jobs, path=pdf_path)
+        results = iter_single_pdf_invoices(jobs=jobs, pdf_path=pdf_path, index_path=index_path, renderer=renderer,
+                                           metrics=metrics)
+    else:
+        if manifest is not None:
+            jobs = manifest.filter_jobs(jobs)
+        if ledger is not None:
+            jobs = ledger.record_jobs(jobs, path=None if sink is None else sink.name)
+        results = iter_rendered_invoices(jobs=jobs, workers=workers, metrics=metrics, sink=sink, checks=checks,
+                                         size_budget=size_budget)
+        if manifest is not None:
+            results = manifest.record_results(results)
+    if ledger is not None:
+        results = ledger.record_results(results)
+
+    if pdf_path is not None:
+        destination = pdf_path
+    else:
+        destination = output_dir if sink is None else sink.name
+    with metrics.stage("render"):
+        failures = report_results(results=results, output_dir=destination, metrics=metrics)
+
+    if pdf_path is not None:
+        checks = get_size_checks([pdf_path] if os.path.exists(pdf_path) else [], size_budget=size_budget)
+    elif manifest is not None:
+        checks = get_size_checks(manifest.rendered, size_budget=size_budget)
+    report_sizes(checks, metrics=metrics)
+
+    if manifest is not None:
+        metrics.count("skipped", manifest.n_skipped)
+        metrics.log("skipped", f"{manifest.n_skipped} unchanged invoices skipped.", skipped=manifest.n_skipped)
+
+    cancelled = cancel is not None and cancel.is_set()
+    if cancelled:
+        if sink is not None:
+            metrics.log("cancelled", "Run cancelled : the archive only holds the invoices generated so far.")
+        elif manifest is not None:
+            metrics.log("cancelled", "Run cancelled : the invoices not generated yet are kept as they were.")
+        else:
+            metrics.log("cancelled", "Run cancelled.")
+
+    if manifest is not None:
+        manifest.save(complete=not cancelled)
+    if ledger is not None:
+        save_ledger(ledger, complete=not cancelled, metrics=metrics)
+
+    if sink is not None:
+        with metrics.stage("write"):
+            sink.close()
+        if os.path.isfile(sink.name):
+            metrics.log("archive", f"Archive '{sink.name}' written ({os.path.getsize(sink.name) / 1024:.1f} KB).",
+                        path=sink.name, bytes=os.path.getsize(sink.name))
+
+    if summarize:
+        metrics.report()
+
+    return failures
+
+
+def make_invoice(entries, workers=1, stream=False, force=False, single_pdf=False, page_index=False, metrics=None,
+                 cache=None, cancel=None, size_budget=None, ledger=None, sink=None, records=None):
+    """
+    Generates one pdf invoice per tenant listed in the Excel file, and the csv summary of the building
+
+    :param entries: dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param workers: number of rendering processes. With 1 (default) invoices are rendered one after another in the
+                    current process, 0 or None uses all the CPU cores
+    :param stream:  if True, the sheet is read row by row ('read_table.iter_workbook_records') and each tenant is
+                    rendered as soon as it is read, with a memory use independent of the size of the sheet. The
+                    summary of the building (see 'write_run_summary') is then not written
+    :param force:   if True, every invoice is rendered again, even those whose inputs did not change since the last
+                    run (see 'invoice_manifest.InvoiceManifest')
+    :param single_pdf:  if True, the whole run is written as the pages of a single pdf (see
+                        'get_single_pdf_filename') rendered in the current process, instead of one file per tenant
+    :param page_index:  with 'single_pdf', also writes a csv index tenant -> page number next to the pdf
+    :param metrics: 'instrumentation.RunMetrics' collecting the stage timings and counters of the run. If None, a new
+                    one is used and its summary is printed at the end of the run
+    :param cache:   'table_cache.TableCache' of the normalized sheets, so that a run on an unchanged Excel file skips
+                    its parsing. None to always parse the file
+    :param cancel:  'threading.Event' stopping the run between two invoices when set (e.g. from the widget), the
+                    invoices being rendered are finished. None if the run cannot be cancelled
+    :param size_budget: maximum size of an invoice in bytes : larger invoices and fonts embedded without subsetting
+                        are reported (see 'report_sizes'). The average size is reported in any case
+    :param ledger:  'invoice_ledger.InvoiceLedger' where the invoices generated are recorded, None for no record
+    :param sink:    where the invoices and the summary go if not in the output folder, e.g. an
+                    'invoice_sink.ArchiveSink' : invoices are then rendered in memory and all of them are generated
+                    again ('force'). Not compatible with 'single_pdf'
+    :param records: list of 'read_table.TenantRecord' already read from the Excel file (e.g. by
+                    'invoice_watch.watch_invoices'), None to read them
+    :return:        list of tuples (output_filename, error message) for the invoices that could not be generated
+    :raise InputFileError:  if the Excel file cannot be read
+    """
+
+    import invoice_manifest
+
+    if single_pdf and sink is not None:
+        raise ValueError("A single pdf run cannot write to a sink")
+
+    summarize = metrics is None
+    if summarize:
+        metrics = instrumentation.RunMetrics()
+
     excel_file = entries['excel']
     output_dir = entries['output']
-    invoice_year = entries['year']
-    invoice_month = entries['month']
-    water_starting_date = entries['water']['initial']
-    water_ending_date = entries['water']['final']
-    energy_starting_date = entries['energy']['initial']
-    energy_ending_date = entries['energy']['final']
-
-    if building == 'COLQUEPATA':
-        building_address = 'Jr. Colquepata 215'
-    else:
-        building_address = 'Jr. Quipaypampa 227'
+    metrics.log("run_started", excel=excel_file, output_dir=output_dir, workers=workers, stream=stream,
+                single_pdf=single_pdf, renderer=entries.get('renderer', 'matplotlib'))
+
+    if records is None:
+        records = load_records(excel_file=excel_file, stream=stream, metrics=metrics, cache=cache)
+    if sink is None:
+        create_folder(output_dir, metrics=metrics)
 
-    create_folder(output_dir)
-    df = pd.DataFrame()
+    # An archive only replaces the previous one once complete : whatever fails before it is closed (summary,
+    # rendering, ledger) removes its temporary file
+    try:
+        totals = None
+        if not stream:
+            metrics.log("tenants", f"{len(records)} tenants read from '{excel_file}'.", tenants=len(records))
+            workers = min(get_worker_count(workers), max(1, len(records)))
+            totals = write_run_summary(entries, records=records, metrics=metrics, sink=sink)
+
+        jobs = iter_until_cancelled(iter_invoice_jobs(entries=entries, records=records,
+                                                      header=build_invoice_header(entries, metrics=metrics),
+                                                      totals=totals, in_memory=sink is not None), cancel=cancel)
+        pdf_path = os.path.join(output_dir, get_single_pdf_filename(entries)) if single_pdf else None
+
+        manifest = None
+        if sink is None and not single_pdf:
+            manifest = invoice_manifest.InvoiceManifest(force=force, metrics=metrics)
+            manifest.add_directory(os.path.dirname(os.path.join(output_dir, '')), period=get_period(entries))
+
+        return run_invoice_jobs(jobs, output_dir=output_dir, metrics=metrics, workers=workers, manifest=manifest,
+                                sink=sink, pdf_path=pdf_path,
+                                index_path=os.path.splitext(pdf_path)[0] + "_indice.csv" if page_index else None,
+                                renderer=entries.get('renderer', 'matplotlib'), ledger=ledger, cancel=cancel,
+                                size_budget=size_budget, summarize=summarize)
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        raise
+
+
+def make_workbook_invoices(entries_by_sheet, workers=1, force=False, metrics=None, ledger=None):
+    """
+    Generates the invoices of several properties stored in the sheets of a single Excel file, reading the file once
+    in streaming mode
+
+    :param entries_by_sheet:    dictionary sheet name -> entries dictionary of the property (see
+                                'widget_gen.get_widget_entries'). Every entries must point to the same Excel file
+    :param workers:             number of rendering processes (see 'get_worker_count')
+    :param force:               if True, every invoice is rendered again (see 'make_invoice')
+    :param metrics:             'instrumentation.RunMetrics' of the run (see 'make_invoice')
+    :param ledger:              'invoice_ledger.InvoiceLedger' of the invoices generated (see 'make_invoice')
+    :return:                    list of tuples (output_filename, error message) of the failed invoices
+    :raise InputFileError:      if the Excel file cannot be read
+    """
+
+    import read_table
+    import invoice_manifest
 
+    summarize = metrics is None
+    if summarize:
+        metrics = instrumentation.RunMetrics()
+
+    excel_files = {entries['excel'] for entries in entries_by_sheet.values()}
+    if len(excel_files) != 1:
+        raise ValueError(f"Expected a single Excel file, got {sorted(excel_files)}")
+    excel_file = excel_files.pop()
+    if not os.path.isfile(excel_file):
+        raise InputFileError(f"File '{excel_file}' not found.")
     try:
-        df = pd.read_excel(io=excel_file, usecols="A:P", sheet_name="CSV", engine='openpyxl')
-    except FileNotFoundError:
-        print(f"File '{excel_file}' not found.")
+        table_schema.read_sheet_schemas(excel_file=excel_file, sheet_names=list(entries_by_sheet))
     except Exception as e:
-        print(f"An error occurred: {e}")
-
-    table_dict = read_table.get_table_dictionary(dataframe=df)
-    fixed_columns = ['apartment', 'first_name', 'last_name', 'rent', 'energy', 'water']
-
-    for i, client_dict in enumerate(table_dict):
-
-        extra_columns = [key for key in client_dict.keys() if key not in fixed_columns]
-        extra_labels = [col for col in extra_columns if "label" in col]
-        extra_amounts = [col for col in extra_columns if "amount" in col]
-
-        # If label two long, it is separated in two lines
-        for label in extra_labels:
-            client_dict[label] = break_string_at_word(text=client_dict[label], max_length=40)
-
-        total_sum = [client_dict[key] for key in extra_amounts]
-        total_sum += [float(client_dict['rent']), float(client_dict['energy']), float(client_dict['water'])]
-        total_sum = np.nansum(total_sum)
-
-        columns = ('Descripción', ' Monto \n[S/.]')
-        data_fixed = [(f"Renta {invoice_month} {invoice_year}", client_dict['rent']),
-                      (f"Agua del {water_starting_date} al {water_ending_date}", client_dict['water']),
-                      (f"Luz del {energy_starting_date} al {energy_ending_date}", client_dict['energy'])
-                      ]
-        data_variable = [(client_dict[f'label_{k}'], client_dict[f'amount_{k}']) for k in range(len(extra_labels))]
-        data_sum = [("TOTAL", "{:.{}f}".format(total_sum, 2))]
-
-        data = data_fixed + data_variable + data_sum
-
-        signature = plt.imread(image_path)
-        im = OffsetImage(signature, zoom=0.50)
-        ab = AnnotationBbox(im,
-                            xy=[0.72, 0.65],
-                            boxcoords=("axes fraction", "data"),
-                            box_alignment=(0.5, 0.5),
-                            bboxprops=dict(alpha=0.0))
-
-        fig, ax = plt.subplot_mosaic([['A', 'A', 'A', 'A', 'A', 'A', 'A'],
-                                      ['A', 'A', 'A', 'A', 'A', 'A', 'A'],
-                                      ['C', 'C', 'C', 'C', 'B', 'B', 'B'],
-                                      ['C', 'C', 'C', 'C', 'B', 'B', 'B'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
-                                      ['G', 'G', 'G', 'H', 'H', 'H', 'H'],
-                                      ['I', 'I', 'I', 'I', 'I', 'I', 'I']],
-                                     height_ratios=[0.25, 0.25, 1, 1, 1, 1, 1, 1, 1, 1, 1.5, 0.25],
-                                     width_ratios=[0.5, 0.65, 0.65, 1.25, 1.25, 1.25, 0.5],
-                                     figsize=(10, 18))
-
-        # Add a table at the bottom of the axes
-        the_table = ax['E'].table(cellText=data,
-                                  colLabels=columns,
-                                  loc='center')
-        # Set font size and scale for column labels and cell content
-        the_table.auto_set_font_size(False)
-        the_table.set_fontsize(18)
-
-        # Manually set column widths
-        col_widths = [1.0, 0.20]  # Adjust as needed
-        for i, width in enumerate(col_widths):
-            for j, row in enumerate(range(len(data) + 1)):
-                the_table._cells[(j, i)].set_width(width)
-
-        # Set cell heights
-        the_table.auto_set_column_width([2, 1])  # Column 1 has 2 times the width of Column 2
-        the_table.scale(1, 4)  # Adjust the scale for cell heights
-
-        # Make the first and last rows bold
-        for j in range(2):
-            cell_first_row = the_table._cells[(0, j)]
-            cell_last_row = the_table._cells[(len(data), j)]
-
-            cell_first_row.set_text_props(weight='bold')
-            cell_last_row.set_text_props(weight='bold')
-
-        # Add background color to the first and last rows
-        for j in range(2):
-            the_table._cells[(0, j)].set_facecolor('#a6a6a6')  # gray background color for the first row
-            the_table._cells[(len(data), j)].set_facecolor('#a6a6a6')  # gray background color for the last row
-
-        for subplot in ax.values():
-            subplot.axis('off')
-
-        ax['A'].axhline(y=0.95, linewidth=5, color='C0')
-        ax['A'].text(0.0, 0.60, 'RECIBO DE PAGO', va='center', color='C0', fontsize=20, weight='bold')
-        ax['A'].text(0.0, 0.20, f'{invoice_month} {invoice_year}', va='center', color='C0', fontsize=20, weight='bold')
-        ax['I'].axhline(y=0.05, linewidth=5, color='C0')
-
-        ax['B'].text(0.05, 0.90, 'Lugar de', va='center', color='C0', fontsize=14, weight='bold')
-        ax['B'].text(0.05, 0.80, 'arrendamiento :', va='center', color='C0', fontsize=14, weight='bold')
-        ax['B'].text(0.05, 0.68, building_address, va='center', color='gray', fontsize=14, weight='bold')
-        ax['B'].text(0.05, 0.58, 'Urb. Tahuantinsuyo', va='center', color='gray', fontsize=14, weight='bold')
-        ax['B'].text(0.05, 0.48, 'Independencia', va='center', color='gray', fontsize=14, weight='bold')
-        ax['B'].text(0.05, 0.38, 'Lima, Perú', va='center', color='gray', fontsize=14, weight='bold')
-
-        ax['C'].text(0.02, 0.90, 'Arrendatario :', va='center', color='C0', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.78, client_dict["first_name"], va='center', color='gray', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.68, client_dict["last_name"], va='center', color='gray', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.58, '', va='center', color='gray', fontsize=18)
-        ax['C'].text(0.02, 0.50, 'Departamento :', va='center', color='C0', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.38, client_dict["apartment"], va='center', color='gray', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.30, '', va='center', color='gray', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.20, 'Fecha de emisión :', va='center', color='C0', fontsize=18, weight='bold')
-        ax['C'].text(0.02, 0.08, datetime.today().date().strftime("%d/%m/%Y"), va='center', color='gray', fontsize=18, weight='bold')
-
-        ax['G'].text(0.02, 0.85, 'Atentamente,', va='center', color='gray', fontsize=18, weight='bold')
-
-        ax['H'].add_artist(ab)
-        ax['H'].text(0.72, 0.22, 'Wuilber Miranda\nQuispecahuana', va='center', ha='center', color='gray', fontsize=15, weight='bold')
-        ax['H'].text(0.72, 0.00, 'Propietario y Administrador', va='center', ha='center', color='gray', fontsize=12, weight='bold')
-
-        output_filename = f"{invoice_year}_{invoice_month.lower()}_depa_{client_dict['apartment']}_{client_dict['last_name'].replace(' ', '_').lower()}.pdf"
-        plt.savefig(os.path.join(output_dir, output_filename), format="pdf")
-        plt.close(fig)
+        raise get_input_error(excel_file, e) from e
+
+    headers = {}
+    for sheet_name, entries in entries_by_sheet.items():
+        create_folder(entries['output'], metrics=metrics)
+        headers[sheet_name] = build_invoice_header(entries, metrics=metrics)
+
+    def iter_records():
+        try:
+            yield from read_table.iter_workbook_records(excel_file=excel_file, sheet_names=list(entries_by_sheet))
+        except Exception as e:
+            raise get_input_error(excel_file, e) from e
+
+    def iter_jobs():
+        for sheet_name, record in metrics.timed_iter("load", iter_records()):
+            entries = entries_by_sheet[sheet_name]
+            yield from iter_invoice_jobs(entries=entries, records=[record], header=headers[sheet_name])
+
+    output_dirs = ", ".join(sorted({entries['output'] for entries in entries_by_sheet.values()}))
+
+    manifest = invoice_manifest.InvoiceManifest(force=force, metrics=metrics)
+    for entries in entries_by_sheet.values():
+        manifest.add_directory(os.path.dirname(os.path.join(entries['output'], '')), period=get_period(entries))
+
+    return run_invoice_jobs(iter_jobs(), output_dir=output_dirs, metrics=metrics, workers=workers, manifest=manifest,
+                            ledger=ledger, summarize=summarize)
+
+
+def get_cli_entries(args):
+    """
+    Builds from the command line arguments the same entries dictionary as 'widget_gen.get_widget_entries'
+
+    :param args:    parsed arguments (see 'parse_arguments')
+    :return:        dict: entries of the invoice run
+    """
+
+    entries = {"property": args.property,
+               "year": str(args.year),
+               "month": args.month,
+               "water": {"initial": args.water_start,
+                         "final": args.water_end},
+               "energy": {"initial": args.energy_start,
+                          "final": args.energy_end},
+               "excel": args.excel,
+               "output": args.out,
+               "renderer": args.renderer
+               }
+    if args.signature_dpi is not None:
+        entries["signature_dpi"] = args.signature_dpi
+
+    return entries
+
+
+def get_ledger(path=None):
+    """
+    :param path:    path of the ledger, None for 'invoice_ledger.get_default_ledger_path'
+    :return:        'invoice_ledger.InvoiceLedger'
+    """
+
+    import invoice_ledger
+
+    return invoice_ledger.InvoiceLedger(path)
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the arguments of the headless (non-interactive) invoice generation
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m invoice_gen",
+                                     description="Generador de recibos sin interfaz gráfica")
+    parser.add_argument("--property", required=True, choices=PROPERTIES, help="inmueble")
+    parser.add_argument("--year", required=True, type=int, help="año del recibo")
+    parser.add_argument("--month", required=True, choices=MONTHS, help="mes del recibo")
+    parser.add_argument("--water-start", default="", help="fecha de inicio del servicio de agua")
+    parser.add_argument("--water-end", default="", help="fecha de fin del servicio de agua")
+    parser.add_argument("--energy-start", default="", help="fecha de inicio del servicio de luz")
+    parser.add_argument("--energy-end", default="", help="fecha de fin del servicio de luz")
+    parser.add_argument("--excel", required=True, help="archivo Excel con la hoja 'CSV'")
+    parser.add_argument("--out", required=True, help="carpeta donde se guardan los recibos")
+    parser.add_argument("--renderer", choices=sorted(RENDERERS), default="matplotlib",
+                        help="motor de dibujo : 'matplotlib' o 'pdf' (pdf directo, sin matplotlib, más rápido)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="número de procesos de generación (0 : todos los núcleos)")
+    parser.add_argument("--stream", action="store_true",
+                        help="lee el Excel fila por fila y genera cada recibo en cuanto se lee")
+    parser.add_argument("--force", action="store_true",
+                        help="genera de nuevo todos los recibos, aunque sus datos no hayan cambiado")
+    parser.add_argument("--single-pdf", action="store_true",
+                        help="guarda todos los recibos como páginas de un único pdf")
+    parser.add_argument("--page-index", action="store_true",
+                        help="con --single-pdf, escribe también el índice inquilino -> página en csv")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="formato de los mensajes : texto o un objeto json por línea")
+    parser.add_argument("--report", default=None,
+                        help="archivo json donde se guarda el resumen (tiempos por etapa, memoria, contadores)")
+    parser.add_argument("--profile", default=None,
+                        help="archivo donde se guarda el perfil cProfile de la ejecución (proceso principal)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="lee siempre el Excel, sin usar la caché de las hojas ya leídas")
+    parser.add_argument("--size-budget", type=float, default=None,
+                        help="tamaño máximo de un recibo en KB : se señalan los recibos más grandes")
+    parser.add_argument("--signature-dpi", type=int, default=None,
+                        help="resolución de impresión de la firma (por defecto 200 ppp)")
+    parser.add_argument("--ledger", default=None,
+                        help="archivo sqlite del registro de recibos emitidos (por defecto en ~/.local/share)")
+    parser.add_argument("--no-ledger", action="store_true",
+                        help="no registra los recibos generados")
+    parser.add_argument("--archive", choices=["zip", "tar", "tar.gz"], default=None,
+                        help="guarda los recibos y el resumen en un único archivo comprimido dentro de la carpeta, "
+                             "sin archivos intermedios")
+    parser.add_argument("--compression-level", type=int, choices=range(10), default=None, metavar="0-9",
+                        help="con --archive, nivel de compresión (0 : sin compresión)")
+    parser.add_argument("--watch", action="store_true",
+                        help="vigila el Excel y, cada vez que se guarda, genera de nuevo solo los recibos de los "
+                             "departamentos añadidos, modificados o eliminados (Ctrl+C para terminar)")
+    parser.add_argument("--poll-interval", type=float, default=None,
+                        help="con --watch, segundos entre dos lecturas del estado del Excel (por defecto 0.5)")
+
+    args = parser.parse_args(argv)
+    if args.archive is not None and args.single_pdf:
+        parser.error("--archive y --single-pdf no se pueden usar juntos")
+    if args.compression_level and args.archive not in ("zip", "tar.gz"):
+        parser.error("--compression-level solo se aplica a --archive zip o tar.gz (tar no se comprime)")
+    if args.watch and (args.stream or args.single_pdf or args.archive is not None):
+        parser.error("--watch no se puede usar con --stream, --single-pdf ni --archive")
+
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point of the headless invoice generation, e.g. :
+
+        python -m invoice_gen --property COLQUEPATA --year 2026 --month Octubre --excel recibos.xlsx --out recibos
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        exit code : 0 if every invoice was generated, 1 if some failed, 2 if the Excel file is unreadable
+    """
+
+    args = parse_arguments(argv)
+
+    # No display on a headless server : invoices are only saved to pdf
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    metrics = instrumentation.RunMetrics(log_format=args.log_format)
+    cache = None if args.no_cache else table_cache.TableCache()
+    ledger = None if args.no_ledger else get_ledger(args.ledger)
+    entries = get_cli_entries(args)
+
+    if args.watch:
+        import invoice_watch
+
+        try:
+            invoice_watch.watch_invoices(entries, workers=args.workers, force=args.force, metrics=metrics,
+                                         ledger=ledger, interval=args.poll_interval or invoice_watch.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            metrics.log("watch_stopped", "Watch stopped.")
+        finally:
+            metrics.report(path=args.report)
+        return 0
+
+    sink = None
+    if args.archive is not None:
+        import invoice_sink
+
+        archive_name = invoice_sink.get_archive_filename(os.path.splitext(get_single_pdf_filename(entries))[0],
+                                                         archive_format=args.archive)
+        sink = invoice_sink.ArchiveSink(os.path.join(args.out, archive_name), archive_format=args.archive,
+                                        compression_level=args.compression_level)
+
+    try:
+        with instrumentation.profile(args.profile):
+            failures = make_invoice(entries, workers=args.workers, stream=args.stream,
+                                    force=args.force, single_pdf=args.single_pdf, page_index=args.page_index,
+                                    metrics=metrics, cache=cache, ledger=ledger, sink=sink,
+                                    size_budget=None if args.size_budget is None else args.size_budget * 1024)
+    except InputFileError as e:
+        metrics.log("error", str(e), error=str(e))
+        return 2
+    finally:
+        metrics.report(path=args.report)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import math
+
+# Fixed lines of the 'Lugar de arrendamiento' block, below the street address of the property
+ADDRESS_LINES = ('Urb. Tahuantinsuyo', 'Independencia', 'Lima, Perú')
+
+LANDLORD_NAME = 'Wuilber Miranda\nQuispecahuana'
+LANDLORD_ROLE = 'Propietario y Administrador'
+
+# Printed width of the signature image, in points
+SIGNATURE_WIDTH = 137.5
+
+
+def break_string_at_word(text, max_length):
+    lines = []
+    current_line = ""
+
+    words = text.split()
+
+    for word in words:
+        if len(current_line) + len(word) + 1 <= max_length:
+            current_line += word + " "
+        else:
+            lines.append(current_line.strip())
+            current_line = word + " "
+
+    # Add the last line
+    lines.append(current_line.strip())
+
+    return "\n".join(lines)
+
+
+def get_total(record):
+    """
+    :param record:  'read_table.TenantRecord' of the tenant
+    :return:        sum of the rent, water, energy and extra charges of the tenant, empty amounts left out
+    """
+
+    amounts = list(record.extra_amounts) + [record.rent, record.energy, record.water]
+
+    return math.fsum(amount for amount in amounts if not math.isnan(amount))
+
+
+def get_charges(header, record):
+    """
+    Lists the charges of a tenant with their printed description : rent, water, energy and the extra charges
+
+    :param header:  job header as built by 'invoice_gen.build_invoice_header'
+    :param record:  'read_table.TenantRecord' of the tenant
+    :return:        list of tuples (kind, description, amount), kind being 'rent', 'water', 'energy' or 'extra'
+    """
+
+    invoice_year = header['year']
+    invoice_month = header['month']
+    water_starting_date = header['water']['initial']
+    water_ending_date = header['water']['final']
+    energy_starting_date = header['energy']['initial']
+    energy_ending_date = header['energy']['final']
+
+    charges = [("rent", f"Renta {invoice_month} {invoice_year}", record.rent),
+               ("water", f"Agua del {water_starting_date} al {water_ending_date}", record.water),
+               ("energy", f"Luz del {energy_starting_date} al {energy_ending_date}", record.energy)
+               ]
+
+    return charges + [("extra", label, amount) for label, amount in zip(record.extra_labels, record.extra_amounts)]
+
+
+def get_table_data(header, record, total=None):
+    """
+    Builds the rows of the charges table of a tenant : rent, water, energy, the extra charges and the total
+
+    :param header:  job header as built by 'invoice_gen.build_invoice_header'
+    :param record:  'read_table.TenantRecord' of the tenant
+    :param total:   total of the tenant if already computed (see 'invoice_summary.get_summary'), None to compute it
+    :return:        tuple (column labels, list of (description, amount) rows)
+    """
+
+    charges = get_charges(header=header, record=record)
+
+    columns = ('Descripción', ' Monto \n[S/.]')
+    data_fixed = [(description, "{:.{}f}".format(amount, 2)) for kind, description, amount in charges[:3]]
+    # If label two long, it is separated in two lines
+    data_variable = [(break_string_at_word(text=description, max_length=40), amount)
+                     for kind, description, amount in charges[3:]]
+    data_sum = [("TOTAL", "{:.{}f}".format(get_total(record) if total is None else total, 2))]
+
+    return columns, data_fixed + data_variable + data_sum
+
+
+def get_page_layout(header):
+    """
+    Describes, independently of the renderer, the part of the invoice page shared by every tenant of a run
+
+    :param header:  job header as built by 'invoice_gen.build_invoice_header'
+    :return:        dictionary of the page sections : 'header', 'landlord', 'issue_date' and 'signature'
+    """
+
+    layout = {'header': {'title': 'RECIBO DE PAGO',
+                         'period': f"{header['month']} {header['year']}"},
+              'landlord': {'heading': ('Lugar de', 'arrendamiento :'),
+                           'address': (header['building_address'],) + ADDRESS_LINES},
+              'issue_date': header['issue_date'],
+              'signature': {'closing': 'Atentamente,',
+                            'image_path': header['image_path'],
+                            'width': SIGNATURE_WIDTH,
+                            'name': LANDLORD_NAME,
+                            'role': LANDLORD_ROLE}
+              }
+
+    return layout
+
+
+def get_tenant_layout(header, record, total=None):
+    """
+    Describes, independently of the renderer, the part of the invoice page specific to a tenant
+
+    :param header:  job header as built by 'invoice_gen.build_invoice_header'
+    :param record:  'read_table.TenantRecord' of the tenant
+    :param total:   total of the tenant if already computed, None to compute it (see 'get_table_data')
+    :return:        dictionary of the page sections : 'tenant', 'charges' (column labels and rows) and 'total'
+    """
+
+    columns, data = get_table_data(header=header, record=record, total=total)
+
+    layout = {'tenant': {'first_name': record.first_name,
+                         'last_name': record.last_name,
+                         'apartment': record.apartment},
+              'charges': {'columns': columns,
+                          'rows': data[:-1]},
+              'total': data[-1]
+              }
+
+    return layout
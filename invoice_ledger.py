@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import csv
+import sqlite3
+import argparse
+from collections import deque
+
+import invoice_layout
+
+# Bump when the tables change : 'PRAGMA user_version' of the ledger
+LEDGER_VERSION = 1
+
+# Number of invoices written per transaction while a run goes on (see 'InvoiceLedger.record_results')
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id          INTEGER PRIMARY KEY,
+    property    TEXT NOT NULL,
+    year        INTEGER NOT NULL,
+    month       INTEGER NOT NULL,
+    apartment   TEXT NOT NULL,
+    first_name  TEXT NOT NULL,
+    last_name   TEXT NOT NULL,
+    total       REAL NOT NULL,
+    path        TEXT NOT NULL,
+    issue_date  TEXT NOT NULL,
+    UNIQUE (property, year, month, apartment, last_name)
+);
+CREATE INDEX IF NOT EXISTS invoices_apartment ON invoices (apartment, year, month);
+CREATE INDEX IF NOT EXISTS invoices_period ON invoices (year, month);
+CREATE TABLE IF NOT EXISTS charges (
+    invoice_id  INTEGER NOT NULL REFERENCES invoices (id) ON DELETE CASCADE,
+    position    INTEGER NOT NULL,
+    kind        TEXT NOT NULL,
+    description TEXT NOT NULL,
+    amount      REAL,
+    PRIMARY KEY (invoice_id, position)
+) WITHOUT ROWID;
+"""
+
+# Columns of the aggregates, one per kind of charge (see 'invoice_layout.get_charges') and the total
+AGGREGATE_COLUMNS = ("rent", "water", "energy", "extra", "total")
+
+# Grouping of the aggregates -> columns of the 'invoices' table
+GROUPS = {"property": ("property",),
+          "year": ("year",),
+          "month": ("year", "month"),
+          "apartment": ("property", "apartment")}
+
+
+def get_default_ledger_path():
+    """
+    :return:    path of the ledger in the home of the current user, looked up at every call (not at import, so that a
+                changed HOME, e.g. in the tests, is followed)
+    """
+
+    return os.path.join(os.path.expanduser("~"), ".local", "share", "invoice_generator", "ledger.sqlite")
+
+
+def open_ledger(path):
+    """
+    Opens (and creates if needed) a ledger database
+
+    :param path:    path of the sqlite file
+    :return:        sqlite3.Connection, foreign keys enforced
+    """
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA foreign_keys = ON")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != LEDGER_VERSION:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {LEDGER_VERSION}")
+
+    return connection
+
+
+def get_amount(value):
+    """
+    :param value:   amount of a charge
+    :return:        the amount, None (NULL) for an empty amount
+    """
+
+    return None if value != value else value
+
+
+def get_job_key(job):
+    """
+    :param job: job dictionary (see 'invoice_gen.iter_invoice_jobs')
+    :return:    tuple (property, year, month number, apartment, last name) identifying its invoice in the ledger, the
+                month number being 1 for January
+    """
+
+    import invoice_gen
+
+    header = job['header']
+    record = job['client']
+
+    return (header['property'], int(header['year']), invoice_gen.MONTHS.index(header['month']) + 1, record.apartment,
+            record.last_name)
+
+
+class InvoiceLedger:
+    """
+    Local index of the issued invoices : one row per invoice (property, period, tenant, total and pdf path) and one
+    row per charge line, so that the reports query the database instead of opening the pdf files. Invoices are keyed
+    by property, period, apartment and last name : a new run of a period replaces its rows. The rows are written in
+    batches while the run goes on, so that the memory does not grow with the number of invoices
+    """
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE):
+        """
+        :param path:        path of the sqlite file, created on first use. None for 'get_default_ledger_path'
+        :param batch_size:  number of invoices written per transaction
+        """
+
+        self.path = get_default_ledger_path() if path is None else path
+        self.batch_size = batch_size
+        self.listed = set()
+        self.periods = set()
+        self.pending = deque()
+        self.rows = []
+        self.n_written = 0
+
+    def list_jobs(self, jobs):
+        """
+        Lists the tenants of a job stream before its unchanged invoices are skipped (see
+        'invoice_manifest.InvoiceManifest.filter_jobs') : 'save' removes the rows of the tenants of the periods that
+        are not listed, those of the skipped invoices are kept as they are
+
+        :param jobs:    iterable of job dictionaries (see 'invoice_gen.iter_invoice_jobs')
+        :return:        generator of the same jobs
+        """
+
+        for job in jobs:
+            key = get_job_key(job)
+            self.periods.add(key[:3])
+            self.listed.add(key)
+            yield job
+
+    def record_jobs(self, jobs, path=None):
+        """
+        Prepares the rows of the invoices to render, written by 'record_results' once they are rendered
+
+        :param jobs:    iterable of job dictionaries, the ones actually rendered
+        :param path:    pdf file of the invoices if they are the pages of a single file (or an archive), None for the
+                        'output_path' of every job
+        :return:        generator of the same jobs
+        """
+
+        for job in jobs:
+            header = job['header']
+            record = job['client']
+            key = property_name, year, month_number, apartment, last_name = get_job_key(job)
+            invoice = (property_name, year, month_number, apartment, record.first_name, last_name,
+                       invoice_layout.get_total(record) if job.get('total') is None else job['total'],
+                       os.path.abspath(job['output_path'] if path is None else path),
+                       header['issue_date'])
+            charges = [(kind, description, get_amount(amount))
+                       for kind, description, amount in invoice_layout.get_charges(header=header, record=record)]
+            self.pending.append((key, invoice, charges))
+            yield job
+
+    def record_results(self, results):
+        """
+        Keeps the rows of the invoices rendered successfully and writes them every 'batch_size' invoices. The rows of
+        the invoices that failed are left as they were. Results must come in the same order as the jobs yielded by
+        'record_jobs'
+
+        :param results: iterable of tuples (output_filename, error message or None)
+        :return:        generator of the same results
+        """
+
+        for output_filename, error in results:
+            row = self.pending.popleft()
+            if error is None:
+                self.rows.append(row)
+                if len(self.rows) >= self.batch_size:
+                    self.write_rows()
+            yield output_filename, error
+
+    def write_rows(self):
+        """
+        Writes the rows kept by 'record_results' in a single transaction, replacing those of the same invoices
+
+        :return:    None
+        """
+
+        connection = open_ledger(self.path)
+        try:
+            with connection:
+                for key, invoice, charges in self.rows:
+                    connection.execute("DELETE FROM invoices WHERE property = ? AND year = ? AND month = ? "
+                                       "AND apartment = ? AND last_name = ?", key)
+                    invoice_id = connection.execute("INSERT INTO invoices (property, year, month, apartment, "
+                                                    "first_name, last_name, total, path, issue_date) "
+                                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", invoice).lastrowid
+                    connection.executemany("INSERT INTO charges (invoice_id, position, kind, description, amount) "
+                                           "VALUES (?, ?, ?, ?, ?)",
+                                           [(invoice_id, position) + charge for position, charge in enumerate(charges)])
+        finally:
+            connection.close()
+
+        self.n_written += len(self.rows)
+        self.rows = []
+
+    def save(self, complete=True):
+        """
+        Writes the rows not written yet and removes those of the tenants no longer listed for a period
+
+        :param complete:    False if the run was interrupted before all its jobs were seen (e.g. cancelled) : no row
+                            is removed
+        :return:            number of invoices written during the run
+        """
+
+        if self.rows:
+            self.write_rows()
+
+        if complete and self.periods:
+            connection = open_ledger(self.path)
+            try:
+                with connection:
+                    for property_name, year, month in self.periods:
+                        rows = connection.execute("SELECT id, apartment, last_name FROM invoices "
+                                                  "WHERE property = ? AND year = ? AND month = ?",
+                                                  (property_name, year, month)).fetchall()
+                        connection.executemany("DELETE FROM invoices WHERE id = ?",
+                                               [(invoice_id,) for invoice_id, apartment, last_name in rows
+                                                if (property_name, year, month, apartment, last_name)
+                                                not in self.listed])
+            finally:
+                connection.close()
+
+        n_written = self.n_written
+        self.listed = set()
+        self.periods = set()
+        self.pending = deque()
+        self.n_written = 0
+
+        return n_written
+
+
+def get_conditions(property_name=None, year=None, month=None, apartment=None):
+    """
+    :param property_name:   property, None for all
+    :param year:            year, None for all
+    :param month:           month (1 for January), None for all
+    :param apartment:       apartment, None for all
+    :return:                tuple (sql WHERE clause, parameters)
+    """
+
+    conditions = []
+    parameters = []
+    for column, value in (("property", property_name), ("year", year), ("month", month), ("apartment", apartment)):
+        if value is not None:
+            conditions.append(f"invoices.{column} = ?")
+            parameters.append(value)
+
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", parameters
+
+
+def query_invoices(path, property_name=None, year=None, month=None, apartment=None, charges=False):
+    """
+    Lists the invoices of the ledger, e.g. what an apartment paid in a month
+
+    :param path:            path of the ledger
+    :param property_name:   property, None for all
+    :param year:            year, None for all
+    :param month:           month (1 for January), None for all
+    :param apartment:       apartment, None for all
+    :param charges:         if True, every charge line is listed instead of the invoice totals
+    :return:                tuple (column names, list of rows), ordered by period, property and apartment
+    """
+
+    where, parameters = get_conditions(property_name=property_name, year=year, month=month, apartment=apartment)
+    columns = ["property", "year", "month", "apartment", "first_name", "last_name"]
+    if charges:
+        columns += ["kind", "description", "amount"]
+        sql = (f"SELECT invoices.property, invoices.year, invoices.month, invoices.apartment, invoices.first_name, "
+               f"invoices.last_name, charges.kind, charges.description, charges.amount "
+               f"FROM invoices JOIN charges ON charges.invoice_id = invoices.id{where} "
+               f"ORDER BY invoices.year, invoices.month, invoices.property, invoices.apartment, charges.position")
+    else:
+        columns += ["total", "path"]
+        sql = (f"SELECT property, year, month, apartment, first_name, last_name, total, path FROM invoices{where} "
+               f"ORDER BY year, month, property, apartment")
+
+    connection = open_ledger(path)
+    try:
+        return columns, connection.execute(sql, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+def aggregate_invoices(path, group_by="month", property_name=None, year=None, month=None, apartment=None):
+    """
+    Sums the invoices of the ledger per group : amount of every kind of charge, total and number of invoices
+
+    :param path:            path of the ledger
+    :param group_by:        key of 'GROUPS' : 'property', 'year', 'month' or 'apartment'
+    :param property_name:   property, None for all
+    :param year:            year, None for all
+    :param month:           month (1 for January), None for all
+    :param apartment:       apartment, None for all
+    :return:                tuple (column names, list of rows)
+    """
+
+    where, parameters = get_conditions(property_name=property_name, year=year, month=month, apartment=apartment)
+    keys = ", ".join(GROUPS[group_by])
+    sums = ", ".join(f"SUM(CASE WHEN charges.kind = '{kind}' THEN charges.amount END) AS {kind}"
+                     for kind in AGGREGATE_COLUMNS[:-1])
+
+    # Charges are summed per invoice first, then the invoices per group
+    sql = (f"SELECT {keys}, {', '.join(f'ROUND(SUM({column}), 2)' for column in AGGREGATE_COLUMNS)}, COUNT(*) "
+           f"FROM (SELECT invoices.property, invoices.year, invoices.month, invoices.apartment, invoices.total, {sums} "
+           f"FROM invoices JOIN charges ON charges.invoice_id = invoices.id{where} GROUP BY invoices.id) "
+           f"GROUP BY {keys} ORDER BY {keys}")
+
+    connection = open_ledger(path)
+    try:
+        rows = connection.execute(sql, parameters).fetchall()
+    finally:
+        connection.close()
+
+    return list(GROUPS[group_by]) + list(AGGREGATE_COLUMNS) + ["invoices"], rows
+
+
+def format_rows(columns, rows):
+    """
+    :param columns: column names
+    :param rows:    list of rows
+    :return:        text table, amounts with two decimals
+    """
+
+    cells = [[f"{value:.2f}" if isinstance(value, float) else ("" if value is None else str(value)) for value in row]
+             for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells]) for i, column in enumerate(columns)]
+
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+                     for row in [columns] + cells)
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the arguments of the ledger queries
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        argparse.Namespace
+    """
+
+    import invoice_gen
+
+    parser = argparse.ArgumentParser(prog="python -m invoice_ledger",
+                                     description="Consultas del registro de recibos emitidos")
+    parser.add_argument("command", choices=["query", "totals"],
+                        help="'query' : lista los recibos, 'totals' : suma los montos por grupo")
+    parser.add_argument("--ledger", default=None,
+                        help="archivo sqlite del registro (por defecto en ~/.local/share)")
+    parser.add_argument("--property", choices=invoice_gen.PROPERTIES, default=None, help="inmueble")
+    parser.add_argument("--year", type=int, default=None, help="año")
+    parser.add_argument("--month", choices=invoice_gen.MONTHS, default=None, help="mes")
+    parser.add_argument("--apartment", default=None, help="departamento")
+    parser.add_argument("--charges", action="store_true", help="con 'query', lista cada concepto del recibo")
+    parser.add_argument("--by", choices=sorted(GROUPS), default="month",
+                        help="con 'totals', agrupa por inmueble, año, mes o departamento")
+    parser.add_argument("--csv", action="store_true", help="escribe el resultado en csv")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Entry point of the ledger queries, e.g. :
+
+        python -m invoice_ledger query --apartment 302 --year 2026 --month Marzo --charges
+        python -m invoice_ledger totals --year 2026 --by property
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        exit code : 0, or 2 if there is no ledger
+    """
+
+    import invoice_gen
+
+    args = parse_arguments(argv)
+    if args.ledger is None:
+        args.ledger = get_default_ledger_path()
+    if not os.path.isfile(args.ledger):
+        print(f"Ledger '{args.ledger}' not found.")
+        return 2
+
+    filters = {"property_name": args.property,
+               "year": args.year,
+               "month": None if args.month is None else invoice_gen.MONTHS.index(args.month) + 1,
+               "apartment": args.apartment}
+    if args.command == "query":
+        columns, rows = query_invoices(args.ledger, charges=args.charges, **filters)
+    else:
+        columns, rows = aggregate_invoices(args.ledger, group_by=args.by, **filters)
+
+    if args.csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        print(format_rows(columns, rows))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
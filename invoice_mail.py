@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+
+import os
+import re
+import csv
+import ssl
+import sys
+import time
+import random
+import asyncio
+import smtplib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import formatdate
+
+import invoice_gen
+import instrumentation
+import table_cache
+import table_schema
+
+# Messages sent at the same time, each over its own connection of the pool
+CONCURRENCY = 4
+
+# Attempts per invoice, and delay in seconds before the first retry (doubled at every retry)
+MAX_ATTEMPTS = 4
+BACKOFF = 1.0
+
+# Delivery status of an invoice
+SENT = "sent"
+PARTIAL = "partial"  # sent, but the server refused some of the addresses of the tenant
+FAILED = "failed"
+NO_ADDRESS = "no_address"
+NO_INVOICE = "no_invoice"
+
+DELIVERY_HEADER = ["departamento", "nombre", "apellido", "correo", "recibo", "estado", "intentos", "error"]
+
+# The password is never given on the command line, where other users could read it
+PASSWORD_VARIABLE = "INVOICE_SMTP_PASSWORD"
+
+
+def parse_addresses(value):
+    """
+    :param value:   cell of the e-mail column, several addresses being separated by commas, semicolons or spaces
+    :return:        tuple of addresses, empty if the cell is empty
+    """
+
+    if value is None:
+        return ()
+
+    return tuple(address for address in re.split(r"[\s,;]+", str(value)) if address)
+
+
+def read_recipients(excel_file, sheet_name="CSV"):
+    """
+    Reads the e-mail addresses of the tenants from the e-mail column of a sheet (see 'table_schema.OPTIONAL_COLUMNS')
+
+    :param excel_file:  path to the Excel file
+    :param sheet_name:  name of the sheet
+    :return:            dictionary apartment -> tuple of addresses, apartments without address are left out
+    :raise table_schema.SchemaError: if the sheet is missing, has an invalid header or no e-mail column
+    """
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        worksheet = table_schema.get_worksheet(workbook, sheet_name)
+        schema = table_schema.get_sheet_schema(worksheet, sheet_name)
+        if 'email' not in schema.positions:
+            keys = " or ".join(f"'{key}'" for key in table_schema.OPTIONAL_COLUMNS)
+            raise table_schema.SchemaError(f"sheet '{sheet_name}' has no e-mail column (header containing {keys})")
+
+        apartment_position = schema.positions['apartment']
+        email_position = schema.positions['email']
+        recipients = {}
+        for row in worksheet.iter_rows(min_row=2, max_col=len(schema.names), values_only=True):
+            apartment = row[apartment_position] if apartment_position < len(row) else None
+            addresses = parse_addresses(row[email_position] if email_position < len(row) else None)
+            if apartment is not None and addresses:
+                recipients[str(apartment)] = addresses
+    finally:
+        workbook.close()
+
+    return recipients
+
+
+def get_delivery_filename(entries):
+    """
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :return:            file name of the csv report of the delivery
+    """
+
+    return f"{entries['year']}_{entries['month'].lower()}_{entries['property'].lower()}_envios.csv"
+
+
+def build_delivery_jobs(entries, records, recipients):
+    """
+    Matches the tenants of a run with their invoice and their addresses
+
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param records:     list of 'read_table.TenantRecord'
+    :param recipients:  dictionary apartment -> tuple of addresses (see 'read_recipients')
+    :return:            list of job dictionaries, one per tenant
+    """
+
+    jobs = []
+    for record in records:
+        filename = invoice_gen.get_output_filename(entries['year'], entries['month'], record)
+        jobs.append({'record': record,
+                     'recipients': recipients.get(record.apartment, ()),
+                     'filename': filename,
+                     'path': os.path.join(entries['output'], filename)})
+
+    return jobs
+
+
+def build_message(job, entries, sender):
+    """
+    :param job:         delivery job (see 'build_delivery_jobs')
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param sender:      address of the sender
+    :return:            email.message.EmailMessage with the invoice attached
+    """
+
+    record = job['record']
+    message = EmailMessage()
+    message['Subject'] = f"Recibo de {entries['month']} {entries['year']} - departamento {record.apartment}"
+    message['From'] = sender
+    message['To'] = ", ".join(job['recipients'])
+    message['Date'] = formatdate(localtime=True)
+    message.set_content(f"Estimado(a) {record.first_name} {record.last_name}:\n\n"
+                        f"Le enviamos adjunto el recibo de {entries['month']} {entries['year']} del departamento "
+                        f"{record.apartment}.\n\nSaludos cordiales\n")
+
+    with open(job['path'], "rb") as file:
+        message.add_attachment(file.read(), maintype="application", subtype="pdf", filename=job['filename'])
+
+    return message
+
+
+def open_connection(smtp):
+    """
+    :param smtp:    dictionary of the SMTP server : 'host', 'port', 'security' ('ssl', 'starttls' or None), 'user'
+                    and 'password' (no login if 'user' is None), 'timeout' in seconds
+    :return:        smtplib.SMTP connection, logged in
+    """
+
+    timeout = smtp.get('timeout', 30)
+    if smtp.get('security') == "ssl":
+        connection = smtplib.SMTP_SSL(smtp['host'], smtp['port'], timeout=timeout,
+                                      context=ssl.create_default_context())
+    else:
+        connection = smtplib.SMTP(smtp['host'], smtp['port'], timeout=timeout)
+        if smtp.get('security') == "starttls":
+            connection.starttls(context=ssl.create_default_context())
+
+    if smtp.get('user'):
+        connection.login(smtp['user'], smtp.get('password') or "")
+
+    return connection
+
+
+def close_connection(connection):
+    """
+    Ends an SMTP session, the connection may already be broken
+
+    :param connection:  smtplib.SMTP connection
+    :return:            None
+    """
+
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+
+def is_transient(error):
+    """
+    :param error:   exception raised while sending a message
+    :return:        True if sending again may work : 4xx replies, lost or refused connections, timeouts
+    """
+
+    if isinstance(error, (ssl.SSLError, smtplib.SMTPNotSupportedError)):
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, reply in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+
+    return isinstance(error, OSError)
+
+
+class SmtpPool:
+    """
+    SMTP connections shared by the messages of a delivery : a connection is opened (and logged in) once and reused
+    for the following messages, at most 'size' of them are open. The blocking smtplib calls run in a thread per
+    connection so that the event loop keeps 'size' messages in flight
+    """
+
+    def __init__(self, smtp, size=CONCURRENCY):
+        """
+        :param smtp:    dictionary of the SMTP server (see 'open_connection')
+        :param size:    maximum number of connections, i.e. of messages sent at the same time
+        """
+
+        self.smtp = smtp
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="smtp")
+        self.semaphore = asyncio.Semaphore(size)
+        self.idle = []
+        self.n_opened = 0
+
+    async def run(self, function, *args):
+        """
+        :param function:    blocking function, run in a thread of the pool
+        :param args:        arguments of the function
+        :return:            result of the function
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def send(self, message):
+        """
+        Sends a message over an idle connection, or a new one. A connection that failed is dropped, the next message
+        opens a new one
+
+        :param message:     email.message.EmailMessage
+        :return:            dictionary address -> tuple (code, reply) of the recipients refused by the server, the
+                            message was sent to the others
+        :raise smtplib.SMTPException, OSError:  if the message could not be sent (e.g. every recipient refused)
+        """
+
+        async with self.semaphore:
+            if self.idle:
+                connection = self.idle.pop()
+            else:
+                connection = await self.run(open_connection, self.smtp)
+                self.n_opened += 1
+
+            try:
+                refused = await self.run(connection.send_message, message)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # Refused by the server, the session itself is still usable
+                self.idle.append(connection)
+                raise
+            except BaseException:
+                await self.run(close_connection, connection)
+                raise
+
+            self.idle.append(connection)
+
+            return refused
+
+    async def close(self):
+        """
+        Closes the idle connections and the threads of the pool
+
+        :return:    None
+        """
+
+        while self.idle:
+            await self.run(close_connection, self.idle.pop())
+        self.executor.shutdown()
+
+
+def format_refused(refused):
+    """
+    :param refused: dictionary address -> tuple (code, reply) of refused recipients (see 'SmtpPool.send')
+    :return:        e.g. 'recipients refused: ana@example.com (550 no such user)'
+    """
+
+    return "recipients refused: " + ", ".join(
+        f"{address} ({code} {reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else reply})"
+        for address, (code, reply) in refused.items())
+
+
+async def send_with_retry(pool, message, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+    """
+    Sends a message, retrying with an exponential backoff (and some jitter, so that the messages that failed together
+    are not retried together) while the errors are transient
+
+    :param pool:            'SmtpPool'
+    :param message:         email.message.EmailMessage
+    :param max_attempts:    maximum number of attempts, at least 1
+    :param backoff:         delay in seconds before the first retry, doubled at every retry
+    :return:                tuple (number of attempts, error message or None, dictionary address -> (code, reply) of
+                            the recipients refused while the message went to the others)
+    """
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            refused = await pool.send(message)
+            return attempt, None, refused
+        except (smtplib.SMTPException, OSError) as e:
+            error = f"{type(e).__name__}: {e}"
+            if not is_transient(e) or attempt == max_attempts:
+                return attempt, error, {}
+        await asyncio.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+
+async def deliver(jobs, entries, sender, smtp, concurrency=CONCURRENCY, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF,
+                  metrics=None):
+    """
+    Sends the invoices of the delivery jobs concurrently over a pool of SMTP connections. A message is built (its
+    pdf read) inside the same limit as its sending, so that at most 'concurrency' messages are held in memory whatever
+    the number of invoices
+
+    :param jobs:            delivery jobs with a recipient and an invoice (see 'build_delivery_jobs')
+    :param entries:         dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param sender:          address of the sender
+    :param smtp:            dictionary of the SMTP server (see 'open_connection')
+    :param concurrency:     maximum number of messages built or sent at the same time
+    :param max_attempts:    maximum number of attempts per invoice (see 'send_with_retry')
+    :param backoff:         delay in seconds before the first retry
+    :param metrics:         'instrumentation.RunMetrics' of the delivery, a new one if None
+    :return:                list of tuples (status 'SENT', 'PARTIAL' or 'FAILED', number of attempts, error message
+                            or None), in the order of the jobs
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    pool = SmtpPool(smtp, size=concurrency)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def send_job(job):
+        async with limit:
+            try:
+                message = await pool.run(build_message, job, entries, sender)
+            except OSError as e:
+                attempts, error, refused = 0, f"{type(e).__name__}: {e}", {}
+            else:
+                attempts, error, refused = await send_with_retry(pool, message, max_attempts=max_attempts,
+                                                                 backoff=backoff)
+
+        if error is not None:
+            metrics.count("send_failed")
+            metrics.log("invoice_not_sent", f"Invoice '{job['filename']}' not sent: {error}",
+                        output_filename=job['filename'], recipients=job['recipients'], attempts=attempts,
+                        error=error)
+            return FAILED, attempts, error
+
+        if refused:
+            error = format_refused(refused)
+            metrics.count("send_partial")
+            metrics.log("invoice_partially_sent", f"Invoice '{job['filename']}' sent, but {error}",
+                        output_filename=job['filename'], recipients=job['recipients'], attempts=attempts,
+                        refused=sorted(refused), error=error)
+            return PARTIAL, attempts, error
+
+        metrics.count("sent")
+        metrics.log("invoice_sent", output_filename=job['filename'], recipients=job['recipients'], attempts=attempts)
+
+        return SENT, attempts, None
+
+    try:
+        return await asyncio.gather(*(send_job(job) for job in jobs))
+    finally:
+        await pool.close()
+        metrics.log("smtp_connections", connections=pool.n_opened)
+
+
+def write_delivery_report(path, jobs, results):
+    """
+    :param path:    path of the csv report
+    :param jobs:    delivery jobs (see 'build_delivery_jobs')
+    :param results: list of dictionaries 'status', 'attempts' and 'error' of the jobs
+    :return:        None
+    """
+
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(DELIVERY_HEADER)
+        for job, result in zip(jobs, results):
+            record = job['record']
+            writer.writerow([record.apartment, record.first_name, record.last_name, " ".join(job['recipients']),
+                             job['filename'], result['status'], result['attempts'], result['error'] or ""])
+
+
+def send_invoices(entries, smtp, sender, sheet_name="CSV", concurrency=CONCURRENCY, max_attempts=MAX_ATTEMPTS,
+                  backoff=BACKOFF, metrics=None, cache=None):
+    """
+    Sends the invoices of a run generated by 'invoice_gen.make_invoice' to the tenants, at the addresses of the
+    e-mail column of the sheet, and writes the result of every invoice in a csv report next to the invoices (see
+    'get_delivery_filename')
+
+    :param entries:         dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param smtp:            dictionary of the SMTP server (see 'open_connection')
+    :param sender:          address of the sender
+    :param sheet_name:      sheet holding the tenants and their addresses
+    :param concurrency:     maximum number of messages sent at the same time, and of SMTP connections
+    :param max_attempts:    maximum number of attempts per invoice (see 'send_with_retry')
+    :param backoff:         delay in seconds before the first retry
+    :param metrics:         'instrumentation.RunMetrics' of the delivery, a new one if None
+    :param cache:           'table_cache.TableCache' of the normalized sheets (see 'invoice_gen.load_records')
+    :return:                list of dictionaries, one per tenant : 'filename', 'recipients', 'status' ('SENT',
+                            'PARTIAL', 'FAILED', 'NO_ADDRESS' or 'NO_INVOICE'), 'attempts' and 'error' (None if
+                            sent, the refused addresses if 'PARTIAL')
+    :raise invoice_gen.InputFileError:  if the Excel file cannot be read or has no e-mail column
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    excel_file = entries['excel']
+    records = invoice_gen.load_workbook_records(excel_file=excel_file, sheet_names=[sheet_name], metrics=metrics,
+                                                cache=cache)[sheet_name]
+    try:
+        recipients = read_recipients(excel_file, sheet_name=sheet_name)
+    except Exception as e:
+        raise invoice_gen.get_input_error(excel_file, e) from e
+
+    jobs = build_delivery_jobs(entries, records=records, recipients=recipients)
+    results = []
+    for job in jobs:
+        status = None
+        if not job['recipients']:
+            status = NO_ADDRESS
+        elif not os.path.isfile(job['path']):
+            status = NO_INVOICE
+        results.append({'filename': job['filename'], 'recipients': job['recipients'], 'status': status,
+                        'attempts': 0, 'error': None})
+        if status is not None:
+            metrics.count("send_skipped")
+            metrics.log("invoice_not_sent", f"Invoice '{job['filename']}' not sent: {status}.",
+                        output_filename=job['filename'], status=status)
+
+    to_send = [(job, result) for job, result in zip(jobs, results) if result['status'] is None]
+    start = time.perf_counter()
+    with metrics.stage("send"):
+        outcomes = asyncio.run(deliver([job for job, result in to_send], entries, sender=sender, smtp=smtp,
+                                       concurrency=concurrency, max_attempts=max_attempts, backoff=backoff,
+                                       metrics=metrics))
+    for (job, result), (status, attempts, error) in zip(to_send, outcomes):
+        result.update(status=status, attempts=attempts, error=error)
+    seconds = time.perf_counter() - start
+
+    report_path = os.path.join(entries['output'], get_delivery_filename(entries))
+    write_delivery_report(report_path, jobs=jobs, results=results)
+
+    n_sent = sum(result['status'] == SENT for result in results)
+    n_partial = sum(result['status'] == PARTIAL for result in results)
+    partial = f" ({n_partial} more to some of their addresses only)" if n_partial else ""
+    metrics.log("delivery", f"{n_sent} of {len(results)} invoices sent{partial} in {seconds:.3f} s, report in "
+                            f"'{report_path}'.", sent=n_sent, partial=n_partial, invoices=len(results),
+                seconds=seconds, report=report_path)
+
+    return results
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the arguments of the delivery of the invoices of a run
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m invoice_mail",
+                                     description="Envío por correo de los recibos ya generados a cada inquilino")
+    parser.add_argument("--property", required=True, choices=invoice_gen.PROPERTIES, help="inmueble")
+    parser.add_argument("--year", required=True, type=int, help="año del recibo")
+    parser.add_argument("--month", required=True, choices=invoice_gen.MONTHS, help="mes del recibo")
+    parser.add_argument("--excel", required=True, help="archivo Excel con la hoja 'CSV' y una columna 'correo'")
+    parser.add_argument("--sheet", default="CSV", help="hoja de los inquilinos (por defecto 'CSV')")
+    parser.add_argument("--out", required=True, help="carpeta donde están los recibos")
+    parser.add_argument("--sender", required=True, help="dirección del remitente")
+    parser.add_argument("--smtp-host", default="localhost", help="servidor SMTP")
+    parser.add_argument("--smtp-port", type=int, default=None,
+                        help="puerto del servidor SMTP (por defecto 465 con ssl, 587 con starttls, si no 25)")
+    parser.add_argument("--smtp-security", choices=["ssl", "starttls", "none"], default="none",
+                        help="cifrado de la conexión")
+    parser.add_argument("--smtp-user", default=None,
+                        help=f"usuario SMTP, la contraseña se lee de la variable de entorno {PASSWORD_VARIABLE}")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help=f"número de correos enviados a la vez, y de conexiones (por defecto {CONCURRENCY})")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                        help=f"intentos por recibo si el servidor falla (por defecto {MAX_ATTEMPTS})")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="formato de los mensajes : texto o un objeto json por línea")
+    parser.add_argument("--report", default=None,
+                        help="archivo json donde se guarda el resumen (tiempos por etapa, contadores)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="lee siempre el Excel, sin usar la caché de las hojas ya leídas")
+
+    args = parser.parse_args(argv)
+    if args.concurrency < 1 or args.max_attempts < 1:
+        parser.error("--concurrency y --max-attempts deben ser al menos 1")
+
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point of the delivery of the invoices, once generated by 'invoice_gen', e.g. :
+
+        python -m invoice_mail --property COLQUEPATA --year 2026 --month Octubre --excel recibos.xlsx --out recibos
+                               --sender administracion@example.com --smtp-host smtp.example.com --smtp-security ssl
+
+    :param argv:    list of arguments, defaults to 'sys.argv[1:]'
+    :return:        exit code : 0 if every invoice was sent, 1 if some were not, 2 if the Excel file is unreadable
+    """
+
+    args = parse_arguments(argv)
+
+    security = None if args.smtp_security == "none" else args.smtp_security
+    smtp = {"host": args.smtp_host,
+            "port": args.smtp_port or {"ssl": 465, "starttls": 587}.get(security, 25),
+            "security": security,
+            "user": args.smtp_user,
+            "password": os.environ.get(PASSWORD_VARIABLE)}
+    entries = {"property": args.property,
+               "year": str(args.year),
+               "month": args.month,
+               "excel": args.excel,
+               "output": args.out}
+
+    metrics = instrumentation.RunMetrics(log_format=args.log_format)
+    cache = None if args.no_cache else table_cache.TableCache()
+
+    try:
+        results = send_invoices(entries, smtp=smtp, sender=args.sender, sheet_name=args.sheet,
+                                concurrency=args.concurrency, max_attempts=args.max_attempts, metrics=metrics,
+                                cache=cache)
+    except invoice_gen.InputFileError as e:
+        metrics.log("error", str(e), error=str(e))
+        return 2
+    finally:
+        metrics.report(path=args.report)
+
+    return 0 if all(result['status'] == SENT for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
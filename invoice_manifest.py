@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import dataclasses
+from collections import deque
+
+import instrumentation
+
+MANIFEST_FILENAME = ".invoice_manifest.json"
+
+# Bump when the rendering of the page changes, so that every invoice is generated again
+TEMPLATE_VERSION = 2
+
+# Header fields that do not change the invoice content of an already generated file. The path of the signature
+# image is replaced by the hash of its content (see 'get_image_hash')
+IGNORED_HEADER_FIELDS = ("image_path", "issue_date")
+
+# Image path -> (size, modification time in ns, sha256) : the image is only hashed again when it changes
+_image_hashes = {}
+
+
+def get_image_hash(image_path):
+    """
+    :param image_path:  path of an image embedded in the invoices
+    :return:            hexadecimal sha256 digest of its content, None if it does not exist (its invoices fail)
+    """
+
+    try:
+        stat = os.stat(image_path)
+    except FileNotFoundError:
+        return None
+
+    size, mtime_ns, digest = _image_hashes.get(image_path, (None, None, None))
+    if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+        with open(image_path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        _image_hashes[image_path] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    return digest
+
+
+def get_job_hash(job):
+    """
+    Computes the content hash of an invoice job : tenant record, run header (with the content of the signature image
+    and its preprocessing settings) and template version
+
+    :param job: job dictionary as built by 'invoice_gen.iter_invoice_jobs'
+    :return:    hexadecimal sha256 digest
+    """
+
+    header = {key: value for key, value in job['header'].items() if key not in IGNORED_HEADER_FIELDS}
+    content = {"template_version": TEMPLATE_VERSION,
+               "header": header,
+               "signature": get_image_hash(job['header']['image_path']),
+               "client": dataclasses.asdict(job['client'])}
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_job_period(job):
+    """
+    :param job: job dictionary as built by 'invoice_gen.iter_invoice_jobs'
+    :return:    tuple (property, year, month) of the invoice : runs of other periods may share its output directory
+    """
+
+    header = job['header']
+
+    return header['property'], header['year'], header['month']
+
+
+def is_in_periods(filename, entry, periods):
+    """
+    :param filename:    output filename of an invoice of the manifest
+    :param entry:       its entry in the manifest (see 'load_manifest')
+    :param periods:     set of tuples (property, year, month) of a run
+    :return:            True if the invoice belongs to one of the periods. The invoices recorded without their period
+                        (manifests of older versions) are recognized by the prefix of their file name (see
+                        'invoice_gen.get_output_filename')
+    """
+
+    if entry['period'] is not None:
+        return tuple(entry['period']) in periods
+
+    return any(filename.startswith(f"{year}_{month.lower()}_") for _, year, month in periods)
+
+
+def load_manifest(output_dir, metrics=None):
+    """
+    Reads the manifest of an output directory
+
+    :param output_dir:  output directory of the invoices
+    :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+    :return:            dictionary output filename -> {'hash': job hash, 'period': [property, year, month] or None if
+                        not recorded}, empty if there is no (readable) manifest
+    """
+
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILENAME), encoding="utf-8") as file:
+            invoices = json.load(file)["invoices"]
+        return {filename: {"hash": entry, "period": None} if isinstance(entry, str) else entry
+                for filename, entry in invoices.items()}
+    except FileNotFoundError:
+        return {}
+    except (ValueError, KeyError, AttributeError) as e:
+        if metrics is None:
+            metrics = instrumentation.RunMetrics()
+        metrics.log("manifest_ignored", f"Manifest of '{output_dir}' ignored: {e}", output_dir=output_dir,
+                    error=str(e))
+        return {}
+
+
+def save_manifest(output_dir, invoices):
+    """
+    Writes the manifest of an output directory, replacing the previous one atomically
+
+    :param output_dir:  output directory of the invoices
+    :param invoices:    dictionary output filename -> {'hash', 'period'} (see 'load_manifest')
+    :return:            None
+    """
+
+    path = os.path.join(output_dir, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"template_version": TEMPLATE_VERSION, "invoices": invoices}, file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+class InvoiceManifest:
+    """
+    Incremental regeneration : keeps, next to the invoices, the hash of the inputs and the period of every generated
+    file so that a new run only renders the tenants whose hash changed and removes the files of the tenants of its
+    periods that are gone. The invoices of other periods sharing the output directory are left as they are
+    """
+
+    def __init__(self, force=False, metrics=None):
+        """
+        :param force:   if True, every invoice is rendered again whatever the manifest says
+        :param metrics: 'instrumentation.RunMetrics' receiving an 'invoice_skipped' event per skipped invoice and the
+                        removed invoices, a new one if None
+        """
+
+        self.force = force
+        self.metrics = instrumentation.RunMetrics() if metrics is None else metrics
+        self.previous = {}
+        self.current = {}
+        self.periods = {}
+        self.pending = deque()
+        self.failed = set()
+        self.rendered = []
+        self.n_skipped = 0
+
+    def add_directory(self, output_dir, period=None):
+        """
+        Loads on first use the manifest of an output directory. Directories and periods are added automatically by
+        'filter_jobs', adding them explicitly lets 'save' clean up a period even when none of its tenants is left
+
+        :param output_dir:  output directory of the invoices
+        :param period:      tuple (property, year, month) of a run writing to the directory (see 'get_job_period')
+        :return:            None
+        """
+
+        if output_dir not in self.previous:
+            self.previous[output_dir] = load_manifest(output_dir, metrics=self.metrics)
+            self.current[output_dir] = {}
+            self.periods[output_dir] = set()
+        if period is not None:
+            self.periods[output_dir].add(tuple(period))
+
+    def filter_jobs(self, jobs):
+        """
+        Drops the jobs whose output file exists and whose inputs did not change since the last run
+
+        :param jobs:    iterable of job dictionaries
+        :return:        generator of the jobs to render
+        """
+
+        for job in jobs:
+            output_dir = os.path.dirname(job['output_path'])
+            period = get_job_period(job)
+            self.add_directory(output_dir, period=period)
+
+            entry = {"hash": get_job_hash(job), "period": list(period)}
+            filename = job['output_filename']
+            previous = self.previous[output_dir].get(filename)
+            unchanged = (previous is not None and previous['hash'] == entry['hash']
+                         and os.path.exists(job['output_path']))
+
+            if unchanged and not self.force:
+                self.current[output_dir][filename] = entry
+                self.n_skipped += 1
+                self.metrics.log("invoice_skipped", output_filename=filename)
+                continue
+
+            self.pending.append((output_dir, filename, entry))
+            yield job
+
+    def record_results(self, results):
+        """
+        Records the hash and the path ('rendered') of the invoices rendered successfully. Results must come in the same
+        order as the jobs yielded by 'filter_jobs'
+
+        :param results: iterable of tuples (output_filename, error message or None)
+        :return:        generator of the same results
+        """
+
+        for output_filename, error in results:
+            output_dir, filename, entry = self.pending.popleft()
+            if error is None:
+                self.current[output_dir][filename] = entry
+                self.rendered.append(os.path.join(output_dir, filename))
+            else:
+                self.failed.add((output_dir, filename))
+            yield output_filename, error
+
+    def save(self, complete=True):
+        """
+        Removes the invoices of the previous run of the same periods that are not part of this one and writes the
+        manifests. The invoices of other periods are kept. The files of the invoices that failed are left untouched :
+        they are not in the manifest, so they are rendered next time
+
+        :param complete:    False if the run was interrupted before all its jobs were seen (e.g. cancelled) : nothing
+                            is removed and the previous hashes of the jobs not seen are kept
+        :return:            None
+        """
+
+        for output_dir, invoices in self.current.items():
+            for filename, entry in self.previous[output_dir].items():
+                if filename in invoices or (output_dir, filename) in self.failed:
+                    continue
+                if not complete or not is_in_periods(filename, entry, self.periods[output_dir]):
+                    invoices[filename] = entry
+                    continue
+                try:
+                    os.remove(os.path.join(output_dir, filename))
+                    self.metrics.log("invoice_removed", f"Stale invoice '{filename}' removed.", output_dir=output_dir,
+                                     output_filename=filename)
+                except FileNotFoundError:
+                    pass
+            save_manifest(output_dir=output_dir, invoices=invoices)
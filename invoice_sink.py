@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import io
+import os
+import json
+import time
+import hashlib
+import tarfile
+import zipfile
+
+# Archive format -> file extension
+ARCHIVE_FORMATS = {"zip": ".zip",
+                   "tar": ".tar",
+                   "tar.gz": ".tar.gz"}
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+# Sinks receive the invoices rendered in memory ('invoice_gen.make_invoice' with a 'sink') through 'add', in the
+# order of the run. They are closed once the run is over, or aborted if it stopped on an error
+class ArchiveSink:
+    """
+    Invoices streamed straight into a zip or tar archive : each invoice is a single write of its in-memory buffer, no
+    file is written on disk besides the archive. The archive ends with a manifest of its files (name, size, sha256)
+    and only replaces a previous archive of the same name once complete
+    """
+
+    def __init__(self, path, archive_format=None, compression_level=None):
+        """
+        :param path:                path of the archive
+        :param archive_format:      key of 'ARCHIVE_FORMATS', None to use the extension of 'path'
+        :param compression_level:   0 (stored) to 9 (smallest), None for the default of the format. A 'tar' archive
+                                    is never compressed, only 0 or None are accepted
+        :raise ValueError:          if the format is unknown, or a compression level is given to a 'tar' archive
+        """
+
+        if archive_format is None:
+            # Longest extensions first : '.tar.gz' is not a '.tar'
+            for name, extension in sorted(ARCHIVE_FORMATS.items(), key=lambda item: -len(item[1])):
+                if path.endswith(extension):
+                    archive_format = name
+                    break
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format for '{path}', expected one of {sorted(ARCHIVE_FORMATS)}")
+        if archive_format == "tar" and compression_level:
+            raise ValueError(f"A 'tar' archive is not compressed, got the compression level {compression_level}: "
+                             f"use 'tar.gz'")
+
+        self.name = path
+        self.archive_format = archive_format
+        self.compression_level = compression_level
+        self.temporary_path = path + f".{os.getpid()}.tmp"
+        self.archive = None
+        self.manifest = []
+        self.closed = False
+
+    def open(self):
+        """
+        Opens the temporary archive (and creates its folder) on the first file added
+
+        :return:    zipfile.ZipFile or tarfile.TarFile
+        """
+
+        if self.archive is not None:
+            return self.archive
+
+        if os.path.dirname(self.name):
+            os.makedirs(os.path.dirname(self.name), exist_ok=True)
+
+        if self.archive_format == "zip":
+            self.archive = zipfile.ZipFile(self.temporary_path, "w",
+                                           compression=zipfile.ZIP_STORED if self.compression_level == 0
+                                           else zipfile.ZIP_DEFLATED,
+                                           compresslevel=self.compression_level or None)
+        elif self.archive_format == "tar.gz":
+            self.archive = tarfile.open(self.temporary_path, "w:gz",
+                                        compresslevel=9 if self.compression_level is None else self.compression_level)
+        else:
+            self.archive = tarfile.open(self.temporary_path, "w")
+
+        return self.archive
+
+    def add(self, filename, data):
+        """
+        Appends a file to the archive
+
+        :param filename:    name of the file in the archive
+        :param data:        content of the file
+        :return:            None
+        """
+
+        archive = self.open()
+        if isinstance(archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            info.compress_type = archive.compression
+            archive.writestr(info, data, compresslevel=archive.compresslevel)
+        else:
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+
+        self.manifest.append({"filename": filename, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+
+    def close(self):
+        """
+        Writes the manifest (last file of the archive), closes the archive and moves it to its final path
+
+        :return:    None
+        """
+
+        if self.closed:
+            return
+
+        manifest = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "files": self.manifest}
+        self.add(MANIFEST_FILENAME, json.dumps(manifest, indent=1, ensure_ascii=False).encode("utf-8"))
+        self.manifest.pop()
+
+        self.archive.close()
+        self.archive = None
+        self.closed = True
+        os.replace(self.temporary_path, self.name)
+
+    def abort(self):
+        """
+        Closes the archive and removes it, the previous archive of the same name is left untouched
+
+        :return:    None
+        """
+
+        self.closed = True
+        if self.archive is None:
+            return
+
+        self.archive.close()
+        self.archive = None
+        os.remove(self.temporary_path)
+
+
+def get_archive_filename(base_name, archive_format):
+    """
+    :param base_name:       file name without extension
+    :param archive_format:  key of 'ARCHIVE_FORMATS'
+    :return:                archive file name
+    """
+
+    return base_name + ARCHIVE_FORMATS[archive_format]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import csv
+
+# Amounts are summed as integer cents : the spreadsheet amounts are rounded to 2 decimals ('read_table.N_DECIMALS'),
+# so their sums are exact whatever the number of tenants
+CENTS = 100
+
+# Columns of the summary, one per kind of charge (see 'invoice_layout.get_charges') and the total
+AMOUNT_COLUMNS = ("rent", "water", "energy", "extra", "total")
+
+SUMMARY_HEADER = ["departamento", "nombre", "apellido", "renta", "agua", "luz", "otros", "total"]
+
+
+def to_cents(amounts):
+    """
+    :param amounts: numpy array of amounts, NaN for the empty ones
+    :return:        int64 array of cents, 0 for the empty amounts
+    """
+
+    import numpy as np
+
+    return np.where(np.isnan(amounts), 0, np.round(amounts * CENTS)).astype(np.int64)
+
+
+def get_summary(records):
+    """
+    Computes in a single vectorized pass the amounts of every tenant (rent, water, energy, sum of the extra charges
+    and total) and of the whole building
+
+    :param records: list of 'read_table.TenantRecord'
+    :return:        dictionary with 'tenants' (AMOUNT_COLUMNS -> int64 array of cents, one value per record),
+                    'building' (AMOUNT_COLUMNS -> cents), and the counts : 'n_tenants', 'n_extra_charges' and
+                    'n_empty_amounts' (rent, water or energy left empty)
+    """
+
+    import numpy as np
+
+    n_records = len(records)
+    fixed = {column: np.fromiter((getattr(record, column) for record in records), dtype=float, count=n_records)
+             for column in AMOUNT_COLUMNS[:3]}
+
+    # The extra charges of all the tenants are flattened : the sum of a tenant is the difference of the cumulated sum
+    # at its bounds
+    offsets = np.cumsum([0] + [len(record.extra_amounts) for record in records])
+    extra = to_cents(np.fromiter((amount for record in records for amount in record.extra_amounts), dtype=float,
+                                 count=int(offsets[-1])))
+    cumulated = np.concatenate([[0], np.cumsum(extra)])
+
+    tenants = {column: to_cents(amounts) for column, amounts in fixed.items()}
+    tenants['extra'] = cumulated[offsets[1:]] - cumulated[offsets[:-1]]
+    tenants['total'] = tenants['rent'] + tenants['water'] + tenants['energy'] + tenants['extra']
+
+    return {"tenants": tenants,
+            "building": {column: int(amounts.sum()) for column, amounts in tenants.items()},
+            "n_tenants": n_records,
+            "n_extra_charges": int(offsets[-1]),
+            "n_empty_amounts": int(sum(np.isnan(amounts).sum() for amounts in fixed.values()))}
+
+
+def format_cents(cents):
+    """
+    :param cents:   amount in cents
+    :return:        amount with 2 decimals, e.g. '1234.50'
+    """
+
+    sign = "-" if cents < 0 else ""
+
+    return f"{sign}{abs(cents) // CENTS}.{abs(cents) % CENTS:02d}"
+
+
+def write_summary(output, records, summary):
+    """
+    Writes the summary of a building for the landlord : one csv row per tenant and a last row with the totals of the
+    building
+
+    :param output:  path of the csv file, or text file object (opened with newline='')
+    :param records: list of 'read_table.TenantRecord'
+    :param summary: summary of the records (see 'get_summary')
+    :return:        None
+    """
+
+    if not hasattr(output, 'write'):
+        with open(output, "w", newline="", encoding="utf-8") as file:
+            write_summary(file, records=records, summary=summary)
+        return
+
+    columns = [summary['tenants'][column].tolist() for column in AMOUNT_COLUMNS]
+
+    writer = csv.writer(output)
+    writer.writerow(SUMMARY_HEADER)
+    for record, amounts in zip(records, zip(*columns)):
+        writer.writerow([record.apartment, record.first_name, record.last_name]
+                        + [format_cents(cents) for cents in amounts])
+    writer.writerow(["TOTAL", f"{summary['n_tenants']} inquilinos", ""]
+                    + [format_cents(summary['building'][column]) for column in AMOUNT_COLUMNS])
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import weakref
+
+import matplotlib.image
+import matplotlib.text
+import matplotlib.font_manager
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+from matplotlib.backends.backend_pdf import FigureCanvasPdf
+
+# The figure is built with the object-oriented API only : no pyplot figure manager keeps a reference to it, whatever
+# the number of invoices. The text layout caches of matplotlib are also emptied every CACHE_CLEAR_INTERVAL pages
+CACHE_CLEAR_INTERVAL = 500
+
+# 'clear_caches' and 'share_pdf_images' rely on private matplotlib internals ('_get_text_metrics_with_cache_impl' or
+# the renderer cache of '_get_text_metrics_function', '_get_font', 'PdfPages._ensure_file' or '_file',
+# 'PdfFile.imageObject'), checked with matplotlib 3.11. Each one is looked up first : without it, matplotlib keeps its
+# own behaviour (caches left as they are, one image per page)
+
+
+def clear_caches():
+    """
+    Empties the text layout and font caches of matplotlib
+
+    :return:    None
+    """
+
+    for cache in (getattr(matplotlib.text, '_get_text_metrics_with_cache_impl', None),
+                  getattr(matplotlib.font_manager, '_get_font', None)):
+        if hasattr(cache, 'cache_clear'):
+            cache.cache_clear()
+
+    # Recent matplotlib versions keep one text metrics cache per renderer, in the default argument of
+    # '_get_text_metrics_function' : the renderer of the figure lives as long as the template
+    defaults = getattr(getattr(matplotlib.text, '_get_text_metrics_function', None), '__defaults__', None) or ()
+    for renderers in defaults:
+        if isinstance(renderers, weakref.WeakKeyDictionary):
+            renderers.clear()
+
+
+class InvoiceTemplate:
+    """
+    Invoice page built once per run (property and month) : the layout, the static texts and the signature are drawn
+    a single time, then only the tenant block and the charges table are swapped before each save
+    """
+
+    def __init__(self, page_layout):
+        """
+        Builds the static part of the invoice page
+
+        :param page_layout:     page description as built by 'invoice_layout.get_page_layout'
+        """
+
+        # The zoom is the size in points of a pixel of the image. A gray image ('assets.prepare_image') is 2-d
+        signature = matplotlib.image.imread(page_layout['signature']['image_path'])
+        im = OffsetImage(signature, zoom=page_layout['signature']['width'] / signature.shape[1],
+                         cmap='gray', norm=Normalize(vmin=0.0, vmax=1.0))
+        ab = AnnotationBbox(im,
+                            xy=[0.72, 0.65],
+                            boxcoords=("axes fraction", "data"),
+                            box_alignment=(0.5, 0.5),
+                            bboxprops=dict(alpha=0.0))
+
+        fig = Figure(figsize=(10, 18))
+        FigureCanvasPdf(fig)
+        ax = fig.subplot_mosaic([['A', 'A', 'A', 'A', 'A', 'A', 'A'],
+                                 ['A', 'A', 'A', 'A', 'A', 'A', 'A'],
+                                 ['C', 'C', 'C', 'C', 'B', 'B', 'B'],
+                                 ['C', 'C', 'C', 'C', 'B', 'B', 'B'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['J', 'E', 'E', 'E', 'E', 'E', 'K'],
+                                 ['G', 'G', 'G', 'H', 'H', 'H', 'H'],
+                                 ['I', 'I', 'I', 'I', 'I', 'I', 'I']],
+                                height_ratios=[0.25, 0.25, 1, 1, 1, 1, 1, 1, 1, 1, 1.5, 0.25],
+                                width_ratios=[0.5, 0.65, 0.65, 1.25, 1.25, 1.25, 0.5])
+
+        for subplot in ax.values():
+            subplot.axis('off')
+
+        page_header = page_layout['header']
+        landlord = page_layout['landlord']
+        signature = page_layout['signature']
+
+        ax['A'].axhline(y=0.95, linewidth=5, color='C0')
+        ax['A'].text(0.0, 0.60, page_header['title'], va='center', color='C0', fontsize=20, weight='bold')
+        ax['A'].text(0.0, 0.20, page_header['period'], va='center', color='C0', fontsize=20, weight='bold')
+        ax['I'].axhline(y=0.05, linewidth=5, color='C0')
+
+        for y, line in zip((0.90, 0.80), landlord['heading']):
+            ax['B'].text(0.05, y, line, va='center', color='C0', fontsize=14, weight='bold')
+        for y, line in zip((0.68, 0.58, 0.48, 0.38), landlord['address']):
+            ax['B'].text(0.05, y, line, va='center', color='gray', fontsize=14, weight='bold')
+
+        # Tenant artists : their text is replaced for every invoice
+        ax['C'].text(0.02, 0.90, 'Arrendatario :', va='center', color='C0', fontsize=18, weight='bold')
+        self.first_name = ax['C'].text(0.02, 0.78, '', va='center', color='gray', fontsize=18, weight='bold')
+        self.last_name = ax['C'].text(0.02, 0.68, '', va='center', color='gray', fontsize=18, weight='bold')
+        ax['C'].text(0.02, 0.50, 'Departamento :', va='center', color='C0', fontsize=18, weight='bold')
+        self.apartment = ax['C'].text(0.02, 0.38, '', va='center', color='gray', fontsize=18, weight='bold')
+        ax['C'].text(0.02, 0.20, 'Fecha de emisión :', va='center', color='C0', fontsize=18, weight='bold')
+        ax['C'].text(0.02, 0.08, page_layout['issue_date'], va='center', color='gray', fontsize=18, weight='bold')
+
+        ax['G'].text(0.02, 0.85, signature['closing'], va='center', color='gray', fontsize=18, weight='bold')
+
+        ax['H'].add_artist(ab)
+        ax['H'].text(0.72, 0.22, signature['name'], va='center', ha='center', color='gray', fontsize=15, weight='bold')
+        ax['H'].text(0.72, 0.00, signature['role'], va='center', ha='center', color='gray', fontsize=12, weight='bold')
+
+        self.fig = fig
+        self.ax = ax
+        self.table = None
+        self.n_rendered = 0
+
+    def set_table(self, data, columns):
+        """
+        Replaces the charges table of the page
+
+        :param data:        list of (description, amount) rows, the last one being the total
+        :param columns:     column labels of the table
+        :return:            None
+        """
+
+        if self.table is not None:
+            self.table.remove()
+
+        # Add a table at the bottom of the axes
+        the_table = self.ax['E'].table(cellText=data,
+                                       colLabels=columns,
+                                       loc='center')
+        # Set font size and scale for column labels and cell content
+        the_table.auto_set_font_size(False)
+        the_table.set_fontsize(18)
+
+        # Manually set column widths
+        col_widths = [1.0, 0.20]  # Adjust as needed
+        for i, width in enumerate(col_widths):
+            for j, row in enumerate(range(len(data) + 1)):
+                the_table._cells[(j, i)].set_width(width)
+
+        # Set cell heights
+        the_table.auto_set_column_width([2, 1])  # Column 1 has 2 times the width of Column 2
+        the_table.scale(1, 4)  # Adjust the scale for cell heights
+
+        # Make the first and last rows bold
+        for j in range(2):
+            cell_first_row = the_table._cells[(0, j)]
+            cell_last_row = the_table._cells[(len(data), j)]
+
+            cell_first_row.set_text_props(weight='bold')
+            cell_last_row.set_text_props(weight='bold')
+
+        # Add background color to the first and last rows
+        for j in range(2):
+            the_table._cells[(0, j)].set_facecolor('#a6a6a6')  # gray background color for the first row
+            the_table._cells[(len(data), j)].set_facecolor('#a6a6a6')  # gray background color for the last row
+
+        self.table = the_table
+
+    def render(self, tenant_layout, output):
+        """
+        Fills the page with a tenant and saves it as pdf
+
+        :param tenant_layout:   tenant description as built by 'invoice_layout.get_tenant_layout'
+        :param output:          path of the pdf file, or document opened with 'open_document' to append the page to
+        :return:                None
+        """
+
+        tenant = tenant_layout['tenant']
+        self.first_name.set_text(tenant['first_name'])
+        self.last_name.set_text(tenant['last_name'])
+        self.apartment.set_text(tenant['apartment'])
+        self.set_table(data=tenant_layout['charges']['rows'] + [tenant_layout['total']],
+                       columns=tenant_layout['charges']['columns'])
+
+        self.fig.savefig(output, format="pdf")
+
+        self.n_rendered += 1
+        if self.n_rendered % CACHE_CLEAR_INTERVAL == 0:
+            clear_caches()
+
+    def close(self):
+        """
+        Releases the artists of the template
+
+        :return:    None
+        """
+
+        self.fig.clear()
+        self.table = None
+
+
+def share_pdf_images(pdf_pages):
+    """
+    Makes a multi-page pdf store identical images (the signature) once : matplotlib resamples the image at every
+    draw and would otherwise embed one copy per page. Fonts are already embedded once per pdf file
+
+    :param pdf_pages:   matplotlib 'PdfPages' being written
+    :return:            True if the images are shared, False if the matplotlib internals are not the expected ones
+    """
+
+    import hashlib
+
+    # Older matplotlib versions open the file when 'PdfPages' is created
+    if hasattr(pdf_pages, '_ensure_file'):
+        pdf_file = pdf_pages._ensure_file()
+    else:
+        pdf_file = getattr(pdf_pages, '_file', None)
+    image_object = getattr(pdf_file, 'imageObject', None)
+    if not callable(image_object):
+        return False
+
+    names = {}
+
+    def shared_image_object(image, *args, **kwargs):
+        if args or kwargs or not hasattr(image, 'tobytes'):
+            return image_object(image, *args, **kwargs)
+        key = (image.shape, image.dtype.str, hashlib.sha1(image.tobytes()).digest())
+        if key not in names:
+            names[key] = image_object(image)
+        return names[key]
+
+    pdf_file.imageObject = shared_image_object
+
+    return True
+
+
+def open_document(pdf_path):
+    """
+    Opens a multi-page pdf to which 'InvoiceTemplate.render' appends pages
+
+    :param pdf_path:    path of the pdf file
+    :return:            matplotlib 'PdfPages', to be closed (or used as a context manager)
+    """
+
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    pdf_pages = PdfPages(pdf_path)
+    share_pdf_images(pdf_pages)
+
+    return pdf_pages
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+import invoice_gen
+import instrumentation
+
+# Seconds between two looks at the Excel file. A change is only read once the file kept the same size and
+# modification time for one more interval, so that a file being saved is not read half written
+POLL_INTERVAL = 0.5
+
+
+def get_file_state(path):
+    """
+    :param path:    path of the watched file
+    :return:        tuple (size, modification time in ns), None if the file does not exist (e.g. while it is replaced)
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def wait_for_change(path, state, interval=POLL_INTERVAL, stop=None):
+    """
+    Polls a file until its state differs from 'state' and stays the same for one interval
+
+    :param path:        path of the watched file
+    :param state:       last state read (see 'get_file_state'), None to wait for the file to exist
+    :param interval:    seconds between two polls
+    :param stop:        'threading.Event' ending the wait when set, None to wait forever
+    :return:            new state of the file, None if stopped
+    """
+
+    pause = time.sleep if stop is None else stop.wait
+    while stop is None or not stop.is_set():
+        new_state = get_file_state(path)
+        if new_state is not None and new_state != state:
+            pause(interval)
+            if get_file_state(path) == new_state:
+                return new_state
+            continue
+        pause(interval)
+
+    return None
+
+
+def get_record_key(record):
+    """
+    :param record:  'read_table.TenantRecord'
+    :return:        comparable value of the record : an empty amount is NaN, which is not equal to itself
+    """
+
+    return repr(record)
+
+
+def get_snapshot(records):
+    """
+    :param records: list of 'read_table.TenantRecord'
+    :return:        dictionary apartment -> tuple of the keys of its records (see 'get_record_key'), in sheet order
+    """
+
+    snapshot = {}
+    for record in records:
+        snapshot.setdefault(record.apartment, []).append(get_record_key(record))
+
+    return {apartment: tuple(keys) for apartment, keys in snapshot.items()}
+
+
+def diff_snapshots(previous, current):
+    """
+    :param previous:    snapshot of the last update (see 'get_snapshot')
+    :param current:     snapshot of the file as just read
+    :return:            dictionary 'added', 'changed', 'removed' -> sorted list of apartments
+    """
+
+    return {"added": sorted(set(current) - set(previous)),
+            "changed": sorted(apartment for apartment in set(current) & set(previous)
+                              if current[apartment] != previous[apartment]),
+            "removed": sorted(set(previous) - set(current))}
+
+
+def format_changes(changes):
+    """
+    :param changes: dictionary of the changed apartments (see 'diff_snapshots')
+    :return:        e.g. 'changed: 101, 204 ; removed: 305'
+    """
+
+    return " ; ".join(f"{kind}: {', '.join(apartments)}" for kind, apartments in changes.items() if apartments)
+
+
+def watch_invoices(entries, workers=1, interval=POLL_INTERVAL, force=False, metrics=None, ledger=None, stop=None):
+    """
+    Keeps the invoices of a run up to date while its Excel file is being edited : the file is polled and, on every
+    save, its normalized tenants are compared by apartment with the previous version. Only the invoices of the
+    apartments added or changed are rendered again and those of the removed apartments are deleted (see
+    'invoice_manifest.InvoiceManifest'), a save that changes no tenant renders nothing. The page template stays
+    warm between the updates (see 'invoice_gen.keep_template')
+
+    :param entries:     dictionary of the widget entries (see 'widget_gen.get_widget_entries')
+    :param workers:     maximum number of rendering processes (see 'invoice_gen.make_invoice'). An update only uses
+                        as many as invoices to render, a single invoice is rendered in the current process
+    :param interval:    seconds between two polls of the Excel file
+    :param force:       if True, every invoice is rendered again at the first update
+    :param metrics:     'instrumentation.RunMetrics' of the whole session, a new one if None
+    :param ledger:      'invoice_ledger.InvoiceLedger' updated with every update, None for no record
+    :param stop:        'threading.Event' ending the watch when set, None to watch until interrupted
+    :return:            list of tuples (output_filename, error message) of the invoices that failed at the last update
+    """
+
+    if metrics is None:
+        metrics = instrumentation.RunMetrics()
+
+    excel_file = entries['excel']
+    max_workers = invoice_gen.get_worker_count(workers)
+    metrics.log("watch_started", f"Watching '{excel_file}' (every {interval} s), Ctrl+C to stop.", excel=excel_file,
+                interval=interval)
+
+    previous = {}
+    state = None
+    failures = []
+    n_updates = 0
+    # The updates rendered in the current process (e.g. a single changed apartment) share one page template, built
+    # at the first of them and released when the watch ends
+    with invoice_gen.keep_template():
+        while True:
+            state = wait_for_change(excel_file, state=state, interval=interval, stop=stop)
+            if state is None:
+                return failures
+
+            start = time.perf_counter()
+            try:
+                # The file changes at every update : caching its versions would only fill the cache
+                records = invoice_gen.load_records(excel_file=excel_file, metrics=metrics)
+            except invoice_gen.InputFileError as e:
+                metrics.log("watch_error", f"{e} (waiting for the next save)", error=str(e))
+                continue
+
+            snapshot = get_snapshot(records)
+            changes = diff_snapshots(previous, snapshot)
+            if not any(changes.values()):
+                metrics.log("watch_unchanged", "Excel file saved, no tenant changed.")
+                continue
+
+            n_rendered = sum(len(snapshot[apartment]) for apartment in changes['added'] + changes['changed'])
+            failures = invoice_gen.make_invoice(entries, workers=max(1, min(max_workers, n_rendered)),
+                                                force=force and n_updates == 0, metrics=metrics, ledger=ledger,
+                                                records=records)
+            # Apartments whose invoice failed are rendered again at the next save
+            failed = {filename for filename, error in failures}
+            failed_apartments = {record.apartment for record in records
+                                 if invoice_gen.get_output_filename(entries['year'], entries['month'], record)
+                                 in failed}
+            previous = {apartment: keys for apartment, keys in snapshot.items() if apartment not in failed_apartments}
+            n_updates += 1
+
+            seconds = time.perf_counter() - start
+            metrics.log("watch_update", f"Invoices updated in {seconds:.3f} s ({format_changes(changes)}).",
+                        seconds=seconds, failed=len(failures), **changes)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import re
+
+# Fonts every pdf reader provides : they are referenced without being embedded
+STANDARD_FONTS = {b"Courier", b"Courier-Bold", b"Courier-Oblique", b"Courier-BoldOblique",
+                  b"Helvetica", b"Helvetica-Bold", b"Helvetica-Oblique", b"Helvetica-BoldOblique",
+                  b"Times-Roman", b"Times-Bold", b"Times-Italic", b"Times-BoldItalic", b"Symbol", b"ZapfDingbats"}
+
+FONT_PATTERN = re.compile(rb"/BaseFont\s*/([^\s/<>\[\]()]+)")
+PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+# Embedded subset fonts are named with a six capital letters tag, e.g. 'EFQZJS+DejaVuSans'
+SUBSET_PATTERN = re.compile(rb"^[A-Z]{6}\+")
+
+
+def check_pdf(path, budget=None, data=None):
+    """
+    Checks the size of a pdf against a budget and that its fonts are either standard or embedded as subsets (a full
+    embedded font costs tens of kilobytes per file). Font and page dictionaries are looked up in the raw file, which
+    works for the files of both renderers (no compressed object streams)
+
+    :param path:    path to the pdf file
+    :param budget:  maximum size per page in bytes, None for no budget
+    :param data:    content of the pdf if it is not read from 'path' (e.g. an invoice rendered in memory)
+    :return:        dictionary with the file 'size', the number of 'pages', the 'fonts' names and the 'problems'
+                    found (list of messages)
+    """
+
+    if data is None:
+        with open(path, "rb") as file:
+            data = file.read()
+
+    fonts = sorted(set(FONT_PATTERN.findall(data)))
+    pages = max(1, len(PAGE_PATTERN.findall(data)))
+
+    problems = []
+    if budget is not None and len(data) > budget * pages:
+        problems.append(f"{len(data) / pages / 1024:.1f} KB per page, over the budget of {budget / 1024:.1f} KB")
+    for font in fonts:
+        if font not in STANDARD_FONTS and not SUBSET_PATTERN.match(font):
+            problems.append(f"font '{font.decode('latin-1')}' is not subset")
+
+    return {"size": len(data),
+            "pages": pages,
+            "fonts": [font.decode("latin-1") for font in fonts],
+            "problems": problems}
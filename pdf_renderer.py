@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+
+import zlib
+import struct
+
+# Direct pdf renderer : writes the pdf operators of the invoice page itself (vector text with the standard Helvetica
+# fonts, table lines and the signature image), without matplotlib. The page has the size and the layout of the
+# matplotlib page of 'invoice_template'
+
+# 10 x 18 inches, as the matplotlib figure
+PAGE_WIDTH = 720.0
+PAGE_HEIGHT = 1296.0
+
+# Boxes (x0, y0, x1, y1) in points of the areas of the matplotlib mosaic
+AREAS = {'A': (90.0, 1085.3, 648.0, 1140.5),
+         'B': (384.6, 892.6, 648.0, 1071.2),
+         'C': (90.0, 892.6, 371.0, 1071.2),
+         'E': (143.0, 314.7, 595.0, 878.6),
+         'G': (90.0, 177.2, 258.9, 300.6),
+         'H': (272.6, 177.2, 648.0, 300.6),
+         'I': (90.0, 142.6, 648.0, 163.1)}
+
+BLUE = (0.122, 0.467, 0.706)  # matplotlib 'C0'
+GRAY = (0.502, 0.502, 0.502)
+BLACK = (0.0, 0.0, 0.0)
+TABLE_GRAY = (0.651, 0.651, 0.651)
+WHITE = (1.0, 1.0, 1.0)
+
+# Distance between the vertical center of a line of text and its baseline, and between two baselines (in font sizes)
+BASELINE_SHIFT = 0.27
+LINE_SPACING = 1.2
+
+TABLE_WIDTHS = (452.0, 92.4)
+TABLE_ROW_HEIGHT = 48.0
+TABLE_FONT_SIZE = 18
+TABLE_PAD = 0.1
+
+FONTS = {False: b'F1', True: b'F2'}
+
+# Advance widths (1/1000 em) of the WinAnsiEncoding characters 32 to 255 (Adobe core font metrics)
+HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584, 0,
+    556, 0, 222, 556, 333, 1000, 556, 556, 333, 1000, 667, 333, 1000, 0, 611, 0,
+    0, 222, 222, 333, 333, 350, 556, 1000, 333, 1000, 500, 333, 944, 0, 500, 667,
+    278, 333, 556, 556, 556, 556, 260, 556, 333, 737, 370, 556, 584, 333, 737, 333,
+    400, 584, 333, 333, 333, 556, 537, 278, 333, 333, 365, 556, 834, 834, 834, 611,
+    667, 667, 667, 667, 667, 667, 1000, 722, 667, 667, 667, 667, 278, 278, 278, 278,
+    722, 722, 778, 778, 778, 778, 778, 584, 778, 722, 722, 722, 722, 667, 667, 611,
+    556, 556, 556, 556, 556, 556, 889, 500, 556, 556, 556, 556, 278, 278, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 584, 611, 556, 556, 556, 556, 500, 556, 500)
+
+HELVETICA_BOLD_WIDTHS = (
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584, 0,
+    556, 0, 278, 556, 500, 1000, 556, 556, 333, 1000, 667, 333, 1000, 0, 611, 0,
+    0, 278, 278, 500, 500, 350, 556, 1000, 333, 1000, 556, 333, 944, 0, 500, 667,
+    278, 333, 556, 556, 556, 556, 280, 556, 333, 737, 370, 556, 584, 333, 737, 333,
+    400, 584, 333, 333, 333, 611, 556, 278, 333, 333, 365, 556, 834, 834, 834, 611,
+    722, 722, 722, 722, 722, 722, 1000, 722, 667, 667, 667, 667, 278, 278, 278, 278,
+    722, 722, 778, 778, 778, 778, 778, 584, 778, 722, 722, 722, 722, 667, 667, 611,
+    556, 556, 556, 556, 556, 556, 889, 556, 556, 556, 556, 556, 278, 278, 278, 278,
+    611, 611, 611, 611, 611, 611, 611, 584, 611, 611, 611, 611, 611, 556, 611, 556)
+
+
+def encode_text(text):
+    """
+    Encodes a text for the standard pdf fonts (WinAnsiEncoding), characters out of it are replaced by '?'
+
+    :param text:    text to encode
+    :return:        bytes
+    """
+
+    return str(text).encode('cp1252', errors='replace')
+
+
+def get_text_width(text, size, bold=False):
+    """
+    Computes the width of a single line of text written with Helvetica
+
+    :param text:    text, already encoded (see 'encode_text')
+    :param size:    font size in points
+    :param bold:    True for Helvetica-Bold
+    :return:        width in points
+    """
+
+    widths = HELVETICA_BOLD_WIDTHS if bold else HELVETICA_WIDTHS
+
+    return sum(widths[code - 32] for code in text if code >= 32) * size / 1000
+
+
+def format_number(value):
+    """
+    Formats a coordinate for the pdf content stream
+
+    :param value:   number
+    :return:        bytes
+    """
+
+    return (b'%.2f' % value).rstrip(b'0').rstrip(b'.')
+
+
+def get_color(color, stroke=False):
+    """
+    Builds the operator setting an RGB color
+
+    :param color:   tuple (r, g, b) of floats between 0 and 1
+    :param stroke:  True for the stroking color (lines), False for the filling color (text, backgrounds)
+    :return:        bytes
+    """
+
+    return b' '.join(format_number(value) for value in color) + (b' RG' if stroke else b' rg')
+
+
+def get_text(text, x, y, size, color, bold=True, ha='left'):
+    """
+    Builds the operators of a (possibly multi-line) text vertically centered on y, as matplotlib 'va=center'
+
+    :param text:    text, lines separated by '\\n'
+    :param x:       x position in points of the anchor
+    :param y:       y position in points of the vertical center of the text
+    :param size:    font size in points
+    :param color:   tuple (r, g, b) of floats between 0 and 1
+    :param bold:    True for Helvetica-Bold
+    :param ha:      horizontal alignment of the lines on x : 'left', 'center' or 'right'
+    :return:        bytes
+    """
+
+    lines = [encode_text(line) for line in str(text).split('\n')]
+    baseline = y + (len(lines) - 1) * LINE_SPACING * size / 2 - BASELINE_SHIFT * size
+
+    operators = [b'BT', b'/%s %s Tf' % (FONTS[bold], format_number(size)), get_color(color)]
+    for line in lines:
+        x_line = x
+        if ha != 'left':
+            width = get_text_width(line, size=size, bold=bold)
+            x_line = x - (width / 2 if ha == 'center' else width)
+        escaped = line.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+        operators.append(b'1 0 0 1 %s %s Tm (%s) Tj' % (format_number(x_line), format_number(baseline), escaped))
+        baseline -= LINE_SPACING * size
+    operators.append(b'ET')
+
+    return b'\n'.join(operators)
+
+
+def get_area_text(area, fx, fy, text, size, color, bold=True, ha='left'):
+    """
+    Builds the operators of a text placed in fractions of an area of the page (as matplotlib axes coordinates)
+
+    :param area:    name of the area (see 'AREAS')
+    :param fx:      horizontal position, fraction of the area width
+    :param fy:      vertical position, fraction of the area height
+    :return:        bytes (see 'get_text' for the other parameters)
+    """
+
+    x0, y0, x1, y1 = AREAS[area]
+
+    return get_text(text, x=x0 + fx * (x1 - x0), y=y0 + fy * (y1 - y0), size=size, color=color, bold=bold, ha=ha)
+
+
+def get_area_line(area, fy, width, color):
+    """
+    Builds the operators of an horizontal line across an area of the page (as matplotlib 'axhline')
+
+    :param area:    name of the area (see 'AREAS')
+    :param fy:      vertical position, fraction of the area height
+    :param width:   line width in points
+    :param color:   tuple (r, g, b) of floats between 0 and 1
+    :return:        bytes
+    """
+
+    x0, y0, x1, y1 = AREAS[area]
+    y = format_number(y0 + fy * (y1 - y0))
+
+    return b'q %s %s w 2 J %s %s m %s %s l S Q' % (get_color(color, stroke=True), format_number(width),
+                                                   format_number(x0), y, format_number(x1), y)
+
+
+def get_table(rows):
+    """
+    Builds the operators of the charges table, centered in area 'E' : the first and last rows are bold on a gray
+    background, the descriptions and amounts are right-aligned as in a matplotlib table
+
+    :param rows:    list of (description, amount) rows, the first one being the column labels
+    :return:        bytes
+    """
+
+    x0, y0, x1, y1 = AREAS['E']
+    table_width = sum(TABLE_WIDTHS)
+    left = (x0 + x1 - table_width) / 2
+    top = (y0 + y1 + len(rows) * TABLE_ROW_HEIGHT) / 2
+
+    operators = [b'q 1 w', get_color(BLACK, stroke=True)]
+    for i, row in enumerate(rows):
+        emphasis = i == 0 or i == len(rows) - 1
+        bottom = top - (i + 1) * TABLE_ROW_HEIGHT
+        x = left
+        for width, text in zip(TABLE_WIDTHS, row):
+            operators.append(get_color(TABLE_GRAY if emphasis else WHITE))
+            operators.append(b'%s %s %s %s re B' % (format_number(x), format_number(bottom),
+                                                    format_number(width), format_number(TABLE_ROW_HEIGHT)))
+            y = bottom + TABLE_ROW_HEIGHT / 2
+            if i == 0:
+                operators.append(get_text(text, x=x + width / 2, y=y, size=TABLE_FONT_SIZE, color=BLACK,
+                                          bold=True, ha='center'))
+            else:
+                operators.append(get_text(text, x=x + width * (1 - TABLE_PAD), y=y, size=TABLE_FONT_SIZE,
+                                          color=BLACK, bold=emphasis, ha='right'))
+            x += width
+    operators.append(b'Q')
+
+    return b'\n'.join(operators)
+
+
+def read_png(path):
+    """
+    Decodes a non-interlaced 8 bits PNG image (gray, RGB, with or without alpha) with the standard library only
+
+    :param path:    path to the PNG file
+    :return:        tuple (width, height, number of color channels, color bytes, alpha bytes or None)
+    """
+
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError(f"'{path}' is not a PNG file")
+
+    position = 8
+    idat = []
+    width = height = bit_depth = color_type = interlace = None
+    while position < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        chunk = data[position + 8:position + 8 + length]
+        if chunk_type == b'IHDR':
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif chunk_type == b'IDAT':
+            idat.append(chunk)
+        elif chunk_type == b'IEND':
+            break
+        position += 12 + length
+
+    channels = {0: 1, 2: 3, 4: 2, 6: 4}.get(color_type)
+    if bit_depth != 8 or channels is None or interlace:
+        raise ValueError(f"Unsupported PNG image '{path}' (bit depth {bit_depth}, color type {color_type}, "
+                         f"interlace {interlace})")
+
+    raw = zlib.decompress(b''.join(idat))
+    stride = width * channels
+    pixels = bytearray(height * stride)
+    previous = bytearray(stride)
+    for row in range(height):
+        start = row * (stride + 1)
+        filter_type = raw[start]
+        line = bytearray(raw[start + 1:start + 1 + stride])
+        if filter_type == 1:
+            for i in range(channels, stride):
+                line[i] = (line[i] + line[i - channels]) & 0xFF
+        elif filter_type == 2:
+            for i in range(stride):
+                line[i] = (line[i] + previous[i]) & 0xFF
+        elif filter_type == 3:
+            for i in range(stride):
+                left = line[i - channels] if i >= channels else 0
+                line[i] = (line[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif filter_type == 4:
+            for i in range(stride):
+                a = line[i - channels] if i >= channels else 0
+                b = previous[i]
+                c = previous[i - channels] if i >= channels else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                predictor = a if pa <= pb and pa <= pc else (b if pb <= pc else c)
+                line[i] = (line[i] + predictor) & 0xFF
+        pixels[row * stride:(row + 1) * stride] = line
+        previous = line
+
+    if color_type in (0, 2):
+        return width, height, channels, bytes(pixels), None
+
+    colors = channels - 1
+    color = bytearray(width * height * colors)
+    for k in range(colors):
+        color[k::colors] = pixels[k::channels]
+
+    return width, height, colors, bytes(color), bytes(pixels[colors::channels])
+
+
+def pack_gray_levels(width, colors, color):
+    """
+    Packs a gray image with at most 16 evenly spaced levels (see 'assets.prepare_image') on 4 bits per pixel
+
+    :param width:   width of the image in pixels
+    :param colors:  number of color channels
+    :param color:   color bytes, 8 bits per channel
+    :return:        tuple (bits per component, color bytes)
+    """
+
+    if colors != 1 or any(value % 17 for value in set(color)):
+        return 8, color
+
+    levels = color.translate(bytes(value // 17 for value in range(256)))
+    packed = bytearray()
+    for start in range(0, len(levels), width):
+        line = levels[start:start + width] + (b'\x00' if width % 2 else b'')
+        packed += bytes(high << 4 | low for high, low in zip(line[0::2], line[1::2]))
+
+    return 4, bytes(packed)
+
+
+class PdfDocument:
+    """
+    Minimal pdf writer : objects are written to the file as they come, so memory does not grow with the number of
+    pages. Fonts (standard, not embedded) and images are written once and shared by all the pages
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    path of the pdf file, or binary file object written from its start (left open on close)
+        """
+
+        self.owns_file = not hasattr(path, 'write')
+        self.file = open(path, 'wb') if self.owns_file else path
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self.offsets = {}
+        self.n_objects = 2  # 1 : catalog, 2 : page tree, written on close
+        self.pages = []
+        self.images = {}
+
+        self.fonts = {}
+        for bold, name in FONTS.items():
+            base_font = b'Helvetica-Bold' if bold else b'Helvetica'
+            self.fonts[name] = self.add_object(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s '
+                                               b'/Encoding /WinAnsiEncoding >>' % base_font)
+
+    def add_object(self, content, stream=None):
+        """
+        Writes a new object
+
+        :param content:     dictionary (or any pdf object) as bytes
+        :param stream:      optional stream data, already encoded : its length is added to the dictionary
+        :return:            object number
+        """
+
+        self.n_objects += 1
+        return self.write_object(self.n_objects, content, stream)
+
+    def write_object(self, number, content, stream=None):
+        """
+        Writes an object with a given number
+
+        :param number:      object number
+        :param content:     dictionary (or any pdf object) as bytes
+        :param stream:      optional stream data, already encoded : its length is added to the dictionary
+        :return:            object number
+        """
+
+        self.offsets[number] = self.file.tell()
+        self.file.write(b'%d 0 obj\n' % number)
+        if stream is None:
+            self.file.write(content)
+        else:
+            self.file.write(content[:-2] + b' /Length %d >>\nstream\n' % len(stream))
+            self.file.write(stream)
+            self.file.write(b'\nendstream')
+        self.file.write(b'\nendobj\n')
+
+        return number
+
+    def add_image(self, name, image):
+        """
+        Writes an image once for the whole document
+
+        :param name:    resource name of the image in the content streams (bytes)
+        :param image:   tuple (width, height, number of color channels, bits per color component, color bytes, alpha
+                        bytes or None), the bytes being zlib compressed
+        :return:        None
+        """
+
+        if name in self.images:
+            return
+
+        width, height, colors, bits, color, alpha = image
+        color_space = b'/DeviceGray' if colors == 1 else b'/DeviceRGB'
+        smask = b''
+        if alpha is not None:
+            smask_number = self.add_object(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+                                           b'/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode >>'
+                                           % (width, height), stream=alpha)
+            smask = b' /SMask %d 0 R' % smask_number
+        self.images[name] = self.add_object(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s '
+                                            b'/BitsPerComponent %d /Filter /FlateDecode%s >>'
+                                            % (width, height, color_space, bits, smask), stream=color)
+
+    def add_page(self, content):
+        """
+        Writes a page
+
+        :param content:     content stream of the page (uncompressed operators)
+        :return:            None
+        """
+
+        fonts = b' '.join(b'/%s %d 0 R' % (name, number) for name, number in self.fonts.items())
+        images = b' '.join(b'/%s %d 0 R' % (name, number) for name, number in self.images.items())
+        content_number = self.add_object(b'<< /Filter /FlateDecode >>', stream=zlib.compress(content))
+        self.pages.append(self.add_object(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] '
+                                          b'/Resources << /Font << %s >> /XObject << %s >> >> /Contents %d 0 R >>'
+                                          % (format_number(PAGE_WIDTH), format_number(PAGE_HEIGHT), fonts, images,
+                                             content_number)))
+
+    def get_pagecount(self):
+        """
+        :return:    number of pages written so far
+        """
+
+        return len(self.pages)
+
+    def close(self):
+        """
+        Writes the page tree, the catalog and the cross-reference table, then closes the file
+
+        :return:    None
+        """
+
+        if self.file is None or self.file.closed:
+            return
+
+        kids = b' '.join(b'%d 0 R' % number for number in self.pages)
+        self.write_object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)))
+        self.write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref = self.file.tell()
+        self.file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (self.n_objects + 1))
+        for number in range(1, self.n_objects + 1):
+            self.file.write(b'%010d 00000 n \n' % self.offsets[number])
+        self.file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                        % (self.n_objects + 1, xref))
+        if self.owns_file:
+            self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class InvoiceTemplate:
+    """
+    Invoice page built once per run : the operators of the static part and the compressed signature are computed a
+    single time, each invoice only adds the tenant block and the charges table
+    """
+
+    def __init__(self, page_layout):
+        """
+        Builds the static part of the invoice page
+
+        :param page_layout:     page description as built by 'invoice_layout.get_page_layout'
+        """
+
+        page_header = page_layout['header']
+        landlord = page_layout['landlord']
+        signature = page_layout['signature']
+
+        width, height, colors, color, alpha = read_png(signature['image_path'])
+        bits, color = pack_gray_levels(width, colors, color)
+        self.image = (width, height, colors, bits, zlib.compress(color, 9),
+                      None if alpha is None else zlib.compress(alpha, 9))
+
+        x0, y0, x1, y1 = AREAS['H']
+        image_width = signature['width']
+        image_height = height * signature['width'] / width
+        image_x = x0 + 0.72 * (x1 - x0) - image_width / 2
+        image_y = y0 + 0.65 * (y1 - y0) - image_height / 2
+
+        operators = [get_area_line('A', 0.95, width=5, color=BLUE),
+                     get_area_text('A', 0.0, 0.60, page_header['title'], size=20, color=BLUE),
+                     get_area_text('A', 0.0, 0.20, page_header['period'], size=20, color=BLUE),
+                     get_area_line('I', 0.05, width=5, color=BLUE)]
+        for fy, line in zip((0.90, 0.80), landlord['heading']):
+            operators.append(get_area_text('B', 0.05, fy, line, size=14, color=BLUE))
+        for fy, line in zip((0.68, 0.58, 0.48, 0.38), landlord['address']):
+            operators.append(get_area_text('B', 0.05, fy, line, size=14, color=GRAY))
+        operators += [get_area_text('C', 0.02, 0.90, 'Arrendatario :', size=18, color=BLUE),
+                      get_area_text('C', 0.02, 0.50, 'Departamento :', size=18, color=BLUE),
+                      get_area_text('C', 0.02, 0.20, 'Fecha de emisión :', size=18, color=BLUE),
+                      get_area_text('C', 0.02, 0.08, page_layout['issue_date'], size=18, color=GRAY),
+                      get_area_text('G', 0.02, 0.85, signature['closing'], size=18, color=GRAY),
+                      b'q %s 0 0 %s %s %s cm /Im1 Do Q' % (format_number(image_width), format_number(image_height),
+                                                           format_number(image_x), format_number(image_y)),
+                      get_area_text('H', 0.72, 0.22, signature['name'], size=15, color=GRAY, ha='center'),
+                      get_area_text('H', 0.72, 0.00, signature['role'], size=12, color=GRAY, ha='center')]
+
+        self.static_content = b'\n'.join(operators)
+
+    def render(self, tenant_layout, output):
+        """
+        Fills the page with a tenant and saves it as pdf
+
+        :param tenant_layout:   tenant description as built by 'invoice_layout.get_tenant_layout'
+        :param output:          path of the pdf file, or 'PdfDocument' to append the page to
+        :return:                None
+        """
+
+        tenant = tenant_layout['tenant']
+        charges = tenant_layout['charges']
+        content = b'\n'.join([self.static_content,
+                              get_area_text('C', 0.02, 0.78, tenant['first_name'], size=18, color=GRAY),
+                              get_area_text('C', 0.02, 0.68, tenant['last_name'], size=18, color=GRAY),
+                              get_area_text('C', 0.02, 0.38, tenant['apartment'], size=18, color=GRAY),
+                              get_table([charges['columns']] + charges['rows'] + [tenant_layout['total']])])
+
+        if isinstance(output, PdfDocument):
+            output.add_image(b'Im1', self.image)
+            output.add_page(content)
+        else:
+            with PdfDocument(output) as document:
+                document.add_image(b'Im1', self.image)
+                document.add_page(content)
+
+    def close(self):
+        """
+        Nothing to release : kept for the same interface as 'invoice_template.InvoiceTemplate'
+
+        :return:    None
+        """
+
+
+def open_document(pdf_path):
+    """
+    Opens a multi-page pdf to which 'InvoiceTemplate.render' appends pages
+
+    :param pdf_path:    path of the pdf file
+    :return:            'PdfDocument', to be closed (or used as a context manager)
+    """
+
+    return PdfDocument(pdf_path)
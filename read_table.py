@@ -1,95 +1,223 @@
 #!/usr/bin/env python
 
-import sys
+from dataclasses import dataclass
 import numpy as np
 import pandas as pd
 
+import table_schema
 
-def get_remaining_columns(columns):
+N_DECIMALS = 2
+
+
+@dataclass(slots=True)
+class TenantRecord:
+    """
+    Normalized spreadsheet row of a tenant. Amounts are rounded floats and the extra charges only hold the non-empty,
+    non-zero label/amount pairs, in the order of the spreadsheet
+    """
+
+    apartment: str
+    first_name: str
+    last_name: str
+    rent: float
+    energy: float
+    water: float
+    extra_labels: tuple = ()
+    extra_amounts: tuple = ()
+
+
+def get_column_mapping(columns):
     """
+    Computes in one go the renaming of all the spreadsheet headers : fixed columns get their fixed name and the
+    remaining columns are paired by position as 'label_i' / 'amount_i' (see 'table_schema.compile_schema')
 
-    :param columns:
-    :return:
+    :param columns: headers of the spreadsheet
+    :return:        tuple (dictionary header -> new name, number of extra label/amount pairs)
+    :raise table_schema.SchemaError: if the headers do not have the expected layout
     """
 
-    # Columns to keep
-    columns_to_keep = ["apartment", "first_name", "last_name", "rent", "water", "energy"]
-    # Select columns that are not in the specified list
-    remaining_columns = [col for col in columns if col not in columns_to_keep]
+    schema = table_schema.compile_schema(tuple(columns))
+
+    return dict(zip(columns, schema.names)), schema.n_pairs
+
+
+def read_sheets(excel_file, schemas):
+    """
+    Reads the data rows of sheets of an Excel file, opening it once : only the columns of the header of every sheet
+    are read, with the dtypes of its schema (text, or float for the amounts)
+
+    :param excel_file:  path to the Excel file
+    :param schemas:     dictionary sheet name -> 'table_schema.SheetSchema', see 'table_schema.read_sheet_schemas'
+    :return:            dictionary sheet name -> DataFrame without the empty rows, columns named as in the schema
+    :raise table_schema.SchemaError: if an amount cell is not a number
+    """
+
+    dataframes = {}
+    with pd.ExcelFile(excel_file, engine='openpyxl') as excel:
+        for sheet_name, schema in schemas.items():
+            try:
+                dataframe = excel.parse(sheet_name=sheet_name, header=None, skiprows=1,
+                                        usecols=list(range(len(schema.names))), names=list(schema.names),
+                                        dtype=schema.dtypes)
+            except ValueError:
+                # The typed load only says that a value is not a number : the cell is looked up for the message
+                table_schema.check_sheet(excel_file=excel_file, sheet_name=sheet_name, schema=schema)
+                raise
+
+            # Empty rows are not tenants, as in 'iter_sheet_records'
+            dataframes[sheet_name] = dataframe.dropna(how='all').reset_index(drop=True)
 
-    return remaining_columns
+    return dataframes
 
 
-def get_table_dictionary(dataframe):
+def get_tenant_records(dataframe, schema=None):
     """
+    Normalizes the whole spreadsheet column by column : money rounding, removal of the empty or zero extra charges and
+    compaction of the remaining ones
 
-    :param dataframe:
-    :return:
+    :param dataframe:   spreadsheet as read by 'pd.read_excel', or by 'read_sheets' if 'schema' is given
+    :param schema:      'table_schema.SheetSchema' the columns are already named after, None to map the headers
+    :return:            list of 'TenantRecord', one per row
+    :raise table_schema.SchemaError: if the headers do not have the expected layout
     """
 
-    my_columns = dataframe.columns.tolist()
-    my_columns = [element.lower() for element in my_columns]
-    dataframe.columns = my_columns
+    if schema is None:
+        mapping, n_pairs = get_column_mapping(dataframe.columns)
+        dataframe = dataframe.rename(columns=mapping)
+    else:
+        n_pairs = schema.n_pairs
+    n_rows = len(dataframe)
+
+    apartments = dataframe['apartment'].fillna('').astype(str).tolist()
+    first_names = dataframe['first_name'].fillna('').astype(str).tolist()
+    last_names = dataframe['last_name'].fillna('').astype(str).tolist()
+    fixed_amounts = dataframe[['rent', 'energy', 'water']].to_numpy(dtype=float).round(N_DECIMALS).tolist()
+
+    # Extra charges as (rows, pairs) matrices : a pair is kept if its label is filled and its amount non-zero
+    labels = dataframe[[f'label_{k}' for k in range(n_pairs)]].to_numpy(dtype=object).reshape(n_rows, n_pairs)
+    amounts = dataframe[[f'amount_{k}' for k in range(n_pairs)]].to_numpy(dtype=float).reshape(n_rows, n_pairs)
+    amounts = amounts.round(N_DECIMALS)
+    keep = ~pd.isna(labels) & (labels != '') & ~np.isnan(amounts) & (amounts != 0.0)
+
+    rows, pairs = np.nonzero(keep)
+    bounds = np.searchsorted(rows, np.arange(n_rows + 1)).tolist()
+    kept_labels = [str(label) for label in labels[rows, pairs]]
+    kept_amounts = amounts[rows, pairs].tolist()
+
+    return [TenantRecord(apartment=apartments[i],
+                         first_name=first_names[i],
+                         last_name=last_names[i],
+                         rent=fixed_amounts[i][0],
+                         energy=fixed_amounts[i][1],
+                         water=fixed_amounts[i][2],
+                         extra_labels=tuple(kept_labels[bounds[i]:bounds[i + 1]]),
+                         extra_amounts=tuple(kept_amounts[bounds[i]:bounds[i + 1]]))
+            for i in range(n_rows)]
+
+
+def round_amount(value):
+    """
+    Rounds a single spreadsheet amount the same way as the column-wise normalization
 
-    for col in dataframe.columns:
+    :param value:   cell value, None if the cell is empty
+    :return:        rounded float, NaN for an empty cell
+    """
 
-        if "depa" in col:
-            dataframe.rename(columns={col: 'apartment'}, inplace=True)
-        elif "nombre" in col:
-            dataframe.rename(columns={col: 'first_name'}, inplace=True)
-        elif "apellido" in col:
-            dataframe.rename(columns={col: 'last_name'}, inplace=True)
-        elif "alquiler" in col:
-            dataframe.rename(columns={col: 'rent'}, inplace=True)
-        elif "agua" in col:
-            dataframe.rename(columns={col: 'water'}, inplace=True)
-        elif "luz" in col:
-            dataframe.rename(columns={col: 'energy'}, inplace=True)
+    if value is None or value == '':
+        return float('nan')
 
-    remaining_columns = get_remaining_columns(dataframe.columns)
+    return float(np.round(float(value), N_DECIMALS))
 
-    # check remaining_columns are in an even number:
-    if len(remaining_columns) % 2 != 0:
-        print("Error: Número de columnas addicionales no es par.")
-        sys.exit(1)
 
-    paired_list = [(remaining_columns[i], remaining_columns[i + 1]) for i in range(0, len(remaining_columns), 2)]
+def get_row_record(row, columns):
+    """
+    Normalizes a single spreadsheet row (same rules as 'get_tenant_records')
 
-    for i, (label, amount) in enumerate(paired_list):
-        dataframe.rename(columns={label: f'label_{i}'}, inplace=True)
-        dataframe.rename(columns={amount: f'amount_{i}'}, inplace=True)
+    :param row:         tuple of cell values
+    :param columns:     dictionary normalized column name -> position in the row
+    :return:            'TenantRecord'
+    """
 
-    # remaining columns with new labels
-    remaining_columns = get_remaining_columns(dataframe.columns)
-    paired_list = [(remaining_columns[i], remaining_columns[i + 1]) for i in range(0, len(remaining_columns), 2)]
+    extra_labels = []
+    extra_amounts = []
+    k = 0
+    while f'label_{k}' in columns:
+        label = row[columns[f'label_{k}']]
+        amount = round_amount(row[columns[f'amount_{k}']])
+        if label is not None and label != '' and not np.isnan(amount) and amount != 0.0:
+            extra_labels.append(str(label))
+            extra_amounts.append(amount)
+        k += 1
+
+    apartment = row[columns['apartment']]
+    first_name = row[columns['first_name']]
+    last_name = row[columns['last_name']]
+
+    return TenantRecord(apartment='' if apartment is None else str(apartment),
+                        first_name='' if first_name is None else str(first_name),
+                        last_name='' if last_name is None else str(last_name),
+                        rent=round_amount(row[columns['rent']]),
+                        energy=round_amount(row[columns['energy']]),
+                        water=round_amount(row[columns['water']]),
+                        extra_labels=tuple(extra_labels),
+                        extra_amounts=tuple(extra_amounts))
+
+
+def iter_sheet_records(worksheet, max_col=16):
+    """
+    Streams the tenants of a worksheet opened in read-only mode, one normalized record at a time : only the current
+    row is held in memory
 
-    n_decimals = 2
-    entries = []
+    :param worksheet:   openpyxl read-only worksheet, headers in the first row
+    :param max_col:     number of columns read, 16 matches the 'A:P' range of 'pd.read_excel'
+    :return:            generator of 'TenantRecord'
+    :raise table_schema.SchemaError: if the header is invalid (before the first record) or an amount is not a number
+    """
 
-    for index, row in dataframe.iterrows():
-        # Fixed label amounts
-        # Personal data
-        entries_in_row = {'apartment': str(row['apartment']),
-                          'first_name': row['first_name'],
-                          'last_name': row['last_name'],
-                          'rent': "{:.{}f}".format(float(row['rent']), n_decimals),
-                          'energy': "{:.{}f}".format(float(row['energy']), n_decimals),
-                          'water': "{:.{}f}".format(float(row['water']), n_decimals)
-                          }
+    schema = table_schema.get_sheet_schema(worksheet, sheet_name=worksheet.title)
 
-        # Variable labels and their amounts
-        cnt_recoded_label = 0
-        for (label_key, amount_key) in paired_list:
+    for row_number, row in enumerate(worksheet.iter_rows(min_row=2, max_col=max_col, values_only=True), start=2):
+        if all(value is None for value in row):
+            continue
+        try:
+            yield get_row_record(row=row, columns=schema.positions)
+        except (TypeError, ValueError):
+            try:
+                schema.check_row(row, row_number)
+            except table_schema.SchemaError as e:
+                raise table_schema.SchemaError(f"sheet '{worksheet.title}': {e}") from None
+            raise
 
-            if row[label_key] is not None and row[label_key] != '' and not pd.isna(row[amount_key]):
-                if row[amount_key] != 0.0:
-                    entries_in_row[f'label_{cnt_recoded_label}'] = row[label_key]
-                    entries_in_row[f'amount_{cnt_recoded_label}'] = np.round(float(row[amount_key]), decimals=n_decimals)
-                    cnt_recoded_label += 1
-            else:
-                continue
 
-        entries.append(entries_in_row)
+def iter_workbook_records(excel_file, sheet_names=("CSV",)):
+    """
+    Streams the tenants of several sheets (e.g. one per property) in a single pass over the Excel file
 
-    return entries
+    :param excel_file:  path to the Excel file
+    :param sheet_names: names of the sheets to read, in this order. None reads every sheet
+    :return:            generator of tuples (sheet name, 'TenantRecord')
+    """
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        if sheet_names is None:
+            sheet_names = workbook.sheetnames
+        for sheet_name in sheet_names:
+            for record in iter_sheet_records(table_schema.get_worksheet(workbook, sheet_name)):
+                yield sheet_name, record
+    finally:
+        workbook.close()
+
+
+def get_table_dictionary(dataframe, schema=None):
+    """
+    Normalizes the spreadsheet into one record per tenant
+
+    :param dataframe:   spreadsheet as read by 'pd.read_excel', or by 'read_sheets' if 'schema' is given
+    :param schema:      'table_schema.SheetSchema' of the sheet, see 'get_tenant_records'
+    :return:            list of 'TenantRecord', one per row (see 'get_tenant_records')
+    """
 
+    return get_tenant_records(dataframe=dataframe, schema=schema)
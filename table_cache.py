@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import zipfile
+
+import instrumentation
+
+# Bump when the normalization of the sheets ('read_table.get_tenant_records') changes, so that old entries are ignored
+CACHE_VERSION = 3
+
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+INDEX_FILENAME = "index.json"
+
+# Errors of a cache folder or index that cannot be used (folder not writable, index not as expected) : the cache is
+# turned off for the run
+CACHE_ERRORS = (OSError, ValueError, KeyError, TypeError)
+
+# Errors of a cache entry that cannot be read (truncated or corrupt '.npz', missing array) : the entry is a miss
+ENTRY_ERRORS = (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile)
+
+# Fields of 'read_table.TenantRecord' stored as one array each
+STRING_FIELDS = ("apartment", "first_name", "last_name")
+AMOUNT_FIELDS = ("rent", "energy", "water")
+
+
+def get_default_cache_dir():
+    """
+    :return:    folder of the cache in the home of the current user, looked up at every call (not at import, so that
+                a changed HOME, e.g. in the tests, is followed)
+    """
+
+    return os.path.join(os.path.expanduser("~"), ".cache", "invoice_generator")
+
+
+def get_file_hash(path):
+    """
+    :param path:    path to a file
+    :return:        hexadecimal sha256 digest of its content
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def records_to_arrays(records, prefix):
+    """
+    Converts tenant records to columns : one array per field, the variable-length extra charges being flattened with
+    the offsets of every tenant
+
+    :param records: list of 'read_table.TenantRecord'
+    :param prefix:  prefix of the array names
+    :return:        dictionary array name -> numpy array
+    """
+
+    import numpy as np
+
+    arrays = {}
+    for field in STRING_FIELDS:
+        arrays[prefix + field] = np.array([getattr(record, field) for record in records], dtype=str)
+    for field in AMOUNT_FIELDS:
+        arrays[prefix + field] = np.array([getattr(record, field) for record in records], dtype=float)
+
+    arrays[prefix + "extra_offsets"] = np.cumsum([0] + [len(record.extra_labels) for record in records])
+    arrays[prefix + "extra_labels"] = np.array([label for record in records for label in record.extra_labels],
+                                               dtype=str)
+    arrays[prefix + "extra_amounts"] = np.array([amount for record in records for amount in record.extra_amounts],
+                                                dtype=float)
+
+    return arrays
+
+
+def arrays_to_records(arrays, prefix):
+    """
+    Rebuilds the tenant records stored by 'records_to_arrays'
+
+    :param arrays:  mapping array name -> numpy array
+    :param prefix:  prefix of the array names
+    :return:        list of 'read_table.TenantRecord'
+    """
+
+    import read_table
+
+    columns = {field: arrays[prefix + field].tolist() for field in STRING_FIELDS + AMOUNT_FIELDS}
+    offsets = arrays[prefix + "extra_offsets"].tolist()
+    labels = arrays[prefix + "extra_labels"].tolist()
+    amounts = arrays[prefix + "extra_amounts"].tolist()
+
+    return [read_table.TenantRecord(apartment=columns['apartment'][i],
+                                    first_name=columns['first_name'][i],
+                                    last_name=columns['last_name'][i],
+                                    rent=columns['rent'][i],
+                                    energy=columns['energy'][i],
+                                    water=columns['water'][i],
+                                    extra_labels=tuple(labels[offsets[i]:offsets[i + 1]]),
+                                    extra_amounts=tuple(amounts[offsets[i]:offsets[i + 1]]))
+            for i in range(len(offsets) - 1)]
+
+
+class TableCache:
+    """
+    Cache of the normalized sheets of the Excel files, stored as numpy arrays ('.npz') so that a run on an unchanged
+    file skips the Excel parsing. Entries are keyed by the content hash of the file, found from its path, size and
+    modification time without reading it again. A modified file gets a new key, and the least recently used entries
+    are removed once the cache is larger than 'max_bytes'. The cache never fails a run : if its folder or index
+    cannot be written (e.g. HOME being a file), it is turned off for the rest of the run and the sheets are parsed
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=MAX_CACHE_BYTES):
+        """
+        :param cache_dir:   folder of the cache, created on first use. None for 'get_default_cache_dir'
+        :param max_bytes:   maximum size of the cached tables
+        """
+
+        self.cache_dir = get_default_cache_dir() if cache_dir is None else cache_dir
+        self.max_bytes = max_bytes
+        self.disabled = False
+
+    def disable(self, error, metrics=None):
+        """
+        Turns the cache off after an error, which is logged once
+
+        :param error:   exception raised by the cache
+        :param metrics: 'instrumentation.RunMetrics' of the run, a new one if None
+        :return:        None
+        """
+
+        if self.disabled:
+            return
+
+        if metrics is None:
+            metrics = instrumentation.RunMetrics()
+        metrics.log("cache_error", f"Cache '{self.cache_dir}' not used: {type(error).__name__}: {error}",
+                    cache_dir=self.cache_dir, error=f"{type(error).__name__}: {error}")
+        self.disabled = True
+
+    def load_index(self):
+        """
+        :return:    dictionary absolute file path -> {'size', 'mtime_ns', 'sha256'}, empty if there is no index
+        """
+
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILENAME), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        """
+        Writes the index of the cache, replacing the previous one atomically
+
+        :param index:   dictionary absolute file path -> {'size', 'mtime_ns', 'sha256'}
+        :return:        None
+        """
+
+        path = os.path.join(self.cache_dir, INDEX_FILENAME)
+        with open(path + f".{os.getpid()}.tmp", "w", encoding="utf-8") as file:
+            json.dump(index, file, indent=1, sort_keys=True)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+
+    def get_content_hash(self, excel_file):
+        """
+        Returns the content hash of a file, hashing it only if its size or modification time changed since last time
+
+        :param excel_file:  path to the Excel file
+        :return:            hexadecimal sha256 digest
+        """
+
+        path = os.path.abspath(excel_file)
+        stat = os.stat(path)
+
+        index = self.load_index()
+        entry = index.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        content_hash = get_file_hash(path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index = {other: entry for other, entry in index.items() if os.path.exists(other)}
+        index[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": content_hash}
+        self.save_index(index)
+
+        return content_hash
+
+    def get_entry_path(self, excel_file, sheet_names, usecols):
+        """
+        :param excel_file:  path to the Excel file
+        :param sheet_names: names of the sheets read
+        :param usecols:     range of the columns read, part of the key
+        :return:            path of the cache entry of these sheets of the file
+        """
+
+        options = json.dumps({"version": CACHE_VERSION, "sheets": list(sheet_names), "usecols": usecols})
+        options_hash = hashlib.sha256(options.encode("utf-8")).hexdigest()[:16]
+
+        return os.path.join(self.cache_dir, f"{self.get_content_hash(excel_file)}_{options_hash}.npz")
+
+    def load(self, excel_file, sheet_names, usecols, metrics=None):
+        """
+        Reads the cached records of sheets of a file
+
+        :param excel_file:  path to the Excel file
+        :param sheet_names: names of the sheets
+        :param usecols:     range of the columns read, part of the key
+        :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+        :return:            dictionary sheet name -> list of 'read_table.TenantRecord', None if not cached
+        """
+
+        import numpy as np
+
+        if self.disabled:
+            return None
+
+        try:
+            path = self.get_entry_path(excel_file, sheet_names, usecols)
+        except CACHE_ERRORS as e:
+            self.disable(e, metrics=metrics)
+            return None
+
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                records = {sheet_name: arrays_to_records(arrays, prefix=f"{i}_")
+                           for i, sheet_name in enumerate(sheet_names)}
+        except FileNotFoundError:
+            return None
+        except ENTRY_ERRORS as e:
+            if metrics is None:
+                metrics = instrumentation.RunMetrics()
+            metrics.log("cache_ignored", f"Cache entry '{path}' ignored: {e}", path=path, error=str(e))
+            return None
+
+        # Marks the entry as recently used for the eviction, a read-only cache is still read
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return records
+
+    def store(self, excel_file, sheet_names, usecols, records, metrics=None):
+        """
+        Caches the records of sheets of a file and evicts the least recently used entries if the cache is too large
+
+        :param excel_file:  path to the Excel file
+        :param sheet_names: names of the sheets
+        :param usecols:     range of the columns read, part of the key
+        :param records:     dictionary sheet name -> list of 'read_table.TenantRecord'
+        :param metrics:     'instrumentation.RunMetrics' of the run, a new one if None
+        :return:            None
+        """
+
+        import numpy as np
+
+        if self.disabled:
+            return
+
+        arrays = {}
+        for i, sheet_name in enumerate(sheet_names):
+            arrays.update(records_to_arrays(records[sheet_name], prefix=f"{i}_"))
+
+        temporary_path = None
+        try:
+            path = self.get_entry_path(excel_file, sheet_names, usecols)
+            temporary_path = path + f".{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as file:
+                np.savez(file, **arrays)
+            os.replace(temporary_path, path)
+            self.evict()
+        except CACHE_ERRORS as e:
+            if temporary_path is not None:
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+            self.disable(e, metrics=metrics)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in 'max_bytes'
+
+        :return:    None
+        """
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Removes every entry of the cache
+
+        :return:    None
+        """
+
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz") or entry.name == INDEX_FILENAME:
+                os.remove(entry.path)
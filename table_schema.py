@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Substring of a (lower case) header -> fixed column name, checked in this order
+FIXED_COLUMNS = {"depa": "apartment",
+                 "nombre": "first_name",
+                 "apellido": "last_name",
+                 "alquiler": "rent",
+                 "agua": "water",
+                 "luz": "energy"}
+
+# Exact (lower case, stripped) header -> name of the columns a sheet may have or not : the e-mail addresses of the
+# tenants (see 'invoice_mail'). Matched exactly, not as substrings, so that an extra charge such as 'Mailbox' stays
+# an extra charge
+OPTIONAL_COLUMNS = {"correo": "email",
+                    "email": "email"}
+
+# Fixed columns holding money amounts : the 'amount_i' columns of the extra charges are numeric as well
+AMOUNT_COLUMNS = ("rent", "energy", "water")
+
+# Number of columns read, the 'A:P' range
+MAX_COLUMNS = 16
+
+
+class SchemaError(ValueError):
+    """
+    A sheet does not have the expected layout (header row or cell types) : the message names the sheet, the column
+    and the row at fault
+    """
+
+
+def get_column_letter(position):
+    """
+    :param position:    position of a column, 0 for 'A'
+    :return:            spreadsheet letters of the column, e.g. 'AB'
+    """
+
+    letters = ""
+    position += 1
+    while position:
+        position, remainder = divmod(position - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+
+    return letters
+
+
+def get_column_name(column):
+    """
+    Maps a spreadsheet header to its fixed (header containing the key) or optional (header equal to the key) column
+    name
+
+    :param column:  lower case header of the spreadsheet
+    :return:        fixed (or optional) column name, or the header itself if it is neither
+    """
+
+    for key, name in FIXED_COLUMNS.items():
+        if key in column:
+            return name
+
+    return OPTIONAL_COLUMNS.get(column.strip(), column)
+
+
+@dataclass(frozen=True, slots=True)
+class SheetSchema:
+    """
+    Column plan of a sheet, compiled once per header layout (see 'compile_schema') : normalized name of every column
+    read ('names', and 'positions' the other way round) and positions of the numeric ones. Fixed columns get their
+    fixed name, the remaining ones are paired by position as 'label_i' / 'amount_i'
+    """
+
+    header: tuple
+    names: tuple
+    n_pairs: int
+    positions: dict
+    amount_positions: tuple
+
+    @property
+    def dtypes(self):
+        """
+        :return:    dictionary normalized column name -> dtype of the column ('pd.read_excel' 'dtype')
+        """
+
+        return {name: float if i in self.amount_positions else str for i, name in enumerate(self.names)}
+
+    def describe_column(self, position):
+        """
+        :param position:    position of a column
+        :return:            header and letter of the column, for the error messages
+        """
+
+        return f"'{self.header[position]}' ({get_column_letter(position)})"
+
+    def check_row(self, row, row_number):
+        """
+        Checks that the amount cells of a row are numbers or empty
+
+        :param row:         tuple of cell values
+        :param row_number:  row number in the sheet, 1 for the header
+        :return:            None
+        :raise SchemaError: on the first amount cell holding something else than a number
+        """
+
+        for position in self.amount_positions:
+            value = row[position] if position < len(row) else None
+            if value is None or value == '':
+                continue
+            try:
+                float(value)
+            except (TypeError, ValueError):
+                raise SchemaError(f"column {self.describe_column(position)}, row {row_number}: "
+                                  f"'{value}' is not a number") from None
+
+
+@lru_cache(maxsize=64)
+def compile_schema(header):
+    """
+    Validates a header row and compiles its column plan. Plans are cached by header, the sheets of a month (or of
+    several properties) sharing the same layout are only checked once
+
+    :param header:      tuple of the header cells, without the trailing empty ones
+    :return:            'SheetSchema'
+    :raise SchemaError: if a fixed column is missing, if a fixed or optional column is found twice, or if the extra
+                        columns are not label/amount pairs
+    """
+
+    names = [get_column_name(str(column).lower()) for column in header]
+
+    missing = [f"'{name}' (header containing '{key}')" for key, name in FIXED_COLUMNS.items() if name not in names]
+    if missing:
+        raise SchemaError(f"missing column {', '.join(missing)}")
+
+    named_columns = list(FIXED_COLUMNS.values()) + list(dict.fromkeys(OPTIONAL_COLUMNS.values()))
+    for name in named_columns:
+        positions = [i for i, other in enumerate(names) if other == name]
+        if len(positions) > 1:
+            columns = ", ".join(f"'{header[i]}' ({get_column_letter(i)})" for i in positions)
+            raise SchemaError(f"columns {columns} are all read as '{name}'")
+
+    remaining = [i for i, name in enumerate(names) if name not in named_columns]
+    if len(remaining) % 2 != 0:
+        raise SchemaError(f"the {len(remaining)} extra columns must come in label/amount pairs : column "
+                          f"'{header[remaining[-1]]}' ({get_column_letter(remaining[-1])}) has no amount column")
+
+    for i in range(len(remaining) // 2):
+        names[remaining[2 * i]] = f'label_{i}'
+        names[remaining[2 * i + 1]] = f'amount_{i}'
+
+    return SheetSchema(header=tuple(header),
+                       names=tuple(names),
+                       n_pairs=len(remaining) // 2,
+                       positions={name: i for i, name in enumerate(names)},
+                       amount_positions=tuple(i for i, name in enumerate(names)
+                                              if name in AMOUNT_COLUMNS or name.startswith('amount_')))
+
+
+def read_header(worksheet, max_col=MAX_COLUMNS):
+    """
+    Reads the first row of a worksheet opened in read-only mode, without going through the data rows
+
+    :param worksheet:   openpyxl read-only worksheet
+    :param max_col:     number of columns read
+    :return:            tuple of the header cells without the trailing empty ones, empty if the sheet is empty
+    """
+
+    header = list(next(worksheet.iter_rows(max_row=1, max_col=max_col, values_only=True), ()))
+    while header and header[-1] is None:
+        header.pop()
+
+    return tuple(header)
+
+
+def get_worksheet(workbook, sheet_name):
+    """
+    :param workbook:    openpyxl workbook
+    :param sheet_name:  name of the sheet
+    :return:            the worksheet
+    :raise SchemaError: if the workbook has no such sheet
+    """
+
+    if sheet_name not in workbook.sheetnames:
+        raise SchemaError(f"sheet '{sheet_name}' not found, the sheets are {workbook.sheetnames}")
+
+    return workbook[sheet_name]
+
+
+def get_sheet_schema(worksheet, sheet_name):
+    """
+    :param worksheet:   openpyxl read-only worksheet, headers in the first row
+    :param sheet_name:  name of the sheet, for the error messages
+    :return:            'SheetSchema' of the sheet
+    :raise SchemaError: if the header row is missing or invalid
+    """
+
+    header = read_header(worksheet)
+    if not header:
+        raise SchemaError(f"sheet '{sheet_name}' has no header row")
+
+    try:
+        return compile_schema(header)
+    except SchemaError as e:
+        raise SchemaError(f"sheet '{sheet_name}': {e}") from None
+
+
+def read_sheet_schemas(excel_file, sheet_names):
+    """
+    Validates the header rows of sheets of an Excel file before their data is parsed : only the first row of every
+    sheet is read, a bad file is rejected in milliseconds
+
+    :param excel_file:  path to the Excel file
+    :param sheet_names: names of the sheets
+    :return:            dictionary sheet name -> 'SheetSchema'
+    :raise SchemaError: if a sheet is missing or has an invalid header
+    """
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        return {sheet_name: get_sheet_schema(get_worksheet(workbook, sheet_name), sheet_name)
+                for sheet_name in sheet_names}
+    finally:
+        workbook.close()
+
+
+def check_sheet(excel_file, sheet_name, schema):
+    """
+    Looks for the first amount cell of a sheet that is not a number, to explain why the typed load failed
+
+    :param excel_file:  path to the Excel file
+    :param sheet_name:  name of the sheet
+    :param schema:      'SheetSchema' of the sheet
+    :return:            None if every amount cell is a number
+    :raise SchemaError: naming the first cell that is not
+    """
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = get_worksheet(workbook, sheet_name).iter_rows(min_row=2, max_col=len(schema.names), values_only=True)
+        for row_number, row in enumerate(rows, start=2):
+            try:
+                schema.check_row(row, row_number)
+            except SchemaError as e:
+                raise SchemaError(f"sheet '{sheet_name}': {e}") from None
+    finally:
+        workbook.close()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the generator are flat scripts at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Invoices are only saved to pdf
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+@pytest.fixture(autouse=True)
+def home_dir(tmp_path_factory, monkeypatch):
+    """
+    Points HOME at a temporary folder, so that the default cache, asset and ledger paths never touch the real ones
+    """
+
+    home = tmp_path_factory.mktemp("home")
+    monkeypatch.setenv("HOME", str(home))
+
+    return home
@@ -0,0 +1,27 @@
+import io
+import json
+
+import batch_gen
+import benchmark
+import instrumentation
+import table_schema
+
+
+def test_headers_read_once_per_workbook(tmp_path, monkeypatch):
+    benchmark.make_workbook(str(tmp_path / "recibos.xlsx"), n_tenants=3, n_pairs=1)
+    jobs = [dict(benchmark.get_entries("recibos.xlsx", output_dir=f"recibos_{month.lower()}", renderer="pdf"),
+                 month=month) for month in ("Setiembre", "Octubre")]
+    (tmp_path / "lote.json").write_text(json.dumps(jobs), encoding="utf-8")
+    calls = []
+    read_sheet_schemas = table_schema.read_sheet_schemas
+
+    def counted_read_sheet_schemas(excel_file, sheet_names):
+        calls.append((excel_file, sheet_names))
+        return read_sheet_schemas(excel_file, sheet_names)
+
+    monkeypatch.setattr(table_schema, "read_sheet_schemas", counted_read_sheet_schemas)
+    runs = batch_gen.read_batch_file(str(tmp_path / "lote.json"))
+
+    assert batch_gen.make_batch_invoices(runs, metrics=instrumentation.RunMetrics(stream=io.StringIO())) == []
+    assert calls == [(str(tmp_path / "recibos.xlsx"), ["CSV"])]
+    assert len(list((tmp_path / "recibos_octubre").glob("*.pdf"))) == 3
@@ -0,0 +1,122 @@
+import io
+import json
+import os
+
+import pytest
+
+import benchmark
+import instrumentation
+import invoice_gen
+import invoice_sink
+
+
+class FailingLedger:
+    """
+    Ledger recording the jobs and failing when written, as a full disk would
+    """
+
+    path = "ledger.sqlite"
+
+    def list_jobs(self, jobs):
+        yield from jobs
+
+    def record_jobs(self, jobs, path=None):
+        yield from jobs
+
+    def record_results(self, results):
+        yield from results
+
+    def save(self, complete):
+        raise OSError("disk full")
+
+
+def get_events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+@pytest.fixture
+def entries(tmp_path):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=3, n_pairs=1)
+
+    return benchmark.get_entries(excel_file, output_dir=str(tmp_path / "recibos"), renderer="pdf")
+
+
+def test_archive_run_reports_sizes(entries):
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    sink = invoice_sink.ArchiveSink(os.path.join(entries['output'], "recibos.zip"))
+
+    assert invoice_gen.make_invoice(entries, metrics=metrics, sink=sink) == []
+
+    sizes = [event for event in get_events(stream) if event['event'] == "sizes"]
+    assert len(sizes) == 1 and sizes[0]['pages'] == 3
+    assert os.listdir(entries['output']) == ["recibos.zip"]
+
+
+def test_building_summary_event(entries):
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    invoice_gen.make_invoice(entries, metrics=metrics)
+    metrics.report()
+
+    events = [event['event'] for event in get_events(stream)]
+    # The summary of the building is not mistaken for the summary of the run
+    assert events.count("building_summary") == 1
+    assert events.count("summary") == 1 and events[-1] == "summary"
+
+
+def test_archive_aborted_when_the_ledger_fails(entries):
+    metrics = instrumentation.RunMetrics(stream=io.StringIO())
+    sink = invoice_sink.ArchiveSink(os.path.join(entries['output'], "recibos.zip"))
+
+    with pytest.raises(OSError, match="disk full"):
+        invoice_gen.make_invoice(entries, metrics=metrics, sink=sink, ledger=FailingLedger())
+
+    assert sink.closed
+    assert not os.path.exists(entries['output']) or os.listdir(entries['output']) == []
+
+
+def test_template_released_after_a_run(entries):
+    invoice_gen.make_invoice(entries, metrics=instrumentation.RunMetrics(stream=io.StringIO()))
+
+    assert invoice_gen._template is None
+
+
+def test_template_kept_across_runs(entries):
+    metrics = instrumentation.RunMetrics(stream=io.StringIO())
+    with invoice_gen.keep_template():
+        invoice_gen.make_invoice(entries, metrics=metrics)
+        template = invoice_gen._template
+        assert template is not None
+        invoice_gen.make_invoice(entries, metrics=metrics, force=True)
+        assert invoice_gen._template is template
+
+    assert invoice_gen._template is None
+
+
+class WorkerCrash:
+    """
+    Job field killing the worker that unpickles it, as the system would kill a worker out of memory
+    """
+
+    def __init__(self):
+        self.exit_code = 1
+
+    def __setstate__(self, state):
+        os._exit(state['exit_code'])
+
+
+def test_dead_worker_fails_the_jobs_in_flight_only(entries):
+    os.makedirs(entries['output'])
+    records = invoice_gen.load_records(entries['excel'], metrics=instrumentation.RunMetrics(stream=io.StringIO()))
+    header = invoice_gen.build_invoice_header(entries)
+    jobs = list(invoice_gen.iter_invoice_jobs(entries, records=records * 8, header=header))
+    jobs[1]['crash'] = WorkerCrash()
+
+    results = list(invoice_gen.iter_rendered_results(jobs, workers=2))
+
+    assert [result[0] for result in results] == [job['output_filename'] for job in jobs]
+    assert results[1][1].startswith("BrokenProcessPool")
+    # At most the 8 jobs in flight with it fail, the next ones are rendered by a new pool
+    assert all(error is None for output_filename, error, timings, data in results[9:])
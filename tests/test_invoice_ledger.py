@@ -0,0 +1,159 @@
+import csv
+import io
+import os
+import sqlite3
+
+import openpyxl
+import pytest
+
+import benchmark
+import instrumentation
+import invoice_gen
+import invoice_ledger
+
+
+@pytest.fixture
+def entries(tmp_path):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=3, n_pairs=1)
+
+    return benchmark.get_entries(excel_file, output_dir=str(tmp_path / "recibos"), renderer="pdf")
+
+
+def write_sheet(path, rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "CSV"
+    sheet.append(["DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "AGUA", "LUZ", "CONCEPTO", "MONTO"])
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return invoice_ledger.InvoiceLedger(str(tmp_path / "ledger.sqlite"))
+
+
+def get_property_entries(tmp_path, property_name, rows):
+    """
+    Run of a property of October 2026, whose sheet holds the given rows
+    """
+
+    excel_file = str(tmp_path / f"{property_name.lower()}.xlsx")
+    write_sheet(excel_file, rows)
+    entries = benchmark.get_entries(excel_file, output_dir=str(tmp_path / property_name.lower()), renderer="pdf")
+    entries['property'] = property_name
+
+    return entries
+
+
+ANA = ["101", "Ana", "Quispe", 500, 10, 30, "Cochera", 50]
+LUIS = ["102", "Luis", "Mamani", 600, 20.5, 40, None, None]
+ROSA = ["101", "Rosa", "Huaman", 700, 15, 35, "Limpieza", 12.25]
+
+
+def run(entries, ledger, **kwargs):
+    return invoice_gen.make_invoice(entries, metrics=instrumentation.RunMetrics(stream=io.StringIO()), ledger=ledger,
+                                    **kwargs)
+
+
+def read_invoices(ledger):
+    with sqlite3.connect(ledger.path) as connection:
+        return connection.execute("SELECT apartment, issue_date FROM invoices ORDER BY apartment").fetchall()
+
+
+def test_skipped_invoices_keep_their_rows(entries, tmp_path):
+    ledger = invoice_ledger.InvoiceLedger(str(tmp_path / "ledger.sqlite"))
+    assert run(entries, ledger) == []
+    with sqlite3.connect(ledger.path) as connection:
+        connection.execute("UPDATE invoices SET issue_date = '01/10/2026'")
+
+    # Nothing changed : every invoice is skipped, its row (and issue date) is left as it was
+    assert run(entries, ledger) == []
+    assert read_invoices(ledger) == [("100", "01/10/2026"), ("101", "01/10/2026"), ("102", "01/10/2026")]
+
+    run(entries, ledger, force=True)
+    assert all(issue_date != "01/10/2026" for apartment, issue_date in read_invoices(ledger))
+
+
+def test_rows_written_in_batches(entries, tmp_path, monkeypatch):
+    ledger = invoice_ledger.InvoiceLedger(str(tmp_path / "ledger.sqlite"), batch_size=2)
+    batches = []
+    write_rows = ledger.write_rows
+
+    def counted_write_rows():
+        batches.append(len(ledger.rows))
+        write_rows()
+
+    monkeypatch.setattr(ledger, "write_rows", counted_write_rows)
+    run(entries, ledger)
+
+    # Two invoices written while rendering, the last one when the run is saved
+    assert batches == [2, 1]
+    assert not ledger.pending and not ledger.rows
+    assert len(read_invoices(ledger)) == 3
+
+
+def test_rerun_replaces_the_rows_of_the_period(tmp_path, ledger):
+    entries = get_property_entries(tmp_path, "COLQUEPATA", [ANA, LUIS])
+    run(entries, ledger)
+    write_sheet(entries['excel'], [ANA[:3] + [550] + ANA[4:], LUIS])
+    run(entries, ledger)
+
+    columns, rows = invoice_ledger.query_invoices(ledger.path, year=2026, month=10)
+    assert [row[:7] for row in rows] == [("COLQUEPATA", 2026, 10, "101", "Ana", "Quispe", 640.0),
+                                         ("COLQUEPATA", 2026, 10, "102", "Luis", "Mamani", 660.5)]
+    assert rows[0][7] == os.path.abspath(os.path.join(entries['output'], "2026_octubre_depa_101_quispe.pdf"))
+
+    columns, rows = invoice_ledger.query_invoices(ledger.path, apartment="101", charges=True)
+    assert [row[6:] for row in rows] == [("rent", "Renta Octubre 2026", 550.0),
+                                         ("water", "Agua del 01/09/26 al 30/09/26", 10.0),
+                                         ("energy", "Luz del 01/09/26 al 30/09/26", 30.0),
+                                         ("extra", "Cochera", 50.0)]
+
+
+def test_removed_tenant_row_deleted(tmp_path, ledger):
+    entries = get_property_entries(tmp_path, "COLQUEPATA", [ANA, LUIS])
+    run(entries, ledger)
+    write_sheet(entries['excel'], [ANA])
+    run(entries, ledger)
+
+    assert read_invoices(ledger)[0][0] == "101" and len(read_invoices(ledger)) == 1
+    with sqlite3.connect(ledger.path) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM charges").fetchone() == (4,)
+
+
+def test_totals_grouped_by_property(tmp_path, ledger):
+    run(get_property_entries(tmp_path, "COLQUEPATA", [ANA, LUIS]), ledger)
+    run(get_property_entries(tmp_path, "QUIPAYPAMPA", [ROSA]), ledger)
+
+    columns, rows = invoice_ledger.aggregate_invoices(ledger.path, group_by="property")
+    assert columns == ["property", "rent", "water", "energy", "extra", "total", "invoices"]
+    assert rows == [("COLQUEPATA", 1100.0, 30.5, 70.0, 50.0, 1250.5, 2),
+                    ("QUIPAYPAMPA", 700.0, 15.0, 35.0, 12.25, 762.25, 1)]
+
+    columns, rows = invoice_ledger.aggregate_invoices(ledger.path, group_by="apartment", apartment="101")
+    assert [(row[0], row[1], row[6]) for row in rows] == [("COLQUEPATA", "101", 590.0),
+                                                          ("QUIPAYPAMPA", "101", 762.25)]
+
+
+def test_command_line_queries(tmp_path, ledger, capsys):
+    run(get_property_entries(tmp_path, "COLQUEPATA", [ANA, LUIS]), ledger)
+    run(get_property_entries(tmp_path, "QUIPAYPAMPA", [ROSA]), ledger)
+    capsys.readouterr()
+
+    assert invoice_ledger.main(["totals", "--ledger", ledger.path, "--by", "property", "--csv"]) == 0
+    rows = list(csv.reader(io.StringIO(capsys.readouterr().out)))
+    assert rows[0] == ["property", "rent", "water", "energy", "extra", "total", "invoices"]
+    assert [(row[0], row[5], row[6]) for row in rows[1:]] == [("COLQUEPATA", "1250.5", "2"),
+                                                              ("QUIPAYPAMPA", "762.25", "1")]
+
+    assert invoice_ledger.main(["query", "--ledger", ledger.path, "--property", "COLQUEPATA", "--month", "Octubre",
+                                "--apartment", "102"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["property", "year", "month", "apartment", "first_name", "last_name", "total", "path"]
+    assert lines[1].split()[:7] == ["COLQUEPATA", "2026", "10", "102", "Luis", "Mamani", "660.50"]
+    assert len(lines) == 2
+
+    assert invoice_ledger.main(["query", "--ledger", str(tmp_path / "missing.sqlite")]) == 2
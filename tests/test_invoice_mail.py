@@ -0,0 +1,204 @@
+import asyncio
+import csv
+import io
+import os
+import threading
+import weakref
+
+import openpyxl
+import pytest
+
+import instrumentation
+import invoice_gen
+import invoice_mail
+import read_table
+
+TENANTS = [("101", "Ana", "Quispe", "ana@example.com"),
+           ("102", "Luis", "Mamani", "luis@example.com; nadie@example.com"),
+           ("103", "Rosa", "Huaman", "rosa@example.com")]
+
+
+class StubSmtpServer:
+    """
+    Local SMTP server speaking just enough of the protocol for smtplib : it accepts every message except the
+    'refused' addresses (550) and answers the first 'transient_failures' messages with a temporary error (451)
+    """
+
+    def __init__(self, refused=(), transient_failures=0):
+        self.refused = set(refused)
+        self.transient_failures = transient_failures
+        self.connections = 0
+        self.messages = []
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        recipients = []
+
+        def reply(line):
+            writer.write(line.encode("ascii") + b"\r\n")
+
+        reply("220 stub")
+        while True:
+            await writer.drain()
+            line = (await reader.readline()).decode("ascii").strip()
+            command = line.upper()
+            if not line or command == "QUIT":
+                reply("221 bye")
+                break
+            if command.startswith("EHLO"):
+                reply("250-stub")
+                reply("250 SIZE 10000000")
+            elif command.startswith("MAIL"):
+                recipients = []
+                reply("250 ok")
+            elif command.startswith("RCPT"):
+                address = line.split(":", 1)[1].strip(" <>")
+                if address in self.refused:
+                    reply("550 no such user")
+                else:
+                    recipients.append(address)
+                    reply("250 ok")
+            elif command == "DATA":
+                reply("354 go ahead")
+                await writer.drain()
+                while await reader.readline() not in (b".\r\n", b""):
+                    pass
+                if self.transient_failures:
+                    self.transient_failures -= 1
+                    reply("451 try again later")
+                else:
+                    self.messages.append(tuple(recipients))
+                    reply("250 queued")
+            else:
+                reply("250 ok")
+        await writer.drain()
+        writer.close()
+
+    def __enter__(self):
+        started = threading.Event()
+
+        async def serve():
+            self.stop = asyncio.Event()
+            server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            async with server:
+                await self.stop.wait()
+
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(serve(),), daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.stop.set)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def entries(tmp_path):
+    """
+    Run of three tenants with an e-mail column, whose invoices were generated
+    """
+
+    excel_file = str(tmp_path / "recibos.xlsx")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "CSV"
+    sheet.append(["DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "AGUA", "LUZ", "CORREO"])
+    for apartment, first_name, last_name, addresses in TENANTS:
+        sheet.append([apartment, first_name, last_name, 500, 10, 30, addresses])
+    workbook.save(excel_file)
+
+    entries = {"property": "COLQUEPATA", "year": "2026", "month": "Octubre", "excel": excel_file,
+               "output": str(tmp_path / "recibos")}
+    os.makedirs(entries['output'])
+    for apartment, first_name, last_name, addresses in TENANTS:
+        record = read_table.TenantRecord(apartment=apartment, first_name=first_name, last_name=last_name, rent=500.0,
+                                         energy=30.0, water=10.0)
+        with open(os.path.join(entries['output'], invoice_gen.get_output_filename("2026", "Octubre", record)),
+                  "wb") as file:
+            file.write(b"%PDF-1.4")
+
+    return entries
+
+
+def send(entries, server, concurrency=1):
+    smtp = {"host": "127.0.0.1", "port": server.port, "security": None, "user": None, "timeout": 10}
+
+    return invoice_mail.send_invoices(entries, smtp=smtp, sender="administracion@example.com",
+                                      concurrency=concurrency, backoff=0.0,
+                                      metrics=instrumentation.RunMetrics(stream=io.StringIO()))
+
+
+def read_report(entries):
+    with open(os.path.join(entries['output'], invoice_mail.get_delivery_filename(entries)), encoding="utf-8") as file:
+        return list(csv.DictReader(file))
+
+
+def test_refused_addresses_are_a_partial_delivery(entries):
+    with StubSmtpServer(refused={"nadie@example.com", "rosa@example.com"}) as server:
+        results = send(entries, server)
+
+    assert [result['status'] for result in results] == [invoice_mail.SENT, invoice_mail.PARTIAL, invoice_mail.FAILED]
+    assert "nadie@example.com (550 no such user)" in results[1]['error']
+    # Every address refused : permanent, not retried
+    assert results[2]['attempts'] == 1
+    assert server.messages == [("ana@example.com",), ("luis@example.com",)]
+
+    rows = read_report(entries)
+    assert rows[1]['estado'] == "partial" and "nadie@example.com" in rows[1]['error']
+
+
+def test_transient_failure_retried_over_the_same_connection(entries):
+    with StubSmtpServer(transient_failures=1) as server:
+        results = send(entries, server)
+
+    assert [result['status'] for result in results] == [invoice_mail.SENT] * 3
+    assert [result['attempts'] for result in results] == [2, 1, 1]
+    # The 451 reply leaves the session usable : the retry and the next messages reuse the connection
+    assert server.connections == 1
+    assert len(server.messages) == 3
+
+    rows = read_report(entries)
+    assert [(row['departamento'], row['estado'], row['intentos'], row['error']) for row in rows] == \
+        [("101", "sent", "2", ""), ("102", "sent", "1", ""), ("103", "sent", "1", "")]
+    assert rows[1]['correo'] == "luis@example.com nadie@example.com"
+
+
+def test_connections_bounded_by_the_concurrency(entries):
+    with StubSmtpServer(transient_failures=2) as server:
+        results = send(entries, server, concurrency=2)
+
+    assert all(result['status'] == invoice_mail.SENT for result in results)
+    assert sum(result['attempts'] for result in results) == 5
+    assert server.connections <= 2
+
+
+def test_messages_built_within_the_concurrency(entries, monkeypatch):
+    records = invoice_gen.load_workbook_records(excel_file=entries['excel'], sheet_names=["CSV"])["CSV"]
+    jobs = invoice_mail.build_delivery_jobs(entries, records=records,
+                                            recipients=invoice_mail.read_recipients(entries['excel']))
+    held = []
+    build_message = invoice_mail.build_message
+
+    def counted_build_message(job, entries, sender):
+        # Messages built and not yet released : one at a time with a concurrency of 1
+        assert not held
+        message = build_message(job, entries, sender)
+        held.append(job['filename'])
+        weakref.finalize(message, held.remove, job['filename'])
+        return message
+
+    monkeypatch.setattr(invoice_mail, "build_message", counted_build_message)
+    with StubSmtpServer() as server:
+        smtp = {"host": "127.0.0.1", "port": server.port, "security": None, "user": None, "timeout": 10}
+        # No metrics : the delivery makes its own
+        outcomes = asyncio.run(invoice_mail.deliver(jobs, entries, sender="administracion@example.com", smtp=smtp,
+                                                    concurrency=1, backoff=0.0))
+
+    assert [status for status, attempts, error in outcomes] == [invoice_mail.SENT] * 3
+    assert len(server.messages) == 3
@@ -0,0 +1,108 @@
+import io
+import json
+import os
+
+import instrumentation
+import invoice_gen
+import invoice_manifest
+import read_table
+
+
+def make_jobs(output_dir, month, apartments, image_path, signature_dpi=200):
+    header = {"image_path": image_path, "property": "COLQUEPATA", "building_address": "Jr. Colquepata 123",
+              "year": "2026", "month": month, "water": {}, "energy": {}, "issue_date": "01/11/2026",
+              "renderer": "pdf", "signature_dpi": signature_dpi}
+    for apartment in apartments:
+        record = read_table.TenantRecord(apartment=apartment, first_name="Ana", last_name="Quispe", rent=500.0,
+                                         energy=30.0, water=10.0)
+        filename = invoice_gen.get_output_filename("2026", month, record)
+        yield {"header": header, "client": record, "output_filename": filename,
+               "output_path": os.path.join(output_dir, filename), "total": None, "in_memory": False}
+
+
+def run(output_dir, month, apartments, image_path, signature_dpi=200):
+    """
+    Runs the manifest over the jobs of a period as 'invoice_gen.make_invoice' does, writing a dummy file per invoice
+
+    :return:    list of the output filenames rendered
+    """
+
+    manifest = invoice_manifest.InvoiceManifest(metrics=instrumentation.RunMetrics(stream=io.StringIO()))
+    manifest.add_directory(output_dir, period=("COLQUEPATA", "2026", month))
+    jobs = list(manifest.filter_jobs(make_jobs(output_dir, month, apartments, image_path, signature_dpi)))
+    for job in jobs:
+        with open(job['output_path'], "wb") as file:
+            file.write(b"%PDF")
+    list(manifest.record_results((job['output_filename'], None) for job in jobs))
+    manifest.save()
+
+    return [job['output_filename'] for job in jobs]
+
+
+def get_files(output_dir):
+    return sorted(name for name in os.listdir(output_dir) if name.endswith(".pdf"))
+
+
+def test_periods_sharing_a_folder(tmp_path):
+    image_path = tmp_path / "firma.png"
+    image_path.write_bytes(b"signature")
+    output_dir = str(tmp_path / "recibos")
+    os.makedirs(output_dir)
+
+    assert len(run(output_dir, "Octubre", ["101", "102"], str(image_path))) == 2
+    assert len(run(output_dir, "Noviembre", ["101", "102"], str(image_path))) == 2
+
+    # The November run leaves the October invoices alone, which are still known as up to date
+    assert get_files(output_dir) == ["2026_noviembre_depa_101_quispe.pdf", "2026_noviembre_depa_102_quispe.pdf",
+                                     "2026_octubre_depa_101_quispe.pdf", "2026_octubre_depa_102_quispe.pdf"]
+    assert run(output_dir, "Octubre", ["101", "102"], str(image_path)) == []
+
+
+def test_removed_tenant_of_the_period(tmp_path):
+    image_path = tmp_path / "firma.png"
+    image_path.write_bytes(b"signature")
+    output_dir = str(tmp_path / "recibos")
+    os.makedirs(output_dir)
+
+    run(output_dir, "Octubre", ["101", "102"], str(image_path))
+    run(output_dir, "Noviembre", ["101", "102"], str(image_path))
+    assert run(output_dir, "Noviembre", ["101"], str(image_path)) == []
+
+    assert get_files(output_dir) == ["2026_noviembre_depa_101_quispe.pdf", "2026_octubre_depa_101_quispe.pdf",
+                                     "2026_octubre_depa_102_quispe.pdf"]
+
+
+def test_manifest_without_periods(tmp_path):
+    image_path = tmp_path / "firma.png"
+    image_path.write_bytes(b"signature")
+    output_dir = str(tmp_path / "recibos")
+    os.makedirs(output_dir)
+
+    # Manifest of an older version : filename -> hash, the period is found from the file name
+    filenames = ["2026_octubre_depa_101_quispe.pdf", "2026_noviembre_depa_101_quispe.pdf",
+                 "2026_noviembre_depa_102_quispe.pdf"]
+    for filename in filenames:
+        (tmp_path / "recibos" / filename).write_bytes(b"%PDF")
+    with open(os.path.join(output_dir, invoice_manifest.MANIFEST_FILENAME), "w", encoding="utf-8") as file:
+        json.dump({"template_version": 2, "invoices": {filename: "0" * 64 for filename in filenames}}, file)
+
+    assert run(output_dir, "Noviembre", ["101"], str(image_path)) == ["2026_noviembre_depa_101_quispe.pdf"]
+    assert get_files(output_dir) == ["2026_noviembre_depa_101_quispe.pdf", "2026_octubre_depa_101_quispe.pdf"]
+
+
+def test_signature_changes(tmp_path):
+    image_path = tmp_path / "firma.png"
+    image_path.write_bytes(b"signature")
+    output_dir = str(tmp_path / "recibos")
+    os.makedirs(output_dir)
+
+    assert len(run(output_dir, "Octubre", ["101", "102"], str(image_path))) == 2
+    assert run(output_dir, "Octubre", ["101", "102"], str(image_path)) == []
+
+    # Same path, new content : e.g. a new scan of the signature
+    image_path.write_bytes(b"new signature")
+    os.utime(image_path, ns=(0, 0))
+    assert len(run(output_dir, "Octubre", ["101", "102"], str(image_path))) == 2
+
+    assert len(run(output_dir, "Octubre", ["101", "102"], str(image_path), signature_dpi=300)) == 2
+    assert run(output_dir, "Octubre", ["101", "102"], str(image_path), signature_dpi=300) == []
@@ -0,0 +1,39 @@
+import tarfile
+import zipfile
+
+import pytest
+
+import invoice_sink
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar", "tar.gz"])
+def test_archive_holds_the_files_and_the_manifest(tmp_path, archive_format):
+    path = str(tmp_path / invoice_sink.get_archive_filename("recibos", archive_format))
+    sink = invoice_sink.ArchiveSink(path, compression_level=0)
+    sink.add("101.pdf", b"%PDF-101")
+    sink.add("102.pdf", b"%PDF-102")
+    sink.close()
+
+    if archive_format == "zip":
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    else:
+        with tarfile.open(path) as archive:
+            names = archive.getnames()
+    assert names == ["101.pdf", "102.pdf", invoice_sink.MANIFEST_FILENAME]
+
+
+def test_tar_rejects_a_compression_level(tmp_path):
+    with pytest.raises(ValueError, match="tar.gz"):
+        invoice_sink.ArchiveSink(str(tmp_path / "recibos.tar"), compression_level=6)
+
+
+def test_abort_leaves_the_previous_archive(tmp_path):
+    path = tmp_path / "recibos.zip"
+    path.write_bytes(b"previous")
+    sink = invoice_sink.ArchiveSink(str(path))
+    sink.add("101.pdf", b"%PDF-101")
+    sink.abort()
+
+    assert path.read_bytes() == b"previous"
+    assert [file.name for file in tmp_path.iterdir()] == ["recibos.zip"]
@@ -0,0 +1,65 @@
+import csv
+import io
+
+import numpy as np
+
+import invoice_summary
+import read_table
+
+NAN = float("nan")
+
+RECORDS = [read_table.TenantRecord(apartment="101", first_name="Ana", last_name="Quispe", rent=500.0, energy=30.5,
+                                   water=NAN, extra_labels=("Cochera", "Limpieza"), extra_amounts=(50.0, 12.25)),
+           read_table.TenantRecord(apartment="102", first_name="Luis", last_name="Mamani", rent=600.0, energy=40.1,
+                                   water=20.2)]
+
+
+def write(records, summary):
+    with io.StringIO(newline="") as file:
+        invoice_summary.write_summary(file, records=records, summary=summary)
+        return list(csv.reader(io.StringIO(file.getvalue())))
+
+
+def test_summary_in_cents():
+    summary = invoice_summary.get_summary(RECORDS)
+
+    assert {column: (amounts.dtype, amounts.tolist()) for column, amounts in summary['tenants'].items()} == \
+        {"rent": (np.int64, [50000, 60000]),
+         "water": (np.int64, [0, 2020]),
+         "energy": (np.int64, [3050, 4010]),
+         "extra": (np.int64, [6225, 0]),
+         "total": (np.int64, [59275, 66030])}
+    assert summary['building'] == {"rent": 110000, "water": 2020, "energy": 7060, "extra": 6225, "total": 125305}
+    assert (summary['n_tenants'], summary['n_extra_charges'], summary['n_empty_amounts']) == (2, 2, 1)
+
+
+def test_summary_file():
+    assert write(RECORDS, invoice_summary.get_summary(RECORDS)) == [
+        invoice_summary.SUMMARY_HEADER,
+        ["101", "Ana", "Quispe", "500.00", "0.00", "30.50", "62.25", "592.75"],
+        ["102", "Luis", "Mamani", "600.00", "20.20", "40.10", "0.00", "660.30"],
+        ["TOTAL", "2 inquilinos", "", "1100.00", "20.20", "70.60", "62.25", "1253.05"]]
+
+
+def test_totals_exact_whatever_the_number_of_tenants():
+    records = [read_table.TenantRecord(apartment=str(i), first_name="", last_name="", rent=0.1, energy=0.2, water=0.3)
+               for i in range(10000)]
+
+    # As floats, 10000 times 0.1 is not 1000
+    assert sum(record.rent for record in records) != 1000.0
+    assert invoice_summary.get_summary(records)['building'] == {"rent": 100000, "water": 300000, "energy": 200000,
+                                                                "extra": 0, "total": 600000}
+
+
+def test_no_tenants():
+    summary = invoice_summary.get_summary([])
+
+    assert summary['building'] == dict.fromkeys(invoice_summary.AMOUNT_COLUMNS, 0)
+    assert all(amounts.dtype == np.int64 and len(amounts) == 0 for amounts in summary['tenants'].values())
+    assert write([], summary) == [invoice_summary.SUMMARY_HEADER,
+                                  ["TOTAL", "0 inquilinos", "", "0.00", "0.00", "0.00", "0.00", "0.00"]]
+
+
+def test_format_cents():
+    assert [invoice_summary.format_cents(cents) for cents in (0, 5, 123450, -5, -123456)] == \
+        ["0.00", "0.05", "1234.50", "-0.05", "-1234.56"]
@@ -0,0 +1,32 @@
+import io
+import re
+
+import benchmark
+import instrumentation
+import invoice_gen
+import invoice_template
+import pdf_check
+
+IMAGE_PATTERN = re.compile(rb"/Subtype\s*/Image")
+
+
+def test_signature_stored_once_in_a_multi_page_pdf(tmp_path):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=3, n_pairs=1)
+    entries = benchmark.get_entries(excel_file, output_dir=str(tmp_path / "recibos"), renderer="matplotlib")
+
+    assert invoice_gen.make_invoice(entries, single_pdf=True,
+                                    metrics=instrumentation.RunMetrics(stream=io.StringIO())) == []
+
+    data = (tmp_path / "recibos" / invoice_gen.get_single_pdf_filename(entries)).read_bytes()
+    assert len(pdf_check.PAGE_PATTERN.findall(data)) == 3
+    assert len(IMAGE_PATTERN.findall(data)) == 1
+
+
+def test_unknown_internals_fall_back():
+    class Document:
+        """
+        Stands for a 'PdfPages' of a matplotlib version without the expected internals
+        """
+
+    assert invoice_template.share_pdf_images(Document()) is False
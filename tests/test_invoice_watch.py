@@ -0,0 +1,50 @@
+import io
+import json
+import threading
+import time
+
+import openpyxl
+
+import benchmark
+import instrumentation
+import invoice_gen
+import invoice_watch
+
+
+def wait_for_updates(stream, n_updates, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        events = [json.loads(line)['event'] for line in stream.getvalue().splitlines()]
+        if events.count("watch_update") >= n_updates:
+            return
+        time.sleep(0.02)
+    raise TimeoutError(f"no {n_updates} updates after {timeout} s")
+
+
+def test_watch_keeps_the_template_warm(tmp_path):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=3, n_pairs=1)
+    entries = benchmark.get_entries(excel_file, output_dir=str(tmp_path / "recibos"), renderer="pdf")
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    stop = threading.Event()
+
+    watch = threading.Thread(target=invoice_watch.watch_invoices,
+                             kwargs={"entries": entries, "interval": 0.05, "metrics": metrics, "stop": stop})
+    watch.start()
+    try:
+        wait_for_updates(stream, 1)
+        template = invoice_gen._template
+        assert template is not None
+
+        # A new rent for one tenant : a single invoice rendered with the same template
+        workbook = openpyxl.load_workbook(excel_file)
+        workbook["CSV"]["D2"] = 999
+        workbook.save(excel_file)
+        wait_for_updates(stream, 2)
+        assert invoice_gen._template is template
+    finally:
+        stop.set()
+        watch.join()
+
+    assert invoice_gen._template is None
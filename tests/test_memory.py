@@ -0,0 +1,56 @@
+import matplotlib.font_manager
+import matplotlib.text
+import pytest
+
+import benchmark
+import invoice_template
+
+# Number of invoices of the short run, the long one renders 4 times as many. matplotlib is slow under tracemalloc
+COUNTS = {"pdf": 25, "matplotlib": 4}
+
+
+def get_text_metrics_size():
+    """
+    :return:    size of the text metrics cache of matplotlib : layouts cached, or renderers holding a cache of their
+                own in recent versions
+    """
+
+    cache = getattr(matplotlib.text, '_get_text_metrics_with_cache_impl', None)
+    if cache is not None:
+        return cache.cache_info().currsize
+
+    return sum(len(renderers) for renderers in matplotlib.text._get_text_metrics_function.__defaults__)
+
+
+@pytest.mark.parametrize("renderer", ["pdf", "matplotlib"])
+def test_memory_does_not_grow_with_the_invoices(tmp_path, renderer):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=20, n_pairs=3)
+    count = COUNTS[renderer]
+
+    short, long = benchmark.bench_memory(excel_file, counts=[count, 4 * count], renderer=renderer)
+
+    # Whatever the first invoices leave behind (e.g. caches filled once), rendering more of them adds nothing
+    assert long['traced_retained_mb'] <= short['traced_retained_mb'] + 0.5
+    assert benchmark.is_memory_flat([short, long], slack_mb=0.5)
+
+
+def test_caches_cleared_during_long_runs(tmp_path, monkeypatch):
+    excel_file = str(tmp_path / "recibos.xlsx")
+    benchmark.make_workbook(excel_file, n_tenants=20, n_pairs=3)
+    cleared = []
+    clear_caches = invoice_template.clear_caches
+
+    def counted_clear_caches():
+        clear_caches()
+        cleared.append((get_text_metrics_size(), matplotlib.font_manager._get_font.cache_info().currsize))
+
+    monkeypatch.setattr(invoice_template, "CACHE_CLEAR_INTERVAL", 3)
+    monkeypatch.setattr(invoice_template, "clear_caches", counted_clear_caches)
+
+    short, long = benchmark.bench_memory(excel_file, counts=[4, 16], renderer="matplotlib")
+
+    # The warm-up page counts : 5 then 17 pages, a clear every 3 of them
+    assert cleared == [(0, 0)] * 6
+    assert long['traced_retained_mb'] <= short['traced_retained_mb'] + 0.5
+    assert benchmark.is_memory_flat([short, long], slack_mb=0.5)
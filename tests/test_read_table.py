@@ -0,0 +1,65 @@
+import io
+import json
+
+import openpyxl
+
+import instrumentation
+import invoice_gen
+import read_table
+import table_cache
+
+HEADER = ["DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "AGUA", "LUZ", "CONCEPTO 1", "MONTO 1", "CONCEPTO 2",
+          "MONTO 2"]
+
+ROWS = [[101, "Ana", "Quispe", 500, 12.346, 30.5, "Cochera", 50, None, None],
+        # Zero and blank amounts, label without amount and amount without label : no extra charge kept
+        ["102", "Luis", "Mamani", 600, 20, 40, "Cochera", 0, "Limpieza", None],
+        [None] * 10,
+        ["103", "Rosa", "Huaman", 700, None, 35, None, 15, "", 20],
+        [],
+        ["104", "Juan", None, 650, 0, 0, "Limpieza", 10.004, "Cochera", 25.5],
+        [None] * 10]
+
+
+def write_workbook(path):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "CSV"
+    sheet.append(HEADER)
+    for row in ROWS:
+        sheet.append(row)
+    workbook.save(path)
+
+    return str(path)
+
+
+def get_events(stream):
+    return [json.loads(line)["event"] for line in stream.getvalue().splitlines()]
+
+
+def test_readers_return_the_same_records(tmp_path):
+    excel_file = write_workbook(tmp_path / "recibos.xlsx")
+    metrics = instrumentation.RunMetrics(stream=io.StringIO())
+
+    records = invoice_gen.load_workbook_records(excel_file, sheet_names=["CSV"], metrics=metrics)["CSV"]
+    streamed = [record for sheet_name, record in read_table.iter_workbook_records(excel_file)]
+
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    cache = table_cache.TableCache(cache_dir=str(tmp_path / "cache"))
+    invoice_gen.load_workbook_records(excel_file, sheet_names=["CSV"], metrics=metrics, cache=cache)
+    cached = invoice_gen.load_workbook_records(excel_file, sheet_names=["CSV"], metrics=metrics, cache=cache)["CSV"]
+    assert get_events(stream).count("cache_hit") == 1
+
+    # repr compares the empty (NaN) amounts and the types of the fields as well
+    assert repr(streamed) == repr(records)
+    assert repr(cached) == repr(records)
+
+    assert [record.apartment for record in records] == ["101", "102", "103", "104"]
+    assert repr(records[0]) == repr(read_table.TenantRecord(apartment="101", first_name="Ana", last_name="Quispe",
+                                                            rent=500.0, energy=30.5, water=12.35,
+                                                            extra_labels=("Cochera",), extra_amounts=(50.0,)))
+    assert records[1].extra_labels == () and records[1].extra_amounts == ()
+    assert repr(records[2].water) == "nan" and records[2].extra_labels == ()
+    assert records[3].last_name == "" and records[3].water == 0.0
+    assert records[3].extra_labels == ("Limpieza", "Cochera") and records[3].extra_amounts == (10.0, 25.5)
@@ -0,0 +1,74 @@
+import io
+import json
+
+import instrumentation
+import read_table
+import table_cache
+
+RECORDS = {"CSV": [read_table.TenantRecord(apartment="101", first_name="Ana", last_name="Quispe", rent=500.0,
+                                           energy=30.5, water=12.0, extra_labels=("Cochera",),
+                                           extra_amounts=(50.0,))]}
+
+
+def get_events(stream):
+    return [json.loads(line)["event"] for line in stream.getvalue().splitlines()]
+
+
+def test_store_then_load(tmp_path):
+    excel_file = tmp_path / "recibos.xlsx"
+    excel_file.write_bytes(b"sheets")
+    cache = table_cache.TableCache(cache_dir=str(tmp_path / "cache"))
+
+    assert cache.load(str(excel_file), ["CSV"], "A:P") is None
+    cache.store(str(excel_file), ["CSV"], "A:P", records=RECORDS)
+
+    assert cache.load(str(excel_file), ["CSV"], "A:P") == RECORDS
+
+
+def test_unusable_folder_is_a_miss_logged_once(tmp_path):
+    excel_file = tmp_path / "recibos.xlsx"
+    excel_file.write_bytes(b"sheets")
+    # e.g. HOME set to a file : the cache folder cannot be created
+    (tmp_path / "home").write_text("not a folder")
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    cache = table_cache.TableCache(cache_dir=str(tmp_path / "home" / ".cache"))
+
+    for _ in range(2):
+        assert cache.load(str(excel_file), ["CSV"], "A:P", metrics=metrics) is None
+        cache.store(str(excel_file), ["CSV"], "A:P", records=RECORDS, metrics=metrics)
+
+    assert cache.disabled
+    assert get_events(stream) == ["cache_error"]
+
+
+def test_corrupt_entry_is_a_miss_and_replaced(tmp_path):
+    excel_file = tmp_path / "recibos.xlsx"
+    excel_file.write_bytes(b"sheets")
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    cache = table_cache.TableCache(cache_dir=str(tmp_path / "cache"))
+    cache.store(str(excel_file), ["CSV"], "A:P", records=RECORDS)
+
+    path = cache.get_entry_path(str(excel_file), ["CSV"], "A:P")
+    with open(path, "r+b") as file:
+        file.truncate(20)
+
+    assert cache.load(str(excel_file), ["CSV"], "A:P", metrics=metrics) is None
+    assert get_events(stream) == ["cache_ignored"]
+    cache.store(str(excel_file), ["CSV"], "A:P", records=RECORDS, metrics=metrics)
+    assert cache.load(str(excel_file), ["CSV"], "A:P", metrics=metrics) == RECORDS
+
+
+def test_corrupt_index_is_a_miss(tmp_path):
+    excel_file = tmp_path / "recibos.xlsx"
+    excel_file.write_bytes(b"sheets")
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / table_cache.INDEX_FILENAME).write_text(json.dumps({str(excel_file): {"size": 6}}))
+    stream = io.StringIO()
+    metrics = instrumentation.RunMetrics(log_format="json", stream=stream)
+    cache = table_cache.TableCache(cache_dir=str(tmp_path / "cache"))
+
+    assert cache.load(str(excel_file), ["CSV"], "A:P", metrics=metrics) is None
+    cache.store(str(excel_file), ["CSV"], "A:P", records=RECORDS, metrics=metrics)
+    assert get_events(stream) == ["cache_error"]
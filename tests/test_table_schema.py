@@ -0,0 +1,106 @@
+import openpyxl
+import pytest
+
+import read_table
+import table_schema
+
+HEADER = ("DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "AGUA", "LUZ")
+
+
+def write_sheet(path, header, rows=(), sheet_name="CSV"):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = sheet_name
+    sheet.append(list(header))
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(path)
+
+    return str(path)
+
+
+def read_schema(excel_file, sheet_name="CSV"):
+    return table_schema.read_sheet_schemas(excel_file, sheet_names=[sheet_name])[sheet_name]
+
+
+def test_missing_column(tmp_path):
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", ("DEPARTAMENTO", "NOMBRE", "APELLIDO", "ALQUILER", "LUZ"))
+
+    with pytest.raises(table_schema.SchemaError) as info:
+        read_schema(excel_file)
+
+    assert str(info.value) == "sheet 'CSV': missing column 'water' (header containing 'agua')"
+
+
+def test_duplicate_column(tmp_path):
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", HEADER + ("LUZ COMUN",))
+
+    with pytest.raises(table_schema.SchemaError) as info:
+        read_schema(excel_file)
+
+    assert str(info.value) == "sheet 'CSV': columns 'LUZ' (F), 'LUZ COMUN' (G) are all read as 'energy'"
+
+
+def test_unpaired_extra_column(tmp_path):
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", HEADER + ("CONCEPTO 1", "MONTO 1", "CONCEPTO 2"))
+
+    with pytest.raises(table_schema.SchemaError) as info:
+        read_schema(excel_file)
+
+    assert str(info.value) == ("sheet 'CSV': the 3 extra columns must come in label/amount pairs : column "
+                               "'CONCEPTO 2' (I) has no amount column")
+
+
+def test_missing_sheet_and_header(tmp_path):
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", (), sheet_name="Hoja1")
+
+    with pytest.raises(table_schema.SchemaError, match=r"sheet 'CSV' not found, the sheets are \['Hoja1'\]"):
+        read_schema(excel_file)
+    with pytest.raises(table_schema.SchemaError, match="sheet 'Hoja1' has no header row"):
+        read_schema(excel_file, sheet_name="Hoja1")
+
+
+def test_email_column_matched_by_its_exact_header():
+    schema = table_schema.compile_schema(HEADER + ("Correo",))
+    assert schema.names[-1] == "email" and schema.n_pairs == 0
+
+    # A header merely containing 'mail' is an extra charge
+    schema = table_schema.compile_schema(HEADER + ("Mailbox", "Monto"))
+    assert schema.names[-2:] == ("label_0", "amount_0") and "email" not in schema.positions
+
+    with pytest.raises(table_schema.SchemaError, match="'Correo' \\(G\\), 'Email' \\(H\\) are all read as 'email'"):
+        table_schema.compile_schema(HEADER + ("Correo", "Email"))
+
+
+@pytest.mark.parametrize("row, column", [(["101", "Ana", "Quispe", "quinientos", 10, 30, "Cochera", 50],
+                                          "'ALQUILER' (D), row 3: 'quinientos'"),
+                                         (["101", "Ana", "Quispe", 500, 10, 30, "Cochera", "S/. 50"],
+                                          "'MONTO' (H), row 3: 'S/. 50'")])
+def test_amount_not_a_number(tmp_path, row, column):
+    rows = [["100", "Rosa", "Huaman", 700, 15, 35, None, None], row]
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", HEADER + ("CONCEPTO", "MONTO"), rows)
+    message = f"sheet 'CSV': column {column} is not a number"
+
+    with pytest.raises(table_schema.SchemaError) as info:
+        read_table.read_sheets(excel_file, schemas={"CSV": read_schema(excel_file)})
+    assert str(info.value) == message
+
+    # Same message when the sheet is streamed
+    with pytest.raises(table_schema.SchemaError) as info:
+        list(read_table.iter_workbook_records(excel_file))
+    assert str(info.value) == message
+
+
+def test_empty_rows_ignored(tmp_path):
+    rows = [["100", "Rosa", "Huaman", 700, 15, 35],
+            [None] * 6,
+            [],
+            ["101", "Ana", "Quispe", 500, 10, 30],
+            [None] * 6]
+    excel_file = write_sheet(tmp_path / "recibos.xlsx", HEADER, rows)
+
+    dataframe = read_table.read_sheets(excel_file, schemas={"CSV": read_schema(excel_file)})["CSV"]
+    records = read_table.get_table_dictionary(dataframe, schema=read_schema(excel_file))
+    assert [record.apartment for record in records] == ["100", "101"]
+
+    assert [record.apartment for sheet_name, record in read_table.iter_workbook_records(excel_file)] == ["100", "101"]
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
+import time
+import queue
+import threading
 import tkinter
-from tkinter import ttk, filedialog
+from tkinter import ttk, filedialog, messagebox
 from tkcalendar import Calendar
 from datetime import datetime
 import invoice_gen
+import instrumentation
+import table_cache
+
+# Milliseconds between two reads of the progress queue by the Tk main loop
+POLL_INTERVAL = 100
 
 
 def pick_date(entry, window, date_var):
@@ -72,7 +80,7 @@ def browse_folder(entry_var):
 def get_widget_entries(property_var, year_var, month_var,
                        water_starting_date_var, water_ending_date_var,
                        energy_starting_date_var, energy_ending_date_var,
-                       open_excel_file_entry_var, open_folder_entry_var, window):
+                       open_excel_file_entry_var, open_folder_entry_var):
     """
     Retrieves values from provided variables associated with different widgets and returns them as a dictionary
 
@@ -85,7 +93,6 @@ def get_widget_entries(property_var, year_var, month_var,
     :param energy_ending_date_var:     The StringVar associated with the energy ending date Entry
     :param open_excel_file_entry_var:    The StringVar associated with the Excel file path Entry
     :param open_folder_entry_var:      The StringVar associated with the folder path Entry
-    :param window:                     Main 'Tkinker' window
     :return:                           dict: A dictionary containing the retrieved values from the provided
                                        variables
     """
@@ -102,11 +109,218 @@ def get_widget_entries(property_var, year_var, month_var,
                "output": open_folder_entry_var.get()
                }
 
-    window.destroy()
-
     return entries
 
 
+class QueueMetrics(instrumentation.RunMetrics):
+    """
+    Run metrics that also send every event to a queue, read by the Tk main loop to follow a run done on a worker thread
+    """
+
+    def __init__(self, events):
+        """
+        :param events:  'queue.Queue' receiving tuples (event, fields)
+        """
+
+        super().__init__()
+        self.events = events
+
+    def log(self, event, message="", **fields):
+        super().log(event, message, **fields)
+        self.events.put((event, fields))
+
+
+def format_duration(seconds):
+    """
+    :param seconds:     duration in seconds
+    :return:            duration as 'm:ss'
+    """
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+
+    return f"{minutes}:{seconds:02d}"
+
+
+class InvoiceRun:
+    """
+    Generation of the invoices on a worker thread, followed from the Tk main loop : progress bar, counts, throughput,
+    remaining time and cancellation between two invoices
+    """
+
+    def __init__(self, window, progress_bar, status_var, generate_button, cancel_button):
+        """
+        :param window:          main Tk window
+        :param progress_bar:    'ttk.Progressbar' of the run
+        :param status_var:      StringVar of the status label
+        :param generate_button: button starting a run, disabled while a run is going on
+        :param cancel_button:   button cancelling the run, enabled while a run is going on
+        """
+
+        self.window = window
+        self.progress_bar = progress_bar
+        self.status_var = status_var
+        self.generate_button = generate_button
+        self.cancel_button = cancel_button
+
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+        self.total = None
+        self.done = {"rendered": 0, "failed": 0, "skipped": 0}
+        self.start_time = self.render_start_time = time.perf_counter()
+
+    def start(self, entries):
+        """
+        Starts the generation of the invoices of the entries, unless a run is already going on
+
+        :param entries: dictionary of the widget entries (see 'get_widget_entries')
+        :return:        None
+        """
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.cancel_event.clear()
+        self.total = None
+        self.done = {"rendered": 0, "failed": 0, "skipped": 0}
+        self.start_time = self.render_start_time = time.perf_counter()
+
+        self.progress_bar.config(mode='indeterminate', value=0)
+        self.progress_bar.start()
+        self.status_var.set("Leyendo el archivo Excel...")
+        self.generate_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+
+        self.thread = threading.Thread(target=self.run, args=(entries,), daemon=True)
+        self.thread.start()
+        self.window.after(POLL_INTERVAL, self.poll)
+
+    def run(self, entries):
+        """
+        Body of the worker thread : the outcome of the run is sent to the queue as a final 'finished' event
+
+        :param entries: dictionary of the widget entries (see 'get_widget_entries')
+        :return:        None
+        """
+
+        metrics = QueueMetrics(self.events)
+        try:
+            failures = invoice_gen.make_invoice(entries, metrics=metrics, cache=table_cache.TableCache(),
+                                                cancel=self.cancel_event, ledger=invoice_gen.get_ledger())
+            metrics.report()
+            self.events.put(("finished", {"failures": failures}))
+        except Exception as e:
+            self.events.put(("finished", {"error": f"{type(e).__name__}: {e}"}))
+
+    def cancel(self):
+        """
+        Asks the run to stop after the invoices being rendered
+
+        :return:    None
+        """
+
+        self.cancel_event.set()
+        self.cancel_button.config(state='disabled')
+        self.status_var.set("Cancelando...")
+
+    def close(self):
+        """
+        Closes the window, after the invoices being rendered if a run is going on
+
+        :return:    None
+        """
+
+        if self.thread is not None and self.thread.is_alive():
+            if not messagebox.askokcancel("GENERADOR DE RECIBOS", "¿Cancelar la generación de los recibos y salir?"):
+                return
+            self.cancel_event.set()
+            self.thread.join()
+
+        self.window.destroy()
+
+    def poll(self):
+        """
+        Reads the events of the worker thread and updates the window, until the run is finished
+
+        :return:    None
+        """
+
+        finished = None
+        while True:
+            try:
+                event, fields = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "tenants":
+                self.total = fields['tenants']
+                self.render_start_time = time.perf_counter()
+                self.progress_bar.stop()
+                self.progress_bar.config(mode='determinate', maximum=max(1, self.total), value=0)
+            elif event in ("invoice_rendered", "invoice_failed", "invoice_skipped"):
+                self.done[event.split("_")[1]] += 1
+            elif event == "finished":
+                finished = fields
+
+        if finished is not None:
+            self.finish(finished)
+            return
+
+        self.update_status()
+        self.window.after(POLL_INTERVAL, self.poll)
+
+    def update_status(self):
+        """
+        Shows the progress of the run : counts, throughput and remaining time
+
+        :return:    None
+        """
+
+        n_done = sum(self.done.values())
+        if self.total is None:
+            return
+
+        elapsed = time.perf_counter() - self.render_start_time
+        rate = n_done / elapsed if elapsed > 0 else 0.0
+        status = f"{n_done} / {self.total} recibos ({self.done['failed']} con error) - {rate:.1f} recibos/s"
+        if 0 < n_done < self.total and not self.cancel_event.is_set():
+            status += f" - quedan {format_duration((self.total - n_done) / rate)}"
+
+        self.progress_bar.config(value=n_done)
+        if not self.cancel_event.is_set():
+            self.status_var.set(status)
+
+    def finish(self, outcome):
+        """
+        Shows the outcome of the run and gets the window ready for another one
+
+        :param outcome: fields of the 'finished' event : 'failures' list, or 'error' message if the run stopped
+        :return:        None
+        """
+
+        self.progress_bar.stop()
+        self.generate_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+
+        if 'error' in outcome:
+            self.progress_bar.config(mode='determinate', value=0)
+            self.status_var.set("No se generó ningún recibo.")
+            messagebox.showerror("GENERADOR DE RECIBOS", outcome['error'])
+            return
+
+        self.update_status()
+        elapsed = format_duration(time.perf_counter() - self.start_time)
+        status = (f"{self.done['rendered']} recibos generados, {self.done['skipped']} sin cambios, "
+                  f"{self.done['failed']} con error, en {elapsed}.")
+        if self.cancel_event.is_set():
+            status = "Cancelado : " + status
+        self.status_var.set(status)
+
+        if outcome['failures']:
+            messagebox.showwarning("GENERADOR DE RECIBOS",
+                                   "\n".join(f"{filename} : {error}" for filename, error in outcome['failures']))
+
+
 def run_widget():
 
     global window
@@ -123,7 +337,7 @@ def run_widget():
     property_var = tkinter.StringVar()
     property_label = tkinter.Label(frame, text="INMUEBLE")
     property_label.grid(row=0, column=0)
-    property_cb = ttk.Combobox(frame, values=["COLQUEPATA", "QUIPAYPAMPA"], state='readonly',
+    property_cb = ttk.Combobox(frame, values=invoice_gen.PROPERTIES, state='readonly',
                                textvariable=property_var)
     property_cb.grid(row=1, column=0, padx=10)
 
@@ -139,9 +353,7 @@ def run_widget():
     month_var = tkinter.StringVar()
     month_label = tkinter.Label(frame, text="MES")
     month_label.grid(row=0, column=2, pady=10)
-    month_values = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
-                    "Julio", "Agosto", "Setiembre", "Octubre", "Noviembre", "Diciembre"]
-    month_cb = ttk.Combobox(frame, values=month_values, state='readonly', textvariable=month_var)
+    month_cb = ttk.Combobox(frame, values=invoice_gen.MONTHS, state='readonly', textvariable=month_var)
     month_cb.grid(row=1, column=2, padx=10)
 
     # Calendar : water
@@ -208,7 +420,7 @@ def run_widget():
 
     # Generate Invoice Button
     gen_invoice_button = tkinter.Button(frame, text="GENERAR RECIBOS",
-                                        command=lambda: invoice_gen.make_invoice(get_widget_entries(
+                                        command=lambda: invoice_run.start(get_widget_entries(
                                             property_var=property_var,
                                             year_var=year_var,
                                             month_var=month_var,
@@ -217,10 +429,24 @@ def run_widget():
                                             energy_starting_date_var=energy_starting_date_var,
                                             energy_ending_date_var=energy_ending_date_var,
                                             open_excel_file_entry_var=open_excel_file_entry_var,
-                                            open_folder_entry_var=open_folder_entry_var,
-                                            window=window))
+                                            open_folder_entry_var=open_folder_entry_var))
                                         )
     gen_invoice_button.config(width=20, height=3, fg='green', font=('Helvetica', 16))
     gen_invoice_button.grid(row=16, column=2, sticky="news", padx=20, pady=10)
 
+    # Progress of the run
+    progress_bar = ttk.Progressbar(frame, orient='horizontal', mode='determinate')
+    progress_bar.grid(row=14, column=0, columnspan=3, sticky="we", padx=20, pady=10)
+    status_var = tkinter.StringVar()
+    status_label = tkinter.Label(frame, textvariable=status_var)
+    status_label.grid(row=15, column=0, columnspan=3, padx=20)
+
+    cancel_button = tkinter.Button(frame, text="CANCELAR", state='disabled', command=lambda: invoice_run.cancel())
+    cancel_button.config(width=20, height=3, fg='red', font=('Helvetica', 16))
+    cancel_button.grid(row=16, column=1, sticky="news", padx=20, pady=10)
+
+    invoice_run = InvoiceRun(window=window, progress_bar=progress_bar, status_var=status_var,
+                             generate_button=gen_invoice_button, cancel_button=cancel_button)
+    window.protocol("WM_DELETE_WINDOW", invoice_run.close)
+
     window.mainloop()